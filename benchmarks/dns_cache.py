@@ -0,0 +1,95 @@
+"""
+Hit rate and latency of the local DNS cache against an upstream stub.
+
+A stub DNS server on 127.0.0.1 answers A queries after a delay that
+stands in for the tunnel round trip, and NXDOMAIN with an SOA for names
+starting with "nx". A Zipf-distributed workload is resolved through
+dnscache.Resolver, and hits and misses are timed separately.
+
+    python3 benchmarks/dns_cache.py --queries 5000 --delay 0.02
+"""
+# Standard Libraries
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import argparse
+import threading
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protonvpn_cli import dnscache  # noqa: E402
+from protonvpn_cli.dnscache import HEADER  # noqa: E402
+
+
+def start_upstream(delay):
+    """Start the upstream stub, return its address"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def answer(query, address):
+        time.sleep(delay)
+        query_id = struct.unpack_from("!H", query)[0]
+        end = dnscache._skip_name(query, HEADER.size)
+        question = query[HEADER.size:end + 4]
+        if query[HEADER.size + 1:HEADER.size + 3] == b"nx":
+            # MNAME and RNAME are the root, MINIMUM is 60
+            soa = b"\xc0\x0c" + struct.pack("!HHIH", 6, 1, 3600, 22) + b"\0\0" + struct.pack("!IIIII", 1, 2, 3, 4, 60)
+            response = HEADER.pack(query_id, 0x8183, 1, 0, 1, 0) + question + soa
+        else:
+            record = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + bytes([10, 0, 0, 1])
+            response = HEADER.pack(query_id, 0x8180, 1, 1, 0, 0) + question + record
+        sock.sendto(response, address)
+
+    def serve():
+        while True:
+            query, address = sock.recvfrom(512)
+            threading.Thread(target=answer, args=(query, address), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()
+
+
+def make_query(name, query_id):
+    query = HEADER.pack(query_id, 0x0100, 1, 0, 0, 0)
+    for label in name.split("."):
+        query += bytes([len(label)]) + label.encode()
+    return query + b"\0" + struct.pack("!HH", 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--names", type=int, default=300, help="Names that resolve, plus 10%% that don't")
+    parser.add_argument("--delay", type=float, default=0.02, help="Upstream delay in seconds")
+    args = parser.parse_args()
+
+    resolver = dnscache.Resolver([start_upstream(args.delay)])
+    names = ["host{0}.example".format(idx) for idx in range(args.names)]
+    names += ["nx{0}.example".format(idx) for idx in range(args.names // 10)]
+    random.seed(1)
+    workload = random.choices(names, [1 / (rank + 1) for rank in range(len(names))], k=args.queries)
+
+    hits, misses = [], []
+    for idx, name in enumerate(workload):
+        query = make_query(name, idx & 0xFFFF)
+        cache_hits = resolver.cache.hits
+        start = time.perf_counter()
+        response = resolver.resolve(query)
+        duration = time.perf_counter() - start
+        assert response[:2] == query[:2]
+        (hits if resolver.cache.hits > cache_hits else misses).append(duration)
+
+    total = sum(hits) + sum(misses)
+    print("{0} queries over {1} names, upstream delay {2:g} ms".format(len(workload), len(names), args.delay * 1000))
+    print("hit rate     {0:.1%} ({1} hits, {2} misses)".format(len(hits) / len(workload), len(hits), len(misses)))
+    print("median hit   {0:.3f} ms".format(statistics.median(hits) * 1000 if hits else 0))
+    print("median miss  {0:.1f} ms".format(statistics.median(misses) * 1000 if misses else 0))
+    print("mean query   {0:.2f} ms".format(total / len(workload) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Recovery time of the network state journal.
+
+Journals a DNS, IPv6 and Kill Switch change like a connect does and
+measures the batch rollback on disconnect and the crash recovery of the
+next start (detection and rollback), against restoring the former backup
+files one by one. iptables-restore and ip6tables-restore are replaced by
+stubs that read the rules, so the firewall of this machine isn't touched.
+The journal and all files live in a temporary directory.
+
+    python3 benchmarks/journal_rollback.py --runs 20
+"""
+# Standard Libraries
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protonvpn_cli import journal  # noqa: E402
+
+ORIGINAL_RESOLV = "search lan\nnameserver 192.168.1.1\n"
+VPN_RESOLV = "search lan\nnameserver 10.8.8.1\n"
+RULES = "*filter\n:INPUT ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n" + "-A OUTPUT -o lo -j ACCEPT\n" * 200 + "COMMIT\n"
+TOOLS = ["iptables-restore", "ip6tables-restore"]
+
+
+def install_stub_tools(directory):
+    """Put restore tools that only read their input first on PATH"""
+    bin_dir = os.path.join(directory, "bin")
+    os.mkdir(bin_dir)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\ncat > /dev/null\n")
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def journal_connect(resolv_path, pid=None):
+    """Journal and apply the changes of a connect, pid fakes the connecting process"""
+    with open(resolv_path, "w") as f:
+        f.write(ORIGINAL_RESOLV)
+    journal.begin()
+    journal.record(journal.DNS, journal.restore_file_step(resolv_path, ORIGINAL_RESOLV, VPN_RESOLV))
+    with open(resolv_path, "w") as f:
+        f.write(VPN_RESOLV)
+    journal.record(journal.IPV6, journal.restore_rules_step("ip6tables-restore", RULES))
+    journal.record(journal.KILLSWITCH, journal.restore_rules_step("iptables-restore", RULES))
+    if pid is not None:
+        with open(journal.JOURNAL_FILE, "r") as f:
+            content = f.read().replace('"pid":{0}'.format(os.getpid()), '"pid":{0}'.format(pid))
+        with open(journal.JOURNAL_FILE, "w") as f:
+            f.write(content)
+
+
+def backup_restore(directory, resolv_path):
+    """Restore the former backup files like disconnect() did, return seconds"""
+    backup = resolv_path + ".backup"
+    with open(backup, "w") as f:
+        f.write(ORIGINAL_RESOLV)
+    for tool in TOOLS:
+        with open(os.path.join(directory, tool + ".backup"), "w") as f:
+            f.write(RULES)
+
+    start = time.monotonic()
+    shutil.copy2(backup, resolv_path)
+    os.remove(backup)
+    for tool in reversed(TOOLS):
+        backup = os.path.join(directory, tool + ".backup")
+        subprocess.run("{0} < {1}".format(tool, backup), shell=True, stdout=subprocess.PIPE)
+        os.remove(backup)
+    return time.monotonic() - start
+
+
+def journal_rollback(resolv_path):
+    journal_connect(resolv_path)
+    start = time.monotonic()
+    journal.rollback()
+    return time.monotonic() - start
+
+
+def crash_recovery(resolv_path):
+    # A pid that can't exist, as if the connecting process crashed
+    journal_connect(resolv_path, pid=2 ** 22 + 1)
+    start = time.monotonic()
+    assert journal.needs_recovery()
+    journal.rollback()
+    duration = time.monotonic() - start
+    with open(resolv_path, "r") as f:
+        assert f.read() == ORIGINAL_RESOLV
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="pvpn-bench-")
+    journal.JOURNAL_FILE = os.path.join(directory, "netstate.journal")
+    resolv_path = os.path.join(directory, "resolv.conf")
+    try:
+        install_stub_tools(directory)
+        results = [
+            ("backup file restores", [backup_restore(directory, resolv_path) for _ in range(args.runs)]),
+            ("journal rollback", [journal_rollback(resolv_path) for _ in range(args.runs)]),
+            ("crash recovery", [crash_recovery(resolv_path) for _ in range(args.runs)]),
+        ]
+
+        start = time.monotonic()
+        for _ in range(args.runs):
+            journal.record(journal.DNS, journal.restore_file_step(resolv_path, ORIGINAL_RESOLV, VPN_RESOLV))
+        append = (time.monotonic() - start) / args.runs
+        journal.rollback()
+
+        print("Median of {0} runs".format(args.runs))
+        for label, durations in results:
+            print("{0:<22} {1:6.2f} ms".format(label, statistics.median(durations) * 1000))
+        print("{0:<22} {1:6.2f} ms (mean, with fsync)".format("journal append", append * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Loopback throughput of the OpenVPN performance profiles.
+
+Starts a local OpenVPN server in a network namespace, linked to this one
+by a veth pair, and connects to it with the client config the CLI renders
+for each profile. A TCP stream is then sent through the tunnel and the
+round trip time is measured with ping. The server offers the ciphers of
+the profile in its order, like a server that follows the client's
+preference.
+
+Needs root, openvpn, openssl and ip:
+
+    sudo python3 benchmarks/profile_throughput.py --seconds 10 --runs 3
+"""
+# Standard Libraries
+import os
+import re
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protonvpn_cli import utils  # noqa: E402
+from protonvpn_cli.constants import PERFORMANCE_PROFILES, OPENVPN_PORTS  # noqa: E402
+
+NETNS = "pvpn-bench"
+VETH_HOST, VETH_NS = "pvb0", "pvb1"
+HOST_IP, NS_IP = "10.231.0.1", "10.231.0.2"
+TUNNEL_NET, TUNNEL_SERVER_IP = "10.232.0.0", "10.232.0.1"
+CLIENT_DEVICE, SERVER_DEVICE = "pvbtun0", "pvbtun1"
+SINK_PORT = 5201
+CHUNK = b"\0" * 65536
+
+
+def run(*args, **kwargs):
+    return subprocess.run(args, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+
+
+def make_certificates(directory):
+    """Create a CA and a server and client certificate in directory"""
+    def path(name):
+        return os.path.join(directory, name)
+
+    ec = ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes"]
+    run("openssl", "req", "-x509", *ec, "-keyout", path("ca.key"), "-out", path("ca.crt"),
+        "-subj", "/CN=pvpn-bench-ca", "-days", "1")
+    for name, usage in [("server", "serverAuth"), ("client", "clientAuth")]:
+        with open(path(name + ".ext"), "w") as f:
+            f.write("keyUsage = digitalSignature\nextendedKeyUsage = {0}\n".format(usage))
+        run("openssl", "req", *ec, "-keyout", path(name + ".key"), "-out", path(name + ".csr"),
+            "-subj", "/CN=pvpn-bench-" + name)
+        run("openssl", "x509", "-req", "-in", path(name + ".csr"), "-CA", path("ca.crt"),
+            "-CAkey", path("ca.key"), "-CAcreateserial", "-out", path(name + ".crt"),
+            "-days", "1", "-extfile", path(name + ".ext"))
+
+
+def setup_network():
+    run("ip", "netns", "add", NETNS)
+    run("ip", "link", "add", VETH_HOST, "type", "veth", "peer", "name", VETH_NS)
+    run("ip", "link", "set", VETH_NS, "netns", NETNS)
+    run("ip", "addr", "add", HOST_IP + "/30", "dev", VETH_HOST)
+    run("ip", "link", "set", VETH_HOST, "up")
+    run("ip", "netns", "exec", NETNS, "ip", "addr", "add", NS_IP + "/30", "dev", VETH_NS)
+    run("ip", "netns", "exec", NETNS, "ip", "link", "set", VETH_NS, "up")
+    run("ip", "netns", "exec", NETNS, "ip", "link", "set", "lo", "up")
+
+
+def teardown_network():
+    # Deleting the namespace removes the veth pair as well
+    subprocess.run(["ip", "netns", "del", NETNS], stderr=subprocess.DEVNULL)
+    subprocess.run(["ip", "link", "del", VETH_HOST], stderr=subprocess.DEVNULL)
+
+
+def strip_block(config, tag):
+    return re.sub(r"<{0}>.*?</{0}>\n?".format(tag), "", config, flags=re.S)
+
+
+def client_config(profile, protocol, directory):
+    """Render the CLI's config for profile with the local CA and certificates"""
+    values = utils.get_openvpn_config_values([NS_IP], protocol, [OPENVPN_PORTS[protocol]], split=False)
+    values.update(utils.get_profile_directives(protocol, profile_name=profile))
+    config = utils.get_j2_environment().get_template("openvpn_template.j2").render(values)
+
+    # Swap the ProtonVPN CA, tls-auth key and credentials for the local ones
+    config = strip_block(strip_block(config, "ca"), "tls-auth")
+    config = re.sub(r"^(key-direction 1|auth-user-pass)\n", "", config, flags=re.M)
+    config += "\nca {0}\ncert {1}\nkey {2}\n".format(
+        *(os.path.join(directory, name) for name in ["ca.crt", "client.crt", "client.key"])
+    )
+    return config, values
+
+
+def server_config(protocol, values, directory):
+    """Return a server config that matches the data channel of the client values"""
+    lines = [
+        "dev tun",
+        "proto {0}".format(protocol),
+        "port {0}".format(OPENVPN_PORTS[protocol]),
+        "local {0}".format(NS_IP),
+        "server {0} 255.255.255.0".format(TUNNEL_NET),
+        "topology subnet",
+        "dh none",
+        "cipher AES-256-CBC",
+        "auth SHA512",
+        "comp-lzo no",
+        "tun-mtu {0}".format(values["tun_mtu"]),
+        "tun-mtu-extra 32",
+        "mssfix {0}".format(values["mssfix"]),
+        "reneg-sec 0",
+        "verb 3",
+    ]
+    if values["data_ciphers"]:
+        lines.append("data-ciphers {0}".format(values["data_ciphers"]))
+    if values["ncp_ciphers"]:
+        lines.append("ncp-ciphers {0}".format(values["ncp_ciphers"]))
+    for option, filename in [("ca", "ca.crt"), ("cert", "server.crt"), ("key", "server.key")]:
+        lines.append("{0} {1}".format(option, os.path.join(directory, filename)))
+    return "\n".join(lines) + "\n"
+
+
+def start_openvpn(config_path, log_path, device, netns=None):
+    command = ["openvpn", "--config", config_path, "--dev", device, "--dev-type", "tun"]
+    if netns:
+        command = ["ip", "netns", "exec", netns] + command
+    log = open(log_path, "w")
+    return subprocess.Popen(command, stdout=log, stderr=log)
+
+
+def wait_for_log(log_path, text, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with open(log_path, "r") as f:
+            content = f.read()
+        if text in content:
+            return content
+        time.sleep(0.1)
+    raise RuntimeError("OpenVPN didn't log '{0}', see {1}".format(text, log_path))
+
+
+def sink(address, port):
+    """Count the bytes of each connection and reply with 'bytes seconds'"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((address, port))
+    server.listen(1)
+    print("ready", flush=True)
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            received = 0
+            start = None
+            while True:
+                data = conn.recv(1 << 20)
+                if not data:
+                    break
+                if start is None:
+                    start = time.monotonic()
+                received += len(data)
+            duration = time.monotonic() - start if start is not None else 0.0
+            conn.sendall("{0} {1}\n".format(received, duration).encode())
+
+
+def send(seconds):
+    """Send through the tunnel for seconds, return the throughput in Mbit/s"""
+    with socket.create_connection((TUNNEL_SERVER_IP, SINK_PORT), timeout=30) as conn:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            conn.sendall(CHUNK)
+        conn.shutdown(socket.SHUT_WR)
+        received, duration = conn.makefile().readline().split()
+    return int(received) * 8 / float(duration) / 1e6
+
+
+def ping_rtt(count=20):
+    """Return the average round trip time through the tunnel in ms"""
+    output = run("ping", "-q", "-c", str(count), "-i", "0.2", TUNNEL_SERVER_IP).stdout.decode()
+    return float(re.search(r"= [\d.]+/([\d.]+)/", output).group(1))
+
+
+def bench_profile(profile, protocol, directory, seconds):
+    config, values = client_config(profile, protocol, directory)
+    paths = {name: os.path.join(directory, name) for name in ["client.ovpn", "server.ovpn", "client.log", "server.log"]}
+    with open(paths["client.ovpn"], "w") as f:
+        f.write(config)
+    with open(paths["server.ovpn"], "w") as f:
+        f.write(server_config(protocol, values, directory))
+
+    server = start_openvpn(paths["server.ovpn"], paths["server.log"], SERVER_DEVICE, NETNS)
+    receiver = client = None
+    try:
+        wait_for_log(paths["server.log"], "Initialization Sequence Completed")
+        # The sink binds to the server's tunnel address inside the namespace
+        receiver = subprocess.Popen(
+            ["ip", "netns", "exec", NETNS, sys.executable, os.path.abspath(__file__), "--sink"],
+            stdout=subprocess.PIPE
+        )
+        receiver.stdout.readline()
+        client = start_openvpn(paths["client.ovpn"], paths["client.log"], CLIENT_DEVICE)
+        log = wait_for_log(paths["client.log"], "Initialization Sequence Completed")
+        cipher = re.search(r"(?:negotiated cipher|Outgoing Data Channel: Cipher) '([^']+)'", log)
+        return {
+            "cipher": cipher.group(1) if cipher else "AES-256-CBC",
+            "mbits": send(seconds),
+            "rtt": ping_rtt(),
+        }
+    finally:
+        for process in [client, receiver, server]:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profiles", default=",".join(PERFORMANCE_PROFILES))
+    parser.add_argument("--proto", default="udp", choices=sorted(OPENVPN_PORTS))
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--sink", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.sink:
+        sink(TUNNEL_SERVER_IP, SINK_PORT)
+        return
+    if os.geteuid() != 0:
+        sys.exit("Needs root to create the network namespace and tun devices")
+    for program in ["openvpn", "openssl", "ip", "ping"]:
+        if shutil.which(program) is None:
+            sys.exit("{0} not found".format(program))
+
+    capabilities = utils.get_openvpn_capabilities()
+    print("OpenVPN {0[0]}.{0[1]}, CHACHA20-POLY1305: {1}, {2}".format(
+        capabilities["version"], capabilities["chacha20"], args.proto.upper()
+    ))
+
+    directory = tempfile.mkdtemp(prefix="pvpn-bench-")
+    teardown_network()
+    try:
+        make_certificates(directory)
+        setup_network()
+        print("{0:<12} {1:<18} {2:>10} {3:>9}".format("profile", "cipher", "Mbit/s", "RTT ms"))
+        for profile in args.profiles.split(","):
+            results = []
+            for _ in range(args.runs):
+                results.append(bench_profile(profile, args.proto, directory, args.seconds))
+            print("{0:<12} {1:<18} {2:>10.1f} {3:>9.3f}".format(
+                profile, results[0]["cipher"],
+                statistics.median(r["mbits"] for r in results),
+                statistics.median(r["rtt"] for r in results),
+            ))
+    finally:
+        teardown_network()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
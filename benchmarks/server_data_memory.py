@@ -0,0 +1,102 @@
+"""
+Peak memory of refreshing the server data from a /vpn/logicals payload.
+
+Compares the former refresh (response.json(), json.dump() of the whole
+payload and loading it back) with the streaming refresh that writes the
+compact cache, using tracemalloc on a synthetic payload.
+
+    python3 benchmarks/server_data_memory.py --servers 20000
+"""
+# Standard Libraries
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protonvpn_cli import utils  # noqa: E402
+
+
+def make_server(idx):
+    """Return a logical server with the fields of the API, including unused ones"""
+    return {
+        "ID": "id{0}==".format(idx) * 3, "Name": "CH#{0}".format(idx), "EntryCountry": "CH",
+        "ExitCountry": "CH", "Domain": "ch-{0}.protonvpn.com".format(idx), "Tier": idx % 3,
+        "Features": idx % 8, "Region": None, "City": "Zürich", "Score": random.random(),
+        "HostCountry": None, "Load": random.randint(0, 100), "Status": 1,
+        "Location": {"Lat": 47.3, "Long": 8.5},
+        "Servers": [
+            {
+                "EntryIP": "10.{0}.{1}.{2}".format(idx // 65536, (idx // 256) % 256, idx % 256),
+                "ExitIP": "10.0.0.1", "Domain": "node-{0}.protonvpn.net".format(idx),
+                "ID": "sid{0}".format(idx) * 4, "Label": "", "X25519PublicKey": "x" * 44,
+                "Generation": 0, "Status": 1, "ServicesDown": 0, "ServicesDownReason": None,
+            }
+            for _ in range(2)
+        ],
+    }
+
+
+def measure(func):
+    """Return (peak MB, seconds) of func()"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--servers", type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    payload = json.dumps(
+        {"Code": 1000, "LogicalServers": [make_server(idx) for idx in range(args.servers)]}, ensure_ascii=False
+    ).encode()
+
+    def chunks():
+        for pos in range(0, len(payload), 65536):
+            yield payload[pos:pos + 65536]
+
+    directory = tempfile.mkdtemp(prefix="pvpn-bench-")
+    old_path = os.path.join(directory, "old.json")
+    new_path = os.path.join(directory, "new.json")
+
+    def old_refresh():
+        data = json.loads(payload.decode())
+        with open(old_path, "w") as f:
+            json.dump(data, f)
+        del data
+        with open(old_path, "r") as f:
+            json.load(f)
+
+    def load_cache():
+        with open(new_path, "r") as f:
+            json.load(f)
+
+    try:
+        print("Payload: {0:.1f} MB, {1} servers".format(len(payload) / 1e6, args.servers))
+        results = [
+            ("json + dump + load", measure(old_refresh)),
+            ("streaming refresh", measure(lambda: utils.write_server_data(chunks(), new_path))),
+            ("load compact cache", measure(load_cache)),
+        ]
+        for label, (peak, duration) in results:
+            print("{0:<20} peak {1:7.1f} MB  {2:6.2f}s".format(label, peak, duration))
+        print("Compact cache: {0:.1f} MB".format(os.path.getsize(new_path) / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
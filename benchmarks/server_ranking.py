@@ -0,0 +1,77 @@
+"""
+Ranking time of the multi-criteria server scoring on a large server list.
+
+Ranks synthetic servers by load, score, RTT, distance and success rate
+with the NumPy and the array.array columns and compares them with the
+former sort by score.
+
+    python3 benchmarks/server_ranking.py --servers 50000
+"""
+# Standard Libraries
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protonvpn_cli import ranking  # noqa: E402
+from protonvpn_cli.servers import LogicalServer  # noqa: E402
+
+ORIGIN = (47.4, 8.5)
+
+
+def make_servers(count):
+    return [
+        LogicalServer({
+            "Name": "S{0}".format(idx), "ExitCountry": "CH", "Tier": 2, "Features": 0, "Status": 1,
+            "Load": random.randint(0, 100), "Score": random.random() * 5,
+            "Location": {"Lat": random.uniform(-60, 60), "Long": random.uniform(-180, 180)},
+        })
+        for idx in range(count)
+    ]
+
+
+def timed(func, repeat):
+    """Return the result of func and its mean duration in ms"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--servers", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(1)
+    servers = make_servers(args.servers)
+    weights = ranking.parse_weights(ranking.DEFAULT_WEIGHTS)
+    weights["distance"] = 1
+    # Measured RTTs and connect history only exist for some servers
+    rtts = {server.name: random.random() * 0.2 for server in servers[::3]}
+    success_rates = {server.name: random.random() for server in servers[::10]}
+    kwargs = dict(rtts=rtts, success_rates=success_rates, origin=ORIGIN)
+
+    print("{0} servers, weights {1}".format(args.servers, ranking.format_weights(weights)))
+    _, duration = timed(lambda: sorted(servers, key=lambda server: server.score)[:4], args.repeat)
+    print("{0:<28} {1:8.1f} ms".format("sort by score", duration))
+
+    backends = [("numpy", ranking.np), ("array", None)] if ranking.np is not None else [("array", None)]
+    for name, module in backends:
+        ranking.np = module
+        table, duration = timed(lambda: ranking.ServerTable(servers), args.repeat)
+        print("{0:<28} {1:8.1f} ms".format(name + ": build columns", duration))
+        _, duration = timed(lambda: table.costs(weights, **kwargs), args.repeat)
+        print("{0:<28} {1:8.1f} ms".format(name + ": weighted costs", duration))
+        candidates, duration = timed(
+            lambda: ranking.rank_servers(servers, weights, 0.02, **kwargs), args.repeat
+        )
+        print("{0:<28} {1:8.1f} ms  ({2} candidates)".format(name + ": rank_servers", duration, len(candidates)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Memory and attribute access of LogicalServer records vs API dicts.
+
+Loads the same compact server cache as plain dicts and as slotted
+LogicalServer records and compares the memory they keep (tracemalloc),
+the time to load them and the time of a typical filter over all servers.
+
+    python3 benchmarks/server_records.py --servers 20000
+"""
+# Standard Libraries
+import os
+import sys
+import json
+import random
+import shutil
+import timeit
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protonvpn_cli.servers import load_servers  # noqa: E402
+
+
+def make_server(idx):
+    return {
+        "ID": "id{0}==".format(idx), "Name": "CH#{0}".format(idx),
+        "ExitCountry": random.choice(["CH", "US", "DE", "NL"]), "Tier": idx % 3, "Features": idx % 8,
+        "City": random.choice(["Zurich", "Berlin", "New York"]), "Score": random.random(),
+        "Load": random.randint(0, 100), "Status": 1, "Location": {"Lat": 47.3, "Long": 8.5},
+        "Servers": [
+            {"EntryIP": "10.{0}.{1}.{2}".format(idx // 65536, (idx // 256) % 256, idx % 256),
+             "ExitIP": "10.0.0.1", "Status": 1}
+            for _ in range(2)
+        ],
+    }
+
+
+def load_dicts(path):
+    with open(path, "r") as f:
+        return json.load(f)["LogicalServers"]
+
+
+def retained(load, path):
+    """Return the objects loaded from path and the MB they keep allocated"""
+    tracemalloc.start()
+    objects = load(path)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return objects, size / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--servers", type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    directory = tempfile.mkdtemp(prefix="pvpn-bench-")
+    path = os.path.join(directory, "serverinfo.json")
+    try:
+        with open(path, "w") as f:
+            json.dump({"LogicalServers": [make_server(idx) for idx in range(args.servers)]}, f)
+
+        dicts, dicts_mb = retained(load_dicts, path)
+        records, records_mb = retained(load_servers, path)
+
+        def filter_dicts():
+            return [s["Score"] for s in dicts if s["Features"] == 4 and s["ExitCountry"] == "CH"]
+
+        def filter_records():
+            return [s.score for s in records if s.features == 4 and s.exit_country == "CH"]
+
+        assert filter_dicts() == filter_records()
+        rows = [
+            ("memory (MB)", dicts_mb, records_mb),
+            ("load (ms)", timeit.timeit(lambda: load_dicts(path), number=3) / 3 * 1000,
+             timeit.timeit(lambda: load_servers(path), number=3) / 3 * 1000),
+            ("filter (ms)", timeit.timeit(filter_dicts, number=50) / 50 * 1000,
+             timeit.timeit(filter_records, number=50) / 50 * 1000),
+        ]
+        print("{0} servers".format(args.servers))
+        print("{0:<12} {1:>10} {2:>14}".format("", "dicts", "LogicalServer"))
+        for label, old, new in rows:
+            print("{0:<12} {1:>10.2f} {2:>14.2f}".format(label, old, new))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,31 @@ import os
 import textwrap
 import configparser
 import getpass
+import pwd
 import shutil
 import time
 import argparse
+import fnmatch
+import json
 # protonvpn-cli Functions
 from . import connection
+from . import exporter
+from . import metrics
+from . import ranking
+from . import locks
+from . import journal
 from .logger import logger
 from .utils import (
     check_root, change_file_owner, pull_server_data,
     check_init, set_config_value, get_config_value,
-    is_valid_ip, wait_for_network
+    is_valid_ip, wait_for_network, get_servers,
+    export_openvpn_configs, get_ranking_weights, parse_location,
+    write_config_file, check_update
 )
 # Constants
 from .constants import (
-    CONFIG_DIR, CONFIG_FILE, PASSFILE, USER, VERSION, SPLIT_TUNNEL_FILE, USAGE
+    CONFIG_DIR, CONFIG_FILE, PASSFILE, USER, VERSION, SPLIT_TUNNEL_FILE, USAGE,
+    METRICS_FILE, METRICS_IGNORED_COMMANDS
 )
 
 
@@ -28,6 +39,10 @@ def main():
     except KeyboardInterrupt:
         print("\nQuitting...")
         sys.exit(1)
+    except locks.LockTimeout as e:
+        print("[!] {0}, another ProtonVPN-CLI command is still running.".format(e))
+        logger.debug("Lock timeout: {0}".format(e.name))
+        sys.exit(1)
 
 
 def cli():
@@ -42,7 +57,22 @@ def cli():
     logger.debug("USER: {0}".format(USER))
     logger.debug("CONFIG_DIR: {0}".format(CONFIG_DIR))
 
-    ProtonVPNCLI()
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    metrics.set_tags(command=command)
+    if command in METRICS_IGNORED_COMMANDS:
+        metrics.disable()
+    try:
+        # Revert what a crashed connect left behind before doing anything else
+        if os.geteuid() == 0 and journal.needs_recovery():
+            connection.recover()
+        with metrics.span("command"):
+            ProtonVPNCLI()
+    finally:
+        metrics.flush()
+        # Checked here as change_file_owner() runs id three times,
+        # too slow for commands that are polled like 'status --json'
+        if os.path.isfile(METRICS_FILE) and os.stat(METRICS_FILE).st_uid != pwd.getpwnam(USER).pw_uid:
+            change_file_owner(METRICS_FILE)
 
 
 class ProtonVPNCLI():
@@ -114,14 +144,20 @@ class ProtonVPNCLI():
         group.add_argument("servername", nargs="?", help="Servername (CH#4, CH-US-1, HK5-Tor).", metavar="")
         group.add_argument("-f", "--fastest", help="Connect to the fastest ProtonVPN server.", action="store_true")
         group.add_argument("-r", "--random", help="Connect to a random ProtonVPN server.", action="store_true")
-        group.add_argument("--cc", help="Connect to the specified country code (SE, PT, BR, AR).", metavar="")
-        group.add_argument("--sc", help="Connect to the fastest Secure-Core server.", action="store_true")
-        group.add_argument("--p2p", help="Connect to the fastest torrent server.", action="store_true")
-        group.add_argument("--tor", help="Connect to the fastest Tor server.", action="store_true")
+        # Filters of fastest connect, they can be combined
+        parser.add_argument(
+            "--cc", help="Connect to the fastest server in any of the country codes (SE, PT, BR, AR or DE,NL).",
+            metavar=""
+        )
+        parser.add_argument("--sc", help="Connect to the fastest Secure-Core server.", action="store_true")
+        parser.add_argument("--p2p", help="Connect to the fastest torrent server.", action="store_true")
+        parser.add_argument("--tor", help="Connect to the fastest Tor server.", action="store_true")
         parser.add_argument(
             "-p", "--protocol", help="Connect via specified protocol.",
             choices=["udp", "tcp"], metavar="", type=str.lower
         )
+        parser.add_argument("--near", help="Pick the fastest server close to your location.", action="store_true")
+        parser.add_argument("--timings", help="Print the duration of each connection phase.", action="store_true")
 
         args = parser.parse_args(sys.argv[2:])
         logger.debug("Sub-arguments:\n{0}".format(args))
@@ -130,22 +166,29 @@ class ProtonVPNCLI():
         if protocol and protocol.lower().strip() in ["tcp", "udp"]:
             protocol = protocol.lower().strip()
 
+        features = 0
+        for feature in ["sc", "p2p", "tor"]:
+            if getattr(args, feature):
+                features |= self.server_features_dict[feature]
+
+        if (args.cc or features or args.near) and (args.random or args.servername):
+            print("[!] --cc, --sc, --p2p, --tor and --near can only be used with fastest connect.")
+            sys.exit(1)
+
         if args.random:
-            connection.random_c(protocol)
-        elif args.fastest:
-            connection.fastest(protocol)
+            connection.random_c(protocol, args.timings)
         elif args.servername:
-            connection.direct(args.servername, protocol)
-        elif args.cc:
-            connection.country_f(args.cc, protocol)
-        elif args.p2p:
-            connection.feature_f(self.server_features_dict.get("p2p", None), protocol)
-        elif args.sc:
-            connection.feature_f(self.server_features_dict.get("sc", None), protocol)
-        elif args.tor:
-            connection.feature_f(self.server_features_dict.get("tor", None), protocol)
+            connection.direct(args.servername, protocol, args.timings)
+        elif args.cc or features:
+            country_codes = args.cc.split(",") if args.cc else None
+            connection.fastest_f(country_codes, features, protocol, args.timings, args.near)
+        elif args.fastest or args.near:
+            connection.fastest(protocol, args.timings, args.near)
         else:
-            connection.dialog()
+            connection.dialog(args.timings)
+
+        # After connecting, the check itself runs in the background
+        check_update()
 
     def r(self):
         """Short CLI command to reconnect to the last connected VPN Server"""
@@ -153,9 +196,20 @@ class ProtonVPNCLI():
 
     def reconnect(self):
         """Full CLI command to reconnect to the last connected VPN Server"""
+        parser = argparse.ArgumentParser(description="Reconnect to ProtonVPN", prog="protonvpn r")
+        parser.add_argument("--timings", help="Print the duration of each connection phase.", action="store_true")
+        parser.add_argument(
+            "--sticky-threshold", help="Switch to a similar server if the load is at least this percentage.",
+            type=int, choices=range(0, 101), metavar="N"
+        )
+
+        args = parser.parse_args(sys.argv[2:])
+        logger.debug("Sub-arguments:\n{0}".format(args))
+
         check_root()
         check_init()
-        connection.reconnect()
+        connection.reconnect(args.timings, args.sticky_threshold)
+        check_update()
 
     def d(self):
         """Short CLI command to disconnect the VPN if a connection is present"""
@@ -173,7 +227,30 @@ class ProtonVPNCLI():
 
     def status(self):
         """Full CLI command to display the current VPN status"""
-        connection.status()
+        parser = argparse.ArgumentParser(description="Show connection status", prog="protonvpn s")
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            "--watch", help="Refresh the status with transfer rates every INTERVAL seconds. (Default: 1)",
+            nargs="?", const=1.0, type=float, metavar="INTERVAL"
+        )
+        group.add_argument("--json", help="Print the status from local state as JSON.", action="store_true")
+        parser.add_argument("--probe", help="Check DNS and the public IP over the network (with --json).",
+                            action="store_true")
+
+        args = parser.parse_args(sys.argv[2:])
+        logger.debug("Sub-arguments:\n{0}".format(args))
+
+        if args.json:
+            check_init()
+            connection.status_json(args.probe)
+        elif args.watch is not None:
+            if args.watch <= 0:
+                print("[!] The interval must be greater than 0.")
+                sys.exit(1)
+            connection.status_watch(args.watch)
+        else:
+            connection.status()
+            check_update()
 
     def cf(self):
         """Short CLI command to change single configuration values"""
@@ -194,6 +271,56 @@ class ProtonVPNCLI():
         check_init()
         pull_server_data(force=True)
 
+    def export(self):
+        """CLI command to export OpenVPN configs of all servers"""
+        parser = argparse.ArgumentParser(description="Export OpenVPN configs", prog="protonvpn export")
+        parser.add_argument("--out", help="Directory to write the configs to.", metavar="DIR", required=True)
+        parser.add_argument(
+            "--filter", help="Comma separated servername patterns (CH#*, US-NY*).", metavar="PATTERNS"
+        )
+        parser.add_argument(
+            "--proto", help="Comma separated protocols (udp,tcp).", metavar="PROTOCOLS", default="udp,tcp"
+        )
+        parser.add_argument(
+            "--prune", help="Delete exported configs of all other servers and protocols from DIR.",
+            action="store_true"
+        )
+
+        args = parser.parse_args(sys.argv[2:])
+        logger.debug("Sub-arguments:\n{0}".format(args))
+
+        check_init()
+        export_cli(args.out, args.filter, args.proto, args.prune)
+
+    def stats(self):
+        """CLI command to display connection timing statistics"""
+        parser = argparse.ArgumentParser(description="Show timing statistics", prog="protonvpn stats")
+        parser.add_argument("--json", help="Export statistics and raw spans as JSON.", action="store_true")
+
+        args = parser.parse_args(sys.argv[2:])
+        logger.debug("Sub-arguments:\n{0}".format(args))
+
+        print_stats(args.json)
+
+    def exporter(self):
+        """CLI command to serve Prometheus metrics"""
+        parser = argparse.ArgumentParser(description="Serve Prometheus metrics", prog="protonvpn exporter")
+        parser.add_argument(
+            "--listen", help="Address to listen on. (Default: 127.0.0.1:9724)",
+            metavar="HOST:PORT", default="127.0.0.1:9724"
+        )
+
+        args = parser.parse_args(sys.argv[2:])
+        logger.debug("Sub-arguments:\n{0}".format(args))
+
+        host, _, port = args.listen.rpartition(":")
+        if not host or not port.isdigit():
+            print("[!] Invalid address '{0}'. Please use HOST:PORT.".format(args.listen))
+            sys.exit(1)
+
+        check_init()
+        exporter.serve(host, int(port))
+
     def ex(self):
         """Short CLI command to display usage examples"""
         self.examples()
@@ -221,11 +348,10 @@ def init_cli():
         }
         config["metadata"] = {
             "last_api_pull": "0",
-            "last_update_check": str(int(time.time())),
         }
 
-        with open(CONFIG_FILE, "w") as f:
-            config.write(f)
+        with locks.config_lock.hold(exclusive=True):
+            write_config_file(config)
         change_file_owner(CONFIG_FILE)
         logger.debug("pvpn-cli.cfg initialized")
 
@@ -326,6 +452,80 @@ def init_cli():
         sys.exit(1)
 
 
+def export_cli(out_dir, filters, protocols, prune=False):
+    """Export OpenVPN configs of all servers matching filters"""
+
+    protocols = [p.strip().lower() for p in protocols.split(",") if p.strip()]
+    for protocol in protocols:
+        if protocol not in ["udp", "tcp"]:
+            print("[!] Invalid protocol '{0}'. Please use udp and/or tcp.".format(protocol))
+            sys.exit(1)
+
+    pull_server_data()
+    servers = get_servers()
+
+    if filters:
+        patterns = [p.strip().upper() for p in filters.split(",") if p.strip()]
+        servers = [
+            server for server in servers
+            if any(fnmatch.fnmatchcase(server.name.upper(), pattern) for pattern in patterns)
+        ]
+
+    if not servers:
+        print("[!] No servers found with your selection.")
+        sys.exit(1)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    start = time.time()
+    written, unchanged, removed = export_openvpn_configs(servers, out_dir, protocols, prune)
+    print(
+        "Exported {0} configs to {1} ({2} written, {3} unchanged{4}) in {5:.2f}s.".format(
+            written + unchanged, out_dir, written, unchanged,
+            ", {0} removed".format(removed) if prune else "", time.time() - start
+        )
+    )
+
+
+def print_stats(as_json=False):
+    """Print p50/p95 durations per phase and per server"""
+
+    records = metrics.read_records()
+    summary = metrics.summarize(records) if records else {
+        "phases": {}, "servers": {}, "revalidations": {"count": 0, "changed": 0}
+    }
+
+    if as_json:
+        summary["records"] = records
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        return
+
+    if not records:
+        print("No statistics recorded yet.")
+        return
+
+    print("{0:<24} {1:>6} {2:>9} {3:>9}".format("Phase", "Count", "p50", "p95"))
+    for name in sorted(summary["phases"]):
+        phase = summary["phases"][name]
+        print("{0:<24} {1:>6} {2:>8.3f}s {3:>8.3f}s".format(name, phase["count"], phase["p50"], phase["p95"]))
+
+    if summary["revalidations"]["count"]:
+        print()
+        print("Revalidations changed the server {0} of {1} times.".format(
+            summary["revalidations"]["changed"], summary["revalidations"]["count"]
+        ))
+
+    if summary["servers"]:
+        print()
+        print("{0:<24} {1:>6} {2:>9} {3:>9} {4:>8}".format("Server", "Count", "p50", "p95", "Success"))
+        for name in sorted(summary["servers"]):
+            server = summary["servers"][name]
+            print("{0:<24} {1:>6} {2:>8.3f}s {3:>8.3f}s {4:>7.0f}%".format(
+                name, server["count"], server["p50"], server["p95"], server["success_rate"] * 100
+            ))
+
+
 def print_examples():
     """Print some examples on how to use this program"""
 
@@ -352,7 +552,9 @@ def print_examples():
         "protonvpn disconnect\n"
         "               Disconnect the current session.\n\n"
         "protonvpn s\n"
-        "               Print information about the current session."
+        "               Print information about the current session.\n\n"
+        "protonvpn export --out configs --filter CH*,SE* --proto udp\n"
+        "               Export UDP configs of all Swiss and Swedish servers."
     )
 
     print(examples)
@@ -371,7 +573,11 @@ def configure_cli():
             "4) DNS Management\n"
             "5) Kill Switch\n"
             "6) Split Tunneling\n"
-            "7) Purge Configuration\n"
+            "7) Performance Profile\n"
+            "8) Path MTU Discovery\n"
+            "9) Server Ranking\n"
+            "10) Server Data Cache\n"
+            "11) Purge Configuration\n"
         )
 
         user_choice = input(
@@ -397,8 +603,20 @@ def configure_cli():
         elif user_choice == "6":
             set_split_tunnel()
             break
-        # Make sure this is always the last option
         elif user_choice == "7":
+            set_performance_profile()
+            break
+        elif user_choice == "8":
+            set_mtu_discovery()
+            break
+        elif user_choice == "9":
+            set_server_ranking()
+            break
+        elif user_choice == "10":
+            set_server_cache()
+            break
+        # Make sure this is always the last option
+        elif user_choice == "11":
             purge_configuration()
             break
         elif user_choice == "":
@@ -599,8 +817,18 @@ def set_dns_protection():
             )
             time.sleep(0.5)
 
+    dns_cache = 0
+    if dns_leak_protection or custom_dns:
+        print()
+        print(
+            "A local DNS cache answers repeated lookups without a round\n"
+            "trip through the VPN. It only forwards through the tunnel.\n"
+        )
+        dns_cache = 1 if input("Cache DNS responses locally? [y/N]: ").strip().lower() == "y" else 0
+
     set_config_value("USER", "dns_leak_protection", dns_leak_protection)
     set_config_value("USER", "custom_dns", custom_dns)
+    set_config_value("USER", "dns_cache", dns_cache)
     print("DNS Management updated.")
 
 
@@ -710,3 +938,177 @@ def set_split_tunnel():
 
     print()
     print("Split tunneling configuration updated.")
+
+
+def set_performance_profile():
+    """Set the OpenVPN performance profile"""
+
+    profiles = {
+        1: ("default", "Default (most compatible)"),
+        2: ("throughput", "Throughput (large buffers, AEAD ciphers)"),
+        3: ("latency", "Latency (small queues, AEAD ciphers)"),
+        4: ("constrained", "Constrained link (small buffers, CHACHA20 first)"),
+    }
+
+    print()
+    print(
+        "Performance profiles tune ciphers, socket buffers and queue lengths\n"
+        "of the OpenVPN connection. Options unsupported by your OpenVPN\n"
+        "version are left out automatically.\n"
+    )
+
+    for profile in profiles:
+        print("{0}) {1}".format(profile, profiles[profile][1]))
+
+    while True:
+        print()
+        user_choice = input("Your choice: ")
+
+        try:
+            if user_choice == "":
+                user_choice = 1
+            profile_name = profiles[int(user_choice)][0]
+            break
+        except (KeyError, ValueError):
+            print()
+            print("[!] Invalid choice. Please enter the number of your choice.")
+
+    set_config_value("USER", "performance_profile", profile_name)
+    print("Performance profile has been updated.")
+
+
+def set_mtu_discovery():
+    """Enable or disable path MTU discovery"""
+
+    print()
+    print(
+        "Path MTU discovery probes the path to the server before connecting\n"
+        "and lowers tun-mtu and mssfix to avoid fragmentation on links with\n"
+        "a smaller MTU (e.g. PPPoE or mobile connections)."
+    )
+    print()
+    user_choice = input("Enable path MTU discovery? [y/N]: ")
+
+    if user_choice.strip().lower() == "y":
+        set_config_value("USER", "mtu_discovery", 1)
+    else:
+        set_config_value("USER", "mtu_discovery", 0)
+
+    print()
+    print("Path MTU discovery configuration updated.")
+
+
+def set_server_ranking():
+    """Set the weights used to rank servers for fastest connect"""
+
+    descriptions = {
+        "load": "Current server load",
+        "score": "Server score reported by ProtonVPN",
+        "rtt": "Measured round-trip time",
+        "distance": "Distance to the server",
+        "success": "Past connection failures",
+    }
+
+    print()
+    print(
+        "Fastest connect ranks servers by a weighted sum of the criteria\n"
+        "below. A weight of 0 ignores a criterion, criteria without data\n"
+        "are skipped. Leave empty to keep the current weight.\n"
+    )
+
+    weights = get_ranking_weights()
+    for criterion in ranking.CRITERIA:
+        while True:
+            user_choice = input("{0} [{1:g}]: ".format(descriptions[criterion], weights[criterion])).strip()
+            if user_choice == "":
+                break
+            try:
+                weight = float(user_choice)
+                if not weight >= 0:
+                    raise ValueError
+                weights[criterion] = weight
+                break
+            except ValueError:
+                print("[!] Please enter a number of at least 0.")
+
+    print()
+    print(
+        "Distances are measured from the location of your public IP.\n"
+        "You can enter your location as latitude,longitude instead\n"
+        "(e.g. 47.37,8.54). Enter 'auto' to use the public IP again.\n"
+    )
+    location = get_config_value("USER", "location")
+    while True:
+        user_choice = input("Location [{0}]: ".format("auto" if location == "None" else location)).strip()
+        if user_choice == "":
+            break
+        if user_choice.lower() == "auto":
+            location = "None"
+            break
+        try:
+            location = "{0},{1}".format(*parse_location(user_choice))
+            break
+        except ValueError:
+            print("[!] Please enter latitude and longitude separated by a comma.")
+
+    print()
+    print(
+        "ProtonVPN-CLI records server loads on every refresh. With load\n"
+        "forecasts, servers are ranked by the load they usually reach in\n"
+        "the next hour instead of the current load.\n"
+    )
+    load_forecast = input("Use load forecasts? [y/N]: ").strip().lower() == "y"
+
+    set_config_value("USER", "ranking_weights", ranking.format_weights(weights))
+    set_config_value("USER", "location", location)
+    set_config_value("USER", "load_forecast", 1 if load_forecast else 0)
+    print()
+    print("Server ranking has been updated.")
+
+
+def set_server_cache():
+    """Set where the server data is cached"""
+
+    print()
+    print(
+        "By default the server list is cached in your home directory. On\n"
+        "machines with several users, a shared directory (e.g.\n"
+        "/var/cache/protonvpn-cli) lets all of them use the same server\n"
+        "list, so it is only downloaded once.\n"
+    )
+    cache_dir = get_config_value("USER", "server_cache_dir")
+    user_choice = input(
+        "Shared cache directory, 'none' for your home directory [{0}]: ".format(
+            "none" if cache_dir == "None" else cache_dir
+        )
+    ).strip()
+
+    if user_choice.lower() == "none":
+        cache_dir = "None"
+    elif user_choice:
+        if not os.path.isabs(user_choice):
+            print("[!] Please enter an absolute path.")
+            sys.exit(1)
+        cache_dir = user_choice
+
+    print()
+    print(
+        "Fastest connect uses cached server data up to this age right\n"
+        "away and refreshes it in the background. The server is only\n"
+        "changed if the refreshed data lists it as offline or busy.\n"
+        "Enter 0 to always refresh before choosing a server.\n"
+    )
+    max_age = get_config_value("USER", "server_data_max_age")
+    while True:
+        user_choice = input("Maximum age in seconds [{0}]: ".format(max_age)).strip()
+        if user_choice == "":
+            break
+        if user_choice.isdigit():
+            max_age = str(int(user_choice))
+            break
+        print("[!] Please enter a number of seconds.")
+
+    set_config_value("USER", "server_cache_dir", cache_dir)
+    set_config_value("USER", "server_data_max_age", max_age)
+    print()
+    print("Server data cache has been updated.")
@@ -9,25 +9,43 @@ import re
 import configparser
 import datetime
 import zlib
+import collections
+import json
+import concurrent.futures
 # External Libraries
 from dialog import Dialog
 # protonvpn-cli Functions
 from .logger import logger
+from . import metrics
+from . import quarantine
+from . import locks
+from . import journal
+from . import dnscache
 from .utils import (
     check_init, pull_server_data, is_connected,
-    get_servers, get_server_value, get_config_value,
+    get_servers, get_server, get_config_value,
     set_config_value, get_ip_info, get_country_name,
-    get_fastest_server, check_update, get_default_nic,
-    get_transferred_data, create_openvpn_config,
-    is_ipv6_disabled
+    get_fastest_server, get_default_nic,
+    get_transferred_data, create_openvpn_config, open_openvpn_config,
+    is_ipv6_disabled, get_path_mtu, timed_call, convert_size,
+    get_openvpn_pid, change_file_owner, order_by_rtt, update_server_loads,
+    get_server_info_file, is_server_data_fresh, refresh_server_data_async,
+    set_config_values
+)
+from .traffic import InterfaceCounters, get_vpn_interface
+from .servers import (
+    ServerIndex, FEATURE_NORMAL, FEATURE_SECURE_CORE, FEATURE_TOR, FEATURE_P2P, STATUS_ONLINE
 )
 # Constants
 from .constants import (
-    CONFIG_DIR, OVPN_FILE, PASSFILE, CONFIG_FILE
+    CONFIG_DIR, PASSFILE, CONFIG_FILE, OPENVPN_PORTS,
+    OPENVPN_PID_FILE, IP_INFO_TTL, QUARANTINE_FILE, REVALIDATE_TIMEOUT,
+    REVALIDATE_MAX_LOAD, STATE_LOCK_TIMEOUT, STATUS_LOCK_TIMEOUT, DNS_CACHE_ADDRESS, DNS_CACHE_PID_FILE,
+    VPN_DEVICE
 )
 
 
-def dialog():
+def dialog(show_timings=False):
     """Connect to a server with a dialog menu."""
     def show_dialog(headline, choices, stop=False):
         """Show the dialog and process response."""
@@ -64,10 +82,10 @@ def dialog():
 
     countries = {}
     for server in servers:
-        country = get_country_name(server["ExitCountry"])
+        country = get_country_name(server.exit_country)
         if country not in countries.keys():
             countries[country] = []
-        countries[country].append(server["Name"])
+        countries[country].append(server)
 
     # Fist dialog
     choices = []
@@ -75,7 +93,7 @@ def dialog():
     for country in sorted(countries.keys()):
         country_features = []
         for server in countries[country]:
-            feat = int(get_server_value(server, "Features", servers))
+            feat = server.features
             if not features[feat] in country_features:
                 country_features.append(features[feat])
         choices.append((country, " | ".join(sorted(country_features))))
@@ -87,24 +105,17 @@ def dialog():
     # lambda sorts servers by Load instead of name
     choices = []
     country_servers = sorted(countries[country],
-                             key=lambda s: get_server_value(
-                                 s, "Load", servers))
+                             key=lambda s: s.load)
 
-    for servername in country_servers:
+    for server in country_servers:
 
-        load = str(
-            get_server_value(servername, "Load", servers)
-        ).rjust(3, " ")
+        load = str(server.load).rjust(3, " ")
 
-        feature = features[
-            get_server_value(servername, 'Features', servers)
-        ]
+        feature = features[server.features]
 
-        tier = server_tiers[
-            get_server_value(servername, "Tier", servers)
-        ]
+        tier = server_tiers[server.tier]
 
-        choices.append((servername, "Load: {0}% | {1} | {2}".format(
+        choices.append((server.name, "Load: {0}% | {1} | {2}".format(
             load, tier, feature
         )))
 
@@ -121,10 +132,10 @@ def dialog():
     logger.debug("Protocol Choice: {0}".format(protocol_result))
 
     os.system("clear")
-    openvpn_connect(server_result, protocol_result)
+    openvpn_connect(server_result, protocol_result, show_timings)
 
 
-def random_c(protocol=None):
+def random_c(protocol=None, show_timings=False):
     """Connect to a random ProtonVPN Server."""
 
     logger.debug("Starting random connect")
@@ -132,100 +143,116 @@ def random_c(protocol=None):
     if not protocol:
         protocol = get_config_value("USER", "default_protocol")
 
-    servers = get_servers()
+    servers = quarantine.filter_servers(get_servers())
 
-    servername = random.choice(servers)["Name"]
+    servername = random.choice(servers).name
 
-    openvpn_connect(servername, protocol)
+    openvpn_connect(servername, protocol, show_timings)
 
 
-def fastest(protocol=None):
+def fastest(protocol=None, show_timings=False, near=False):
     """Connect to the fastest server available."""
+    fastest_f(protocol=protocol, show_timings=show_timings, near=near)
 
-    logger.debug("Starting fastest connect")
-
-    if not protocol:
-        protocol = get_config_value("USER", "default_protocol")
-
-    disconnect(passed=True)
-    pull_server_data(force=True)
-
-    servers = get_servers()
-
-    # ProtonVPN Features: 1: SECURE-CORE, 2: TOR, 4: P2P
-    excluded_features = [1, 2]
-
-    # Filter out excluded features
-    server_pool = []
-    for server in servers:
-        if server["Features"] not in excluded_features:
-            server_pool.append(server)
-
-    fastest_server = get_fastest_server(server_pool)
-    openvpn_connect(fastest_server, protocol)
 
+def fastest_f(country_codes=None, features=FEATURE_NORMAL, protocol=None, show_timings=False, near=False):
+    """
+    Connect to the fastest server in any of the countries with all features.
 
-def country_f(country_code, protocol=None):
-    """Connect to the fastest server in a specific country."""
-    logger.debug("Starting fastest country connect")
+    country_codes = list of exit country codes or None for all countries
+    features = bitmask of ProtonVPN features the server must have
+    """
+    logger.debug(
+        "Starting fastest connect with countries {0} and features {1}".format(country_codes, features)
+    )
 
     if not protocol:
         protocol = get_config_value("USER", "default_protocol")
 
-    country_code = country_code.strip().upper()
+    if country_codes is not None:
+        country_codes = [code.strip().upper() for code in country_codes if code.strip()]
 
     disconnect(passed=True)
-    pull_server_data(force=True)
-
-    servers = get_servers()
 
-    # ProtonVPN Features: 1: SECURE-CORE, 2: TOR, 4: P2P
-    excluded_features = [1, 2]
+    # Fresh enough cached data is used right away and revalidated
+    # by a concurrent refresh before OpenVPN is started
+    refresh = None
+    max_age = int(get_config_value("USER", "server_data_max_age"))
+    if max_age > 0 and is_server_data_fresh(get_server_info_file(), max_age):
+        logger.debug("Using cached server data, refreshing in the background")
+        refresh = refresh_server_data_async()
+    else:
+        pull_server_data(force=True)
 
-    # Filter out excluded features and countries
-    server_pool = []
-    for server in servers:
-        if server["Features"] not in excluded_features and server["ExitCountry"] == country_code:
-            server_pool.append(server)
+    servers = get_servers()
 
-    if len(server_pool) == 0:
-        print(
-            "[!] No Server in country {0} found\n".format(country_code)
-            + "[!] Please choose a valid country"
+    if country_codes is not None:
+        known_countries = {server.exit_country for server in servers}
+        for country_code in country_codes:
+            if country_code not in known_countries:
+                print("[!] No Server in country {0} found".format(country_code))
+                logger.debug("No server in country {0}".format(country_code))
+
+    def choose(servers):
+        # Secure-Core and Tor servers are only used when asked for
+        server_pool = ServerIndex(servers).select(
+            country_codes, features, excluded_features=FEATURE_SECURE_CORE | FEATURE_TOR
         )
-        logger.debug("No server in country {0}".format(country_code))
-        sys.exit(1)
-
-    fastest_server = get_fastest_server(server_pool)
-    openvpn_connect(fastest_server, protocol)
 
+        if len(server_pool) == 0:
+            logger.debug("No servers found with users selection. Exiting.")
+            print("[!] No servers found with your selection.")
+            sys.exit(1)
 
-def feature_f(feature, protocol=None):
-    """Connect to the fastest server in a specific country."""
-    logger.debug(
-        "Starting fastest feature connect with feature {0}".format(feature)
-    )
+        return get_fastest_server(server_pool, near)
 
-    if not protocol:
-        protocol = get_config_value("USER", "default_protocol")
+    def revalidate(servername):
+        return revalidate_server(refresh, servername, choose)
 
-    disconnect(passed=True)
-    pull_server_data(force=True)
-
-    servers = get_servers()
+    openvpn_connect(
+        choose(servers), protocol, show_timings,
+        revalidate=revalidate if refresh is not None else None
+    )
 
-    server_pool = [s for s in servers if s["Features"] == feature]
 
-    if len(server_pool) == 0:
-        logger.debug("No servers found with users selection. Exiting.")
-        print("[!] No servers found with your selection.")
-        sys.exit(1)
+def revalidate_server(refresh, servername, choose):
+    """
+    Revisit the choice of servername once the background refresh is done.
 
-    fastest_server = get_fastest_server(server_pool)
-    openvpn_connect(fastest_server, protocol)
+    choose(servers) picks a new server, it is only called if the
+    refreshed data lists servername as offline or heavily loaded.
+    Returns the server to connect to.
+    """
+    start = time.monotonic()
+    try:
+        updated = refresh.result(timeout=REVALIDATE_TIMEOUT)
+    except (concurrent.futures.TimeoutError, locks.LockTimeout):
+        logger.debug("Server data refresh didn't finish in time, keeping {0}".format(servername))
+        updated = False
+    except Exception as e:
+        # The cached data is still good enough to connect with
+        logger.debug("Server data refresh failed, keeping {0}: {1!r}".format(servername, e))
+        updated = False
+
+    new_servername = servername
+    if updated:
+        servers = get_servers(online_only=False)
+        try:
+            server = get_server(servername, servers)
+        except KeyError:
+            server = None
+        if server is None or server.status != STATUS_ONLINE or server.load >= REVALIDATE_MAX_LOAD:
+            logger.debug("{0} is no longer a good choice, choosing again".format(servername))
+            new_servername = choose([s for s in servers if s.status == STATUS_ONLINE])
+
+    metrics.record_span(
+        "revalidate", time.monotonic() - start,
+        updated=bool(updated), changed=new_servername != servername
+    )
+    return new_servername
 
 
-def direct(user_input, protocol=None):
+def direct(user_input, protocol=None, show_timings=False):
     """Connect to a single given server directly"""
 
     logger.debug("Starting direct connect with {0}".format(user_input))
@@ -270,7 +297,7 @@ def direct(user_input, protocol=None):
 
     servers = get_servers()
 
-    if servername not in [server["Name"] for server in servers]:
+    if servername not in [server.name for server in servers]:
         print(
             "[!] {0} doesn't exist, ".format(servername)
             + "is under maintenance, or inaccessible with your plan.\n"
@@ -279,11 +306,17 @@ def direct(user_input, protocol=None):
         logger.debug("{0} doesn't exist".format(servername))
         sys.exit(1)
 
-    openvpn_connect(servername, protocol)
+    openvpn_connect(servername, protocol, show_timings)
+
 
+def reconnect(show_timings=False, sticky_threshold=None):
+    """
+    Reconnect to the last VPN Server.
 
-def reconnect():
-    """Reconnect to the last VPN Server."""
+    With sticky_threshold, stay on the last server only while its load is
+    below the threshold and otherwise switch to the best server in the
+    same country and city with the same features.
+    """
 
     logger.debug("Starting reconnect")
 
@@ -298,9 +331,51 @@ def reconnect():
         )
         sys.exit(1)
 
-    openvpn_connect(servername, protocol)
+    if sticky_threshold is not None:
+        servername = get_sticky_server(servername, sticky_threshold)
 
+    openvpn_connect(servername, protocol, show_timings)
 
+
+def get_sticky_server(servername, threshold):
+    """Return servername if its load is below threshold, otherwise a similar server"""
+
+    servers = get_servers(online_only=False)
+    try:
+        current = get_server(servername, servers)
+    except KeyError:
+        print("[!] {0} is not available anymore.".format(servername))
+        logger.debug("Previous server {0} not found".format(servername))
+        sys.exit(1)
+
+    if not update_server_loads(servers):
+        logger.debug("Staying on {0} without current loads".format(servername))
+        return servername
+
+    if current.status == STATUS_ONLINE and current.load < threshold:
+        logger.debug("Staying on {0} with load {1}".format(servername, current.load))
+        return servername
+
+    # Same exit country and the exact same Secure-Core/Tor/P2P flags
+    all_features = FEATURE_SECURE_CORE | FEATURE_TOR | FEATURE_P2P
+    index = ServerIndex([s for s in servers if s.status == STATUS_ONLINE and s.name != servername])
+    server_pool = index.select([current.exit_country], current.features & all_features, all_features)
+
+    # Prefer the same city, switching only pays off below the threshold
+    server_pool = [s for s in server_pool if s.load < threshold]
+    server_pool = [s for s in server_pool if s.city == current.city] or server_pool
+
+    if not server_pool:
+        logger.debug("No alternative to {0} below {1}% load".format(servername, threshold))
+        return servername
+
+    new_server = get_fastest_server(server_pool)
+    print("{0} is at {1}% load, switching to {2}.".format(servername, current.load, new_server))
+    logger.debug("Switching from {0} to {1}".format(servername, new_server))
+    return new_server
+
+
+@locks.state_lock.hold(exclusive=True, timeout=STATE_LOCK_TIMEOUT)
 def disconnect(passed=False):
     """Disconnect VPN if a connection is present."""
 
@@ -332,21 +407,37 @@ def disconnect(passed=False):
             print("[!] Could not terminate OpenVPN process.")
             sys.exit(1)
         else:
-            manage_dns("restore")
-            manage_ipv6("restore")
-            manage_killswitch("restore")
+            if os.path.isfile(OPENVPN_PID_FILE):
+                os.remove(OPENVPN_PID_FILE)
+            restore_network_state()
             logger.debug("Disconnected")
             if not passed:
                 print("Disconnected.")
     else:
         if not passed:
             print("No connection found.")
-        manage_dns("restore")
-        manage_ipv6("restore")
-        manage_killswitch("restore")
+        restore_network_state()
         logger.debug("No connection found")
 
 
+def restore_network_state():
+    """Undo the DNS, IPv6 and Kill Switch changes of a connection"""
+    # All journaled changes in one batch
+    journal.rollback()
+    # Backups of earlier versions
+    manage_dns("restore")
+    manage_ipv6("restore")
+    manage_killswitch("restore")
+
+
+def recover():
+    """Revert the changes of a connect that was interrupted, e.g. by a crash"""
+    logger.debug("Recovering from an interrupted connect")
+    print("[!] A previous connection attempt was interrupted. Reverting its changes...")
+    disconnect(passed=True)
+
+
+@locks.state_lock.hold(timeout=STATE_LOCK_TIMEOUT)
 def status():
     """
     Display the current VPN status
@@ -361,7 +452,7 @@ def status():
     if not is_connected():
         logger.debug("Disconnected")
         print("Status:     Disconnected")
-        if os.path.isfile(os.path.join(CONFIG_DIR, "iptables.backup")):
+        if is_killswitch_active():
             print("[!] Kill Switch is currently active.")
             logger.debug("Kill Switch active while VPN disconnected")
         else:
@@ -399,15 +490,15 @@ def status():
     all_features = {0: "Normal", 1: "Secure-Core", 2: "Tor", 4: "P2P"}
 
     logger.debug("Collecting status information")
-    country_code = get_server_value(connected_server, "ExitCountry", servers)
-    country = get_country_name(country_code)
-    city = get_server_value(connected_server, "City", servers)
-    load = get_server_value(connected_server, "Load", servers)
-    feature = get_server_value(connected_server, "Features", servers)
+    server = get_server(connected_server, servers)
+    country = get_country_name(server.exit_country)
+    city = server.city
+    load = server.load
+    feature = server.features
     last_connection = get_config_value("metadata", "connected_time")
     connection_time = time.time() - int(last_connection)
 
-    if os.path.isfile(os.path.join(CONFIG_DIR, "iptables.backup")):
+    if is_killswitch_active():
         killswitch_on = True
     else:
         killswitch_on = False
@@ -436,39 +527,254 @@ def status():
     )
 
 
-def openvpn_connect(servername, protocol):
-    """Connect to VPN Server."""
+def status_json(probe=False):
+    """
+    Print the VPN status as JSON.
+
+    Answers from local state only: the OpenVPN pidfile, the interface
+    counters, the connection metadata and the public IP cached at connect
+    time for IP_INFO_TTL seconds. Network probes only run with probe=True.
+
+    Schema (version 1), all keys are always present:
+    schema_version, connected, pid, interface, server, protocol,
+    connected_since, killswitch, rx_bytes, tx_bytes, ip, isp, ip_age,
+    transitioning, probe (null, or an object with dns_reachable, ip and isp)
+
+    transitioning is true if a connect or disconnect was running, the
+    state is then read without waiting for it and may be inconsistent.
+    """
+    logger.debug("Getting VPN Status as JSON")
+
+    def read_state():
+        config = configparser.ConfigParser()
+        with locks.config_lock.hold():
+            config.read(CONFIG_FILE)
+        metadata = config["metadata"] if config.has_section("metadata") else {}
+
+        pid = get_openvpn_pid()
+        # Connections established before the pidfile existed
+        connected = bool(pid) or (not os.path.isfile(OPENVPN_PID_FILE) and is_connected())
+        killswitch = is_killswitch_active()
+
+        interface = get_vpn_interface()
+        counters = InterfaceCounters().sample() if interface else None
+        return metadata, pid, connected, killswitch, interface, counters
+
+    # A consistent snapshot, unless a connect or disconnect holds the lock.
+    # Pollers get an answer right away instead of waiting for it.
+    transitioning = False
+    try:
+        with locks.state_lock.hold(timeout=STATUS_LOCK_TIMEOUT):
+            metadata, pid, connected, killswitch, interface, counters = read_state()
+    except locks.LockTimeout:
+        transitioning = True
+        metadata, pid, connected, killswitch, interface, counters = read_state()
+
+    result = collections.OrderedDict([
+        ("schema_version", 1),
+        ("connected", connected),
+        ("pid", pid),
+        ("interface", interface),
+        ("server", None),
+        ("protocol", None),
+        ("connected_since", None),
+        ("killswitch", killswitch),
+        ("rx_bytes", counters[0] if counters else None),
+        ("tx_bytes", counters[1] if counters else None),
+        ("ip", None),
+        ("isp", None),
+        ("ip_age", None),
+        ("transitioning", transitioning),
+        ("probe", None),
+    ])
+
+    if connected:
+        result["server"] = metadata.get("connected_server")
+        result["protocol"] = metadata.get("connected_proto")
+        if metadata.get("connected_time"):
+            result["connected_since"] = int(metadata["connected_time"])
+        if metadata.get("ip_info_time"):
+            ip_age = int(time.time()) - int(metadata["ip_info_time"])
+            if ip_age <= IP_INFO_TTL:
+                result["ip"] = metadata.get("connected_ip")
+                result["isp"] = metadata.get("connected_isp")
+                result["ip_age"] = ip_age
+
+    if probe:
+        dns_reachable = None
+        if connected and metadata.get("dns_server"):
+            ping = subprocess.run(["ping", "-c", "1", metadata["dns_server"]],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+            dns_reachable = ping.returncode == 0
+        ip, isp = get_ip_info()
+        result["probe"] = collections.OrderedDict([
+            ("dns_reachable", dns_reachable), ("ip", ip), ("isp", isp)
+        ])
+        if connected:
+            result["ip"], result["isp"], result["ip_age"] = ip, isp, 0
+
+    print(json.dumps(result, indent=2))
+
+
+def status_watch(interval=1.0):
+    """
+    Continuously display the connection status with transfer rates.
+
+    Only reads local state: the sysfs counters are sampled every interval
+    seconds, while the connected server and its load are re-read from the
+    configuration and the cached server list every 60 seconds.
+    """
+    check_init()
+    logger.debug("Watching VPN Status every {0}s".format(interval))
+
+    counters = InterfaceCounters()
+    # Rates of the last 10 samples for the moving average
+    rx_rates = collections.deque(maxlen=10)
+    tx_rates = collections.deque(maxlen=10)
+    server_info = {}
+    server_info_time = 0
+    lines_drawn = 0
+
+    while True:
+        sample = counters.sample()
+
+        if time.monotonic() - server_info_time >= 60:
+            server_info = {}
+            try:
+                server_info["server"] = get_config_value("metadata", "connected_server")
+                server_info["time"] = int(get_config_value("metadata", "connected_time"))
+                servers = get_servers()
+                server_info["load"] = get_server(server_info["server"], servers).load
+            except (KeyError, IndexError, OSError, ValueError):
+                logger.debug("Incomplete connection information")
+            server_info_time = time.monotonic()
+
+        if sample is None:
+            rx_rates.clear()
+            tx_rates.clear()
+            output = ["Status:       Disconnected"]
+        else:
+            rx_bytes, tx_bytes = sample
+            rx_rates.append(counters.rx_rate)
+            tx_rates.append(counters.tx_rate)
+            output = ["Status:       Connected"]
+            if "time" in server_info:
+                connection_time = str(datetime.timedelta(seconds=int(time.time()) - server_info["time"]))
+                output.append("Time:         {0}".format(connection_time))
+            if "server" in server_info:
+                output.append("Server:       {0}".format(server_info["server"]))
+            if "load" in server_info:
+                output.append("Load:         {0}%".format(server_info["load"]))
+            output += [
+                "Received:     {0}".format(convert_size(rx_bytes)),
+                "Sent:         {0}".format(convert_size(tx_bytes)),
+                "Download:     {0}/s (avg {1}/s)".format(
+                    convert_size(counters.rx_rate), convert_size(sum(rx_rates) / len(rx_rates))
+                ),
+                "Upload:       {0}/s (avg {1}/s)".format(
+                    convert_size(counters.tx_rate), convert_size(sum(tx_rates) / len(tx_rates))
+                ),
+            ]
+
+        # Move the cursor back up and redraw in place
+        if lines_drawn:
+            sys.stdout.write("\033[{0}F\033[J".format(lines_drawn))
+        sys.stdout.write("\n".join(output) + "\n")
+        sys.stdout.flush()
+        lines_drawn = len(output)
+
+        time.sleep(interval)
+
+
+@locks.state_lock.hold(exclusive=True, timeout=STATE_LOCK_TIMEOUT)
+def openvpn_connect(servername, protocol, show_timings=False, revalidate=None):
+    """
+    Connect to VPN Server.
+
+    Independent phases run concurrently: the IP lookup alongside rendering
+    the config and the DNS/IPv6 setup alongside the Kill Switch.
+    revalidate(servername) returns the server to use instead, it is
+    called right before OpenVPN is started.
+    """
 
     logger.debug("Initiating OpenVPN connection")
     logger.debug(
         "Connecting to {0} via {1}".format(servername, protocol.upper())
     )
 
-    port = {"udp": 1194, "tcp": 443}
-
-    servers = get_servers()
-    subservers = get_server_value(servername, "Servers", servers)
-    ip_list = [subserver["EntryIP"] for subserver in subservers]
-
-    # Ports gets casted to a list instead of just a single port to make it iterable
-    create_openvpn_config(serverlist=ip_list, protocol=protocol, ports=[port[protocol.lower()]])
-
-    disconnect(passed=True)
+    timings = collections.OrderedDict()
+    pipeline_start = time.monotonic()
+    metrics.set_tags(server=servername, proto=protocol.lower())
+    port = OPENVPN_PORTS[protocol.lower()]
+
+    # Only looked up by name, the caller may have chosen a server the
+    # cached data still lists as offline, e.g. by its current load
+    servers = timed_call(timings, "servers", get_servers, online_only=False)
+    ip_list = []
+    config_path = None
+
+    timed_call(timings, "disconnect", disconnect, passed=True)
+    # Changes of this connect are rolled back on the next start if it crashes
+    transaction = journal.begin()
+
+    def render_config():
+        nonlocal ip_list, config_path
+        ip_list = [subserver.entry_ip for subserver in get_server(servername, servers).servers]
+        # Entry IPs that recently failed are left out of the remote lines
+        ip_list = quarantine.filter_entry_ips(ip_list)
+
+        # Probes have to run after disconnecting, so they don't go
+        # through a previous tunnel
+        serverlist, ordered = order_by_rtt(ip_list)
+
+        path_mtu = None
+        if int(get_config_value("USER", "mtu_discovery")):
+            path_mtu = get_path_mtu(serverlist[0])
+
+        # Ports gets casted to a list instead of just a single port to make it iterable
+        config_path = create_openvpn_config(
+            serverlist=serverlist, protocol=protocol, ports=[port], path_mtu=path_mtu, ordered=ordered
+        )
 
-    old_ip, _ = get_ip_info()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        ip_lookup = executor.submit(timed_call, timings, "ip_lookup", get_ip_info)
+        config = executor.submit(timed_call, timings, "config", render_config)
+        old_ip, _ = ip_lookup.result()
+        config.result()
+
+    if revalidate is not None:
+        new_servername = timed_call(timings, "revalidate", revalidate, servername)
+        if new_servername != servername:
+            print("Switching from {0} to {1} after refreshing the server data.".format(servername, new_servername))
+            servername = new_servername
+            metrics.set_tags(server=servername)
+            servers = get_servers(online_only=False)
+            timed_call(timings, "config", render_config)
 
     print("Connecting to {0} via {1}...".format(servername, protocol.upper()))
 
-    with open(os.path.join(CONFIG_DIR, "ovpn.log"), "w+") as f:
-        subprocess.Popen(
+    # OpenVPN reads the config verified here instead of the path, which
+    # could be replaced until it starts
+    config_file = open_openvpn_config(config_path)
+    if config_file is None:
+        print("[!] The OpenVPN config {0} was modified while connecting.".format(config_path))
+        logger.debug("OpenVPN config failed verification before the spawn")
+        metrics.record_span("connect", time.monotonic() - pipeline_start, ok=False)
+        sys.exit(1)
+
+    with config_file, open(os.path.join(CONFIG_DIR, "ovpn.log"), "w+") as f:
+        timed_call(
+            timings, "spawn", subprocess.Popen,
             [
                 "openvpn",
-                "--config", OVPN_FILE,
+                "--config", "/dev/fd/{0}".format(config_file.fileno()),
                 "--auth-user-pass", PASSFILE,
-                "--dev", "proton0",
-                "--dev-type", "tun"
+                "--dev", VPN_DEVICE,
+                "--dev-type", "tun",
+                "--writepid", OPENVPN_PID_FILE
             ],
-            stdout=f, stderr=f
+            stdout=f, stderr=f, pass_fds=[config_file.fileno()]
         )
 
     logger.debug("OpenVPN process started")
@@ -480,30 +786,48 @@ def openvpn_connect(servername, protocol):
             f.seek(0)
             # If connection successful
             if "Initialization Sequence Completed" in content:
-                # Enable DNS Leak Protection
-                dns_dhcp_regex = re.compile(
-                    r"(dhcp-option DNS )"
-                    r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
-                )
-
-                dns_dhcp = dns_dhcp_regex.search(content)
-                if dns_dhcp:
-                    dns_server = dns_dhcp.group(2)
-                    set_config_value("metadata", "dns_server", dns_server)
-                    manage_dns("leak_protection", dns_server)
-                else:
-                    print(
-                        "[!] Could not enable DNS Leak Protection!\n"
-                        "[!] Make sure you are protected!"
+                timings["handshake"] = time.time() - time_start
+                metrics.record_span("handshake", timings["handshake"])
+
+                def enable_dns():
+                    # Enable DNS Leak Protection
+                    dns_dhcp_regex = re.compile(
+                        r"(dhcp-option DNS )"
+                        r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})"
                     )
-                manage_ipv6("disable")
-                manage_killswitch("enable", proto=protocol.lower(),
-                                  port=port[protocol.lower()])
-                new_ip, _ = get_ip_info()
+
+                    dns_dhcp = dns_dhcp_regex.search(content)
+                    if dns_dhcp:
+                        dns_server = dns_dhcp.group(2)
+                        set_config_value("metadata", "dns_server", dns_server)
+                        manage_dns("leak_protection", dns_server)
+                    else:
+                        print(
+                            "[!] Could not enable DNS Leak Protection!\n"
+                            "[!] Make sure you are protected!"
+                        )
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+                    tasks = [
+                        executor.submit(timed_call, timings, "dns", enable_dns),
+                        executor.submit(timed_call, timings, "ipv6", manage_ipv6, "disable"),
+                        executor.submit(
+                            timed_call, timings, "killswitch",
+                            manage_killswitch, "enable", proto=protocol.lower(), port=port
+                        ),
+                    ]
+                    for task in tasks:
+                        task.result()
+
+                new_ip, new_isp = timed_call(timings, "verify", get_ip_info)
                 if old_ip == new_ip:
                     logger.debug("Failed to connect. IP didn't change")
                     print("[!] Connection failed. Reverting all changes...")
                     disconnect(passed=True)
+                    peer = quarantine.get_peer(content)
+                    quarantine_failed(servername, [peer] if peer else [])
+                    metrics.record_span("connect", time.monotonic() - pipeline_start, ok=False)
+                    sys.exit(1)
                 print("Connected!")
                 logger.debug("Connection successful")
                 break
@@ -515,27 +839,55 @@ def openvpn_connect(servername, protocol):
                     "Username and Password is correct."
                 )
                 logger.debug("Authentication failure")
+                metrics.record_span("connect", time.monotonic() - pipeline_start, ok=False)
                 sys.exit(1)
             # Stop after 45s
             elif time.time() - time_start >= 45:
                 print("Connection failed.")
                 logger.debug("Connection failed after 45 Seconds")
+                failed_ips = quarantine.get_failed_remotes(content)
+                quarantine_failed(
+                    servername, failed_ips,
+                    whole_server=not failed_ips or set(ip_list) <= set(failed_ips)
+                )
+                metrics.record_span("connect", time.monotonic() - pipeline_start, ok=False)
                 sys.exit(1)
             time.sleep(0.1)
 
-    # Write connection info into configuration file
-    logger.debug("Writing connection info to file")
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
-
-    config["metadata"]["connected_server"] = servername
-    config["metadata"]["connected_proto"] = protocol
-    config["metadata"]["connected_time"] = str(int(time.time()))
-
-    with open(CONFIG_FILE, "w+") as f:
-        config.write(f)
-
-    check_update()
+    def write_metadata():
+        # Write connection info into configuration file
+        logger.debug("Writing connection info to file")
+        now = int(time.time())
+        set_config_values("metadata", {
+            "connected_server": servername,
+            "connected_proto": protocol,
+            "connected_time": now,
+            # Cached for 'status --json'
+            "connected_ip": new_ip,
+            "connected_isp": new_isp,
+            "ip_info_time": now,
+        })
+
+    timed_call(timings, "metadata", write_metadata)
+    journal.commit(transaction)
+    timings["total"] = time.monotonic() - pipeline_start
+    metrics.record_span("connect", timings["total"], ok=True)
+
+    logger.debug("Connection timings: {0}".format(dict(timings)))
+    if show_timings:
+        print()
+        print("Connection phases:")
+        for phase, duration in timings.items():
+            print("  {0:<12} {1:.3f}s".format(phase, duration))
+
+
+def quarantine_failed(servername, entry_ips, whole_server=True):
+    """Quarantine a server or some of its entry IPs after a failed connection"""
+    try:
+        quarantine.add(servers=[servername] if whole_server else [], entry_ips=entry_ips)
+        change_file_owner(QUARANTINE_FILE)
+    except OSError as e:
+        logger.debug("Couldn't quarantine {0}: {1}".format(servername, e))
 
 
 def manage_dns(mode, dns_server=False):
@@ -552,9 +904,9 @@ def manage_dns(mode, dns_server=False):
 
     if mode == "leak_protection":
         logger.debug("Leak Protection initiated")
-        # Restore original resolv.conf if it exists
-        if os.path.isfile(backupfile):
-            logger.debug("resolv.conf.backup exists")
+        # Restore original resolv.conf if it was changed
+        if journal.is_active(journal.DNS) or os.path.isfile(backupfile):
+            logger.debug("resolv.conf was changed before")
             manage_dns("restore")
         # Check for custom DNS Server
         if not int(get_config_value("USER", "dns_leak_protection")):
@@ -570,40 +922,43 @@ def manage_dns(mode, dns_server=False):
         if not dns_server:
             raise Exception("No DNS Server has been provided.")
 
-        shutil.copy2(resolvconf_path, backupfile)
-        logger.debug("{0} (resolv.conf) backed up".format(resolvconf_path))
+        with open(resolvconf_path, "r") as f:
+            original = f.read()
 
         # Remove previous nameservers
         dns_regex = re.compile(r"^nameserver .*$")
-
-        with open(backupfile, 'r') as backup_handle:
-            with open(resolvconf_path, 'w') as resolvconf_handle:
-                for line in backup_handle:
-                    if not dns_regex.search(line):
-                        resolvconf_handle.write(line)
-
-        logger.debug("Removed existing DNS Servers")
+        lines = [line for line in original.splitlines(True) if not dns_regex.search(line)]
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+
+        nameservers = dns_server.split()[:3]
+        if int(get_config_value("USER", "dns_cache")):
+            journal.record(journal.DNS, journal.stop_process_step(DNS_CACHE_PID_FILE, "protonvpn_cli.dnscache"))
+            try:
+                dnscache.start(nameservers, VPN_DEVICE)
+                nameservers = [DNS_CACHE_ADDRESS]
+            except OSError as e:
+                print("[!] Could not start the DNS cache, using the DNS servers directly.")
+                logger.debug("DNS cache failed to start: {0}".format(e))
 
         # Add ProtonVPN managed DNS Server to resolv.conf
-        dns_server = dns_server.split()
-        with open(resolvconf_path, "a") as f:
-            f.write("# ProtonVPN DNS Servers. Managed by ProtonVPN-CLI.\n")
-            for dns in dns_server[:3]:
-                f.write("nameserver {0}\n".format(dns))
-            logger.debug("Added ProtonVPN or custom DNS")
-
-        # Write the hash of the edited file in the configuration
-        #
-        # This is so it doesn't restore an old DNS configuration
-        # if the configuration changes during a VPN session
-        # (e.g. by switching networks)
-
-        with open(resolvconf_path, "rb") as f:
-            filehash = zlib.crc32(f.read())
-        set_config_value("metadata", "resolvconf_hash", filehash)
+        lines.append("# ProtonVPN DNS Servers. Managed by ProtonVPN-CLI.\n")
+        for dns in nameservers:
+            lines.append("nameserver {0}\n".format(dns))
+        changed = "".join(lines)
+
+        # The journaled checksum of the edited file keeps an old DNS
+        # configuration from being restored if the configuration changes
+        # during a VPN session (e.g. by switching networks)
+        journal.record(journal.DNS, journal.restore_file_step(resolvconf_path, original, changed))
+        with open(resolvconf_path, "w") as f:
+            f.write(changed)
+        logger.debug("Replaced DNS Servers with ProtonVPN or custom DNS")
 
     elif mode == "restore":
         logger.debug("Restoring DNS")
+        journal.rollback([journal.DNS])
+        # Backup of earlier versions
         if os.path.isfile(backupfile):
 
             # Check if the file changed since connection
@@ -619,8 +974,6 @@ def manage_dns(mode, dns_server=False):
 
             os.remove(backupfile)
             logger.debug("resolv.conf.backup removed")
-        else:
-            logger.debug("No Backupfile found")
     else:
         raise Exception("Invalid argument provided. "
                         "Mode must be 'restore' or 'leak_protection'")
@@ -646,8 +999,8 @@ def manage_ipv6(mode):
         if os.path.isfile(ipv6_backupfile):
             manage_ipv6("legacy_restore")
 
-        if os.path.isfile(ip6tables_backupfile):
-            logger.debug("IPv6 backup exists")
+        if journal.is_active(journal.IPV6) or os.path.isfile(ip6tables_backupfile):
+            logger.debug("IPv6 leak protection was enabled before")
             manage_ipv6("restore")
 
         if is_ipv6_disabled():
@@ -659,16 +1012,9 @@ def manage_ipv6(mode):
         ip6tables_rules = subprocess.run(["ip6tables-save"],
                                          stdout=subprocess.PIPE)
 
-        if "COMMIT" in ip6tables_rules.stdout.decode():
-            with open(ip6tables_backupfile, "wb") as f:
-                f.write(ip6tables_rules.stdout)
-        else:
-            with open(ip6tables_backupfile, "w") as f:
-                f.write("*filter\n")
-                f.write(":INPUT ACCEPT\n")
-                f.write(":FORWARD ACCEPT\n")
-                f.write(":OUTPUT ACCEPT\n")
-                f.write("COMMIT\n")
+        journal.record(
+            journal.IPV6, journal.restore_rules_step("ip6tables-restore", get_saved_rules(ip6tables_rules.stdout))
+        )
 
         # Get the default nic from ip route show output
         default_nic = get_default_nic()
@@ -679,6 +1025,8 @@ def manage_ipv6(mode):
         ]
         for command in ip6tables_commands:
             command = command.split()
+            # Wait for the xtables lock, the Kill Switch may be set up concurrently
+            command.insert(1, "-w")
             subprocess.run(command)
         logger.debug("IPv6 disabled successfully")
 
@@ -688,6 +1036,8 @@ def manage_ipv6(mode):
         if os.path.isfile(ipv6_backupfile):
             logger.debug("legacy ipv6 backup found")
             manage_ipv6("legacy_restore")
+        journal.rollback([journal.IPV6])
+        # Backup of earlier versions
         if os.path.isfile(ip6tables_backupfile):
             subprocess.run(
                 "ip6tables-restore < {0}".format(
@@ -697,8 +1047,6 @@ def manage_ipv6(mode):
             logger.debug("ip6tables restored")
             os.remove(ip6tables_backupfile)
             logger.debug("ip6tables.backup removed")
-        else:
-            logger.debug("No Backupfile found")
         return
 
     elif mode == "legacy_restore":
@@ -774,6 +1122,8 @@ def manage_killswitch(mode, proto=None, port=None):
 
     if mode == "restore":
         logger.debug("Restoring iptables")
+        journal.rollback([journal.KILLSWITCH])
+        # Backup of earlier versions
         if os.path.isfile(backupfile):
             logger.debug("Restoring IPTables rules")
             subprocess.run("iptables-restore < {0}".format(backupfile),
@@ -781,8 +1131,6 @@ def manage_killswitch(mode, proto=None, port=None):
             logger.debug("iptables restored")
             os.remove(backupfile)
             logger.debug("iptables.backup removed")
-        else:
-            logger.debug("No Backupfile found")
         return
 
     # Stop if Kill Switch is disabled
@@ -790,8 +1138,8 @@ def manage_killswitch(mode, proto=None, port=None):
         return
 
     if mode == "enable":
-        if os.path.isfile(backupfile):
-            logger.debug("Kill Switch backup exists")
+        if is_killswitch_active():
+            logger.debug("Kill Switch was enabled before")
             manage_killswitch("restore")
 
         with open(os.path.join(CONFIG_DIR, "ovpn.log"), "r") as f:
@@ -810,16 +1158,9 @@ def manage_killswitch(mode, proto=None, port=None):
         iptables_rules = subprocess.run(["iptables-save"],
                                         stdout=subprocess.PIPE)
 
-        if "COMMIT" in iptables_rules.stdout.decode():
-            with open(backupfile, "wb") as f:
-                f.write(iptables_rules.stdout)
-        else:
-            with open(backupfile, "w") as f:
-                f.write("*filter\n")
-                f.write(":INPUT ACCEPT\n")
-                f.write(":FORWARD ACCEPT\n")
-                f.write(":OUTPUT ACCEPT\n")
-                f.write("COMMIT\n")
+        journal.record(
+            journal.KILLSWITCH, journal.restore_rules_step("iptables-restore", get_saved_rules(iptables_rules.stdout))
+        )
 
         # Creating Kill Switch rules
         iptables_commands = [
@@ -856,5 +1197,26 @@ def manage_killswitch(mode, proto=None, port=None):
 
         for command in iptables_commands:
             command = command.split()
+            # Wait for the xtables lock, IPv6 leak protection may be set up concurrently
+            command.insert(1, "-w")
             subprocess.run(command)
         logger.debug("Kill Switch enabled")
+
+
+def get_saved_rules(output):
+    """Return iptables-save output, or an empty ruleset if there is none"""
+    rules = output.decode()
+    if "COMMIT" in rules:
+        return rules
+    return (
+        "*filter\n"
+        ":INPUT ACCEPT\n"
+        ":FORWARD ACCEPT\n"
+        ":OUTPUT ACCEPT\n"
+        "COMMIT\n"
+    )
+
+
+def is_killswitch_active():
+    """Return True if the Kill Switch rules are applied"""
+    return journal.is_active(journal.KILLSWITCH) or os.path.isfile(os.path.join(CONFIG_DIR, "iptables.backup"))
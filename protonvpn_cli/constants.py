@@ -16,8 +16,109 @@ CONFIG_FILE = os.path.join(CONFIG_DIR, "pvpn-cli.cfg")
 SERVER_INFO_FILE = os.path.join(CONFIG_DIR, "serverinfo.json")
 SPLIT_TUNNEL_FILE = os.path.join(CONFIG_DIR, "split_tunnel.txt")
 OVPN_FILE = os.path.join(CONFIG_DIR, "connect.ovpn")
+# Rendered OpenVPN configs, named by the hash of their inputs
+OVPN_CACHE_DIR = os.path.join(CONFIG_DIR, "ovpn_cache")
+OVPN_CACHE_SIZE = 16
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
 PASSFILE = os.path.join(CONFIG_DIR, "pvpnpass")
+OPENVPN_PID_FILE = os.path.join(CONFIG_DIR, "openvpn.pid")
+# Seconds the public IP looked up at connect time is reported by 'status --json'
+IP_INFO_TTL = 3600
+METRICS_FILE = os.path.join(CONFIG_DIR, "metrics.jsonl")
+METRICS_MAX_RECORDS = 5000
+# Read-only commands that are polled, their spans would push the connect
+# spans out of the metrics file
+METRICS_IGNORED_COMMANDS = ["s", "status", "stats", "exporter", "ex", "examples"]
+PMTU_CACHE_FILE = os.path.join(CONFIG_DIR, "pmtu_cache.json")
+# Seconds a discovered path MTU is reused
+PMTU_CACHE_TTL = 6 * 3600
+# Servers ranked within this cost (0..1) of the best are picked at random
+RANKING_TOLERANCE = 0.02
+# Number of nearest servers ranked by 'connect --near'
+PROXIMITY_POOL_SIZE = 25
+# Seconds the location of the public IP is reused for ranking
+LOCATION_TTL = 3600
+# Hourly peak loads of all servers, kept for LOAD_HISTORY_WEEKS
+LOAD_HISTORY_FILE = os.path.join(CONFIG_DIR, "load_history.bin")
+LOAD_HISTORY_INDEX = os.path.join(CONFIG_DIR, "load_history.json")
+LOAD_HISTORY_WEEKS = 4
+# Servers and entry IPs that failed to connect are skipped for QUARANTINE_TTL
+QUARANTINE_FILE = os.path.join(CONFIG_DIR, "quarantine.json")
+QUARANTINE_TTL = 30 * 60
+# TCP connect times to entry IPs, used to order remotes and rank servers
+RTT_CACHE_FILE = os.path.join(CONFIG_DIR, "rtt_cache.json")
+RTT_CACHE_TTL = 10 * 60
+RTT_PROBE_PORT = 443
+RTT_PROBE_TIMEOUT = 1.5
+# Seconds OpenVPN waits for a remote before trying the next one
+SERVER_POLL_TIMEOUT = 8
+# Seconds to wait for a concurrent server data refresh
+SERVER_CACHE_LOCK_TIMEOUT = 60
+# Seconds a background refresh waits for the API to respond
+SERVER_REFRESH_TIMEOUT = 5
+# Seconds a connect waits for the background refresh before using the cached choice
+REVALIDATE_TIMEOUT = 5
+# Load from which a refreshed server counts as too busy to keep the cached choice
+REVALIDATE_MAX_LOAD = 90
+# Lock files serializing concurrent invocations
+CONFIG_LOCK_FILE = os.path.join(CONFIG_DIR, "pvpn-cli.cfg.lock")
+STATE_LOCK_FILE = os.path.join(CONFIG_DIR, "state.lock")
+# Write-ahead journal of DNS, IPv6 and Kill Switch changes
+JOURNAL_FILE = os.path.join(CONFIG_DIR, "netstate.journal")
+# Seconds to wait for the config lock, it is only held briefly
+LOCK_TIMEOUT = 10
+# Seconds to wait for the state lock, a connect holds it for up to a minute
+STATE_LOCK_TIMEOUT = 90
+# Seconds 'status --json' waits for the state lock before reading anyway
+STATUS_LOCK_TIMEOUT = 0.2
+# Local caching DNS forwarder, it only forwards through the tunnel device
+DNS_CACHE_ADDRESS = "127.0.0.153"
+DNS_CACHE_PID_FILE = os.path.join(CONFIG_DIR, "dnscache.pid")
+DNS_CACHE_SIZE = 4096
+# Upper bounds in seconds for cached answers and cached negative answers
+DNS_CACHE_MAX_TTL = 24 * 3600
+DNS_CACHE_NEGATIVE_TTL = 5 * 60
+# Seconds to wait for an upstream DNS server before trying the next one
+DNS_UPSTREAM_TIMEOUT = 2
+# Seconds between the first API probes of wait_for_network(), doubled up to the max
+NETWORK_PROBE_BACKOFF_START = 0.05
+NETWORK_PROBE_BACKOFF_MAX = 2
+# Result of the last background update check
+UPDATE_CHECK_FILE = os.path.join(CONFIG_DIR, "update_check.json")
+UPDATE_CHECK_TIMEOUT = 5
 VERSION = "2.2.4"
+OPENVPN_PORTS = {"udp": 1194, "tcp": 443}
+VPN_DEVICE = "proton0"
+# OpenVPN support assumed for exported configs, which run on other machines.
+# OpenVPN 2.5 and newer still accept the 2.4 ncp-ciphers.
+EXPORT_OPENVPN_CAPABILITIES = {"version": (2, 4), "chacha20": False}
+
+# OpenVPN performance profiles, selectable via 'protonvpn configure'.
+# Directives the local OpenVPN doesn't support are dropped when rendering.
+PERFORMANCE_PROFILES = {
+    "default": {},
+    "throughput": {
+        "data_ciphers": ["AES-256-GCM", "CHACHA20-POLY1305"],
+        "sndbuf": 524288,
+        "rcvbuf": 524288,
+        "txqueuelen": 1000,
+        "fast_io": True,
+    },
+    "latency": {
+        "data_ciphers": ["AES-256-GCM", "CHACHA20-POLY1305"],
+        "sndbuf": 131072,
+        "rcvbuf": 131072,
+        "txqueuelen": 100,
+        "fast_io": True,
+    },
+    "constrained": {
+        "data_ciphers": ["CHACHA20-POLY1305", "AES-256-GCM"],
+        "sndbuf": 65536,
+        "rcvbuf": 65536,
+        "txqueuelen": 50,
+        "fast_io": True,
+    },
+}
 
 USAGE = """
 ProtonVPN CLI
@@ -25,17 +126,18 @@ ProtonVPN CLI
 Usage:
     protonvpn init
     protonvpn (c | connect) [<servername>] [-p <protocol>]
-    protonvpn (c | connect) [-f | --fastest] [-p <protocol>]
-    protonvpn (c | connect) [--cc <code>] [-p <protocol>]
-    protonvpn (c | connect) [--sc] [-p <protocol>]
-    protonvpn (c | connect) [--p2p] [-p <protocol>]
-    protonvpn (c | connect) [--tor] [-p <protocol>]
+    protonvpn (c | connect) [-f | --fastest] [--near] [-p <protocol>]
+    protonvpn (c | connect) [--cc <codes>] [--sc] [--p2p] [--tor] [--near] [-p <protocol>]
     protonvpn (c | connect) [-r | --random] [-p <protocol>]
-    protonvpn (r | reconnect)
+    protonvpn (r | reconnect) [--timings] [--sticky-threshold <load>]
     protonvpn (d | disconnect)
-    protonvpn (s | status)
+    protonvpn (s | status) [--watch [<interval>]]
+    protonvpn (s | status) [--json [--probe]]
     protonvpn (cf | configure)
     protonvpn (rf | refresh)
+    protonvpn export --out <dir> [--filter <patterns>] [--proto <protocols>] [--prune]
+    protonvpn stats [--json]
+    protonvpn exporter [--listen <host:port>]
     protonvpn (ex | examples)
     protonvpn (-h | --help)
     protonvpn (-v | --version)
@@ -43,11 +145,15 @@ Usage:
 Options:
     -f, --fastest       Select the fastest ProtonVPN server.
     -r, --random        Select a random ProtonVPN server.
-    --cc CODE           Determine the country for fastest connect.
+    --cc CODES          Determine the countries for fastest connect (DE,NL).
     --sc                Connect to the fastest Secure-Core server.
     --p2p               Connect to the fastest torrent server.
     --tor               Connect to the fastest Tor server.
+    --near              Only consider servers close to your location.
     -p PROTOCOL         Determine the protocol (UDP or TCP).
+    --timings           Print the duration of each connection phase.
+    --sticky-threshold LOAD
+                        Reconnect elsewhere if the last server's load is this high.
     -h, --help          Show this help message.
     -v, --version       Display version.
 
@@ -59,6 +165,9 @@ Commands:
     s, status           Show connection status.
     cf, configure       Change ProtonVPN-CLI configuration.
     rf, refresh         Refresh OpenVPN configuration and server data.
+    export              Export OpenVPN configs of all servers.
+    stats               Show timing statistics of past commands.
+    exporter            Serve Prometheus metrics of the connection.
     ex, examples        Print some example commands.
 
 Arguments:
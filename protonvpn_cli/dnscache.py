@@ -0,0 +1,370 @@
+# Standard Libraries
+import sys
+import time
+import signal
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+import collections
+import socketserver
+# ProtonVPN-CLI functions
+from .logger import logger
+# Constants
+from .constants import (
+    DNS_CACHE_ADDRESS, DNS_CACHE_PID_FILE, DNS_CACHE_SIZE, DNS_CACHE_MAX_TTL,
+    DNS_CACHE_NEGATIVE_TTL, DNS_UPSTREAM_TIMEOUT
+)
+
+# A caching DNS forwarder for the duration of a connection. It answers
+# from an LRU cache while answers are within their TTL and forwards
+# everything else through the tunnel device only, so queries never leave
+# through another interface, whether or not the Kill Switch is enabled.
+
+DNS_PORT = 53
+HEADER = struct.Struct("!HHHHHH")
+RR_FIXED = struct.Struct("!HHIH")
+TYPE_SOA = 6
+TYPE_OPT = 41
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RA = 0x0080
+# Largest UDP response for clients without and with EDNS
+UDP_LIMIT = 512
+EDNS_UDP_LIMIT = 1232
+# socket.SO_BINDTODEVICE is missing in older Pythons
+SO_BINDTODEVICE = getattr(socket, "SO_BINDTODEVICE", 25)
+
+
+def _skip_name(message, offset):
+    """Return the offset after the (possibly compressed) name at offset"""
+    while True:
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise ValueError("Invalid label")
+        offset += 1 + length
+        if not length:
+            return offset
+
+
+def parse_question(message):
+    """
+    Return the cache key (name, type, class) and the question section.
+
+    Raises ValueError for anything but a query with a single question.
+    """
+    try:
+        _, flags, qdcount, _, _, _ = HEADER.unpack_from(message)
+        if flags & FLAG_QR or qdcount != 1:
+            raise ValueError("Not a single question query")
+        end = _skip_name(message, HEADER.size)
+        qtype, qclass = struct.unpack_from("!HH", message, end)
+    except (struct.error, IndexError):
+        raise ValueError("Truncated query")
+    name = bytes(message[HEADER.size:end]).lower()
+    return (name, qtype, qclass), bytes(message[HEADER.size:end + 4])
+
+
+def parse_response(message):
+    """
+    Return (seconds the response may be cached, offsets of its TTL fields).
+
+    The cache time is None for responses that mustn't be cached. Negative
+    answers (NXDOMAIN and empty answers) are cached for the SOA minimum.
+    """
+    try:
+        _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(message)
+        offset = HEADER.size
+        for _ in range(qdcount):
+            offset = _skip_name(message, offset) + 4
+
+        answer_ttl = None
+        negative_ttl = None
+        ttl_offsets = []
+        for idx in range(ancount + nscount + arcount):
+            offset = _skip_name(message, offset)
+            rtype, _, ttl, rdlength = RR_FIXED.unpack_from(message, offset)
+            rdata = offset + RR_FIXED.size
+            # The TTL of OPT pseudo-records holds EDNS flags
+            if rtype != TYPE_OPT:
+                ttl_offsets.append(offset + 4)
+                if idx < ancount:
+                    answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+                elif idx < ancount + nscount and rtype == TYPE_SOA:
+                    # MINIMUM is the last field of the SOA data
+                    minimum = struct.unpack_from("!I", message, rdata + rdlength - 4)[0]
+                    negative_ttl = min(ttl, minimum)
+            offset = rdata + rdlength
+        if offset > len(message):
+            raise ValueError("Truncated response")
+    except (struct.error, IndexError):
+        raise ValueError("Truncated response")
+
+    rcode = flags & 0xF
+    if flags & FLAG_TC:
+        cache_ttl = None
+    elif rcode == RCODE_NOERROR and ancount:
+        cache_ttl = min(answer_ttl, DNS_CACHE_MAX_TTL) if answer_ttl is not None else None
+    elif rcode in [RCODE_NOERROR, RCODE_NXDOMAIN] and negative_ttl is not None:
+        cache_ttl = min(negative_ttl, DNS_CACHE_NEGATIVE_TTL)
+    else:
+        cache_ttl = None
+    return cache_ttl, ttl_offsets
+
+
+def error_response(query, question, rcode=RCODE_SERVFAIL):
+    """Return a response with rcode to query"""
+    query_id, flags = struct.unpack_from("!HH", query)
+    # Keep the opcode and RD flag of the query
+    flags = (flags & 0x7900) | FLAG_QR | FLAG_RA | rcode
+    return HEADER.pack(query_id, flags, 1, 0, 0, 0) + question
+
+
+def truncate(response, question):
+    """Return the header and question of response with the TC flag set"""
+    query_id, flags = struct.unpack_from("!HH", response)
+    return HEADER.pack(query_id, flags | FLAG_TC, 1, 0, 0, 0) + question
+
+
+class DNSCache():
+    """
+    LRU cache of DNS responses that honours their TTLs.
+
+    Cached responses are served with the ID and question of the query
+    and their TTLs reduced by the time they spent in the cache.
+    """
+
+    def __init__(self, size=DNS_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, query, question, now=None):
+        """Return the cached response for query or None"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        response, expires, stored, ttl_offsets = entry
+
+        response = bytearray(response)
+        response[0:2] = query[0:2]
+        response[HEADER.size:HEADER.size + len(question)] = question
+        age = int(now - stored)
+        for offset in ttl_offsets:
+            ttl = struct.unpack_from("!I", response, offset)[0]
+            struct.pack_into("!I", response, offset, max(ttl - age, 0))
+        return bytes(response)
+
+    def put(self, key, response, now=None):
+        """Cache response if its TTLs allow it"""
+        now = time.monotonic() if now is None else now
+        try:
+            ttl, ttl_offsets = parse_response(response)
+        except ValueError:
+            return
+        if not ttl:
+            return
+        with self.lock:
+            self.entries[key] = (bytes(response), now + ttl, now, ttl_offsets)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class Resolver():
+    """Answer queries from a DNSCache and forward misses to upstreams"""
+
+    def __init__(self, upstreams, device=None, timeout=DNS_UPSTREAM_TIMEOUT, cache=None):
+        # upstreams is a list of (address, port)
+        self.upstreams = upstreams
+        self.device = device
+        self.timeout = timeout
+        self.cache = cache if cache is not None else DNSCache()
+
+    def _socket(self, kind):
+        sock = socket.socket(socket.AF_INET, kind)
+        if self.device:
+            # Fails instead of using another interface if the tunnel is gone
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.device.encode())
+        sock.settimeout(self.timeout)
+        return sock
+
+    def _forward_udp(self, query, upstream):
+        with self._socket(socket.SOCK_DGRAM) as sock:
+            sock.sendto(query, upstream)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                response, address = sock.recvfrom(65535)
+                # Ignore anything but the answer to this query
+                if address == upstream and response[:2] == query[:2]:
+                    return response
+
+    def _forward_tcp(self, query, upstream):
+        with self._socket(socket.SOCK_STREAM) as sock:
+            sock.connect(upstream)
+            sock.sendall(struct.pack("!H", len(query)) + query)
+            length = struct.unpack("!H", _recv_exactly(sock, 2))[0]
+            return _recv_exactly(sock, length)
+
+    def forward(self, query, tcp=False):
+        """Return the response of the first upstream that answers or None"""
+        for upstream in self.upstreams:
+            try:
+                response = self._forward_tcp(query, upstream) if tcp else self._forward_udp(query, upstream)
+                # A truncated UDP answer is retried over TCP
+                if not tcp and struct.unpack_from("!H", response, 2)[0] & FLAG_TC:
+                    response = self._forward_tcp(query, upstream)
+                return response
+            except (OSError, struct.error) as e:
+                logger.debug("DNS upstream {0} failed: {1}".format(upstream[0], e))
+        return None
+
+    def resolve(self, query, tcp=False):
+        """Return the response to query, None to drop invalid queries"""
+        try:
+            key, question = parse_question(query)
+        except ValueError:
+            return None
+
+        response = self.cache.get(key, query, question)
+        if response is None:
+            response = self.forward(query, tcp)
+            if response is None:
+                return error_response(query, question)
+            self.cache.put(key, response)
+
+        if not tcp:
+            # Queries with an additional record carry an EDNS buffer size
+            limit = EDNS_UDP_LIMIT if struct.unpack_from("!H", query, 10)[0] else UDP_LIMIT
+            if len(response) > limit:
+                return truncate(response, question)
+        return response
+
+
+def _recv_exactly(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise OSError("Connection closed")
+        data += chunk
+    return data
+
+
+class UDPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        query, sock = self.request
+        response = self.server.resolver.resolve(query)
+        if response is not None:
+            sock.sendto(response, self.client_address)
+
+
+class TCPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.settimeout(10)
+        try:
+            while True:
+                length = struct.unpack("!H", _recv_exactly(self.request, 2))[0]
+                response = self.server.resolver.resolve(_recv_exactly(self.request, length), tcp=True)
+                if response is None:
+                    return
+                self.request.sendall(struct.pack("!H", len(response)) + response)
+        except OSError:
+            return
+
+
+class ThreadingUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+
+def serve(udp_sock, tcp_sock, resolver):
+    """Serve queries on the bound sockets until terminated"""
+    servers = []
+    for server_class, handler, sock in [
+        (ThreadingUDPServer, UDPHandler, udp_sock),
+        (ThreadingTCPServer, TCPHandler, tcp_sock),
+    ]:
+        server = server_class(sock.getsockname(), handler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.resolver = resolver
+        servers.append(server)
+
+    threading.Thread(target=servers[1].serve_forever, daemon=True).start()
+    try:
+        servers[0].serve_forever()
+    finally:
+        logger.debug("DNS cache stopped ({0} hits, {1} misses)".format(resolver.cache.hits, resolver.cache.misses))
+
+
+def start(nameservers, device, address=DNS_CACHE_ADDRESS):
+    """
+    Start the DNS cache for nameservers in the background.
+
+    The sockets are bound here, so queries are queued and answered as
+    soon as the forwarder runs. Raises OSError if they can't be bound.
+    """
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp_sock.bind((address, DNS_PORT))
+        tcp_sock.bind((address, DNS_PORT))
+        tcp_sock.listen(16)
+
+        fds = [str(udp_sock.fileno()), str(tcp_sock.fileno())]
+        process = subprocess.Popen(
+            [sys.executable, "-m", "protonvpn_cli.dnscache", "--fds", ",".join(fds), "--device", device]
+            + list(nameservers),
+            pass_fds=(udp_sock.fileno(), tcp_sock.fileno()), start_new_session=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    finally:
+        udp_sock.close()
+        tcp_sock.close()
+
+    with open(DNS_CACHE_PID_FILE, "w") as f:
+        f.write(str(process.pid))
+    logger.debug("DNS cache started on {0} (pid {1})".format(address, process.pid))
+    return process.pid
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="protonvpn_cli.dnscache")
+    parser.add_argument("--fds", required=True, help="Bound UDP and listening TCP socket")
+    parser.add_argument("--device", required=True, help="Device to forward through")
+    parser.add_argument("nameservers", nargs="+")
+    args = parser.parse_args()
+
+    udp_fd, tcp_fd = (int(fd) for fd in args.fds.split(","))
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, fileno=udp_fd)
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=tcp_fd)
+    resolver = Resolver([(ns, DNS_PORT) for ns in args.nameservers], device=args.device)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.debug("DNS cache forwarding to {0} via {1}".format(args.nameservers, args.device))
+    serve(udp_sock, tcp_sock, resolver)
+
+
+if __name__ == "__main__":
+    main()
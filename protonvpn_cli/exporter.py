@@ -0,0 +1,231 @@
+# Standard Libraries
+import os
+import configparser
+import socketserver
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+# ProtonVPN-CLI functions
+from .logger import logger
+from . import metrics
+from .traffic import InterfaceCounters
+from .servers import load_servers
+from .utils import get_server_info_file
+# Constants
+from .constants import CONFIG_FILE, METRICS_FILE
+
+# Histogram buckets in seconds
+CONNECT_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45]
+API_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+LOCK_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60]
+CONNECT_PHASES = [
+    "servers", "disconnect", "ip_lookup", "config", "spawn", "handshake",
+    "dns", "ipv6", "killswitch", "verify", "metadata", "connect", "revalidate",
+]
+
+
+class FileCache():
+    """Parse a file only when its modification time changed"""
+
+    def __init__(self, path, parser):
+        self.path = path
+        self.parser = parser
+        self.mtime = None
+        self.value = None
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self.mtime = self.value = None
+            return None
+        if mtime != self.mtime:
+            try:
+                self.value = self.parser(self.path)
+                self.mtime = mtime
+            except (OSError, ValueError, KeyError, configparser.Error):
+                logger.debug("Exporter couldn't parse {0}".format(self.path))
+        return self.value
+
+
+def parse_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def parse_server_loads(path):
+    """Return {servername: load} of the cached server list"""
+    return {server.name: server.load for server in load_servers(path)}
+
+
+def parse_metrics(path):
+    """Return histograms of connect phase, API call and lock wait durations"""
+
+    def histogram(buckets):
+        return {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+
+    phases = {}
+    api_calls = {}
+    lock_waits = {}
+    connects = {"success": 0, "failure": 0}
+    reconnects = 0
+    revalidations = {"changed": 0, "kept": 0}
+
+    for record in metrics.read_records():
+        name = record["span"]
+        if name in CONNECT_PHASES:
+            target, buckets, label = phases, CONNECT_BUCKETS, name
+        elif name.startswith("api:"):
+            target, buckets, label = api_calls, API_BUCKETS, name[4:]
+        elif name.startswith("lock:"):
+            target, buckets, label = lock_waits, LOCK_BUCKETS, name[5:]
+        else:
+            continue
+
+        hist = target.setdefault(label, histogram(buckets))
+        for idx, bound in enumerate(buckets):
+            if record["dur"] <= bound:
+                hist["buckets"][idx] += 1
+        hist["sum"] += record["dur"]
+        hist["count"] += 1
+
+        if name == "connect":
+            connects["success" if record.get("ok") else "failure"] += 1
+            if record.get("command") in ["r", "reconnect"]:
+                reconnects += 1
+        elif name == "revalidate":
+            revalidations["changed" if record.get("changed") else "kept"] += 1
+
+    return {
+        "phases": phases, "api_calls": api_calls, "lock_waits": lock_waits, "connects": connects,
+        "reconnects": reconnects, "revalidations": revalidations,
+    }
+
+
+class MetricsCollector():
+    """Render the exporter metrics in the Prometheus text format"""
+
+    def __init__(self):
+        self.counters = InterfaceCounters()
+        self.config = FileCache(CONFIG_FILE, parse_config)
+        self.loads = FileCache(get_server_info_file(), parse_server_loads)
+        self.metrics = FileCache(METRICS_FILE, parse_metrics)
+        self.lock = threading.Lock()
+
+    def collect(self):
+        with self.lock:
+            return self._collect()
+
+    def _collect(self):
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for labels, value in samples:
+                label_str = ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append("{0}{1} {2}".format(name, "{" + label_str + "}" if label_str else "", value))
+
+        def histogram(name, help_text, label, buckets, histograms):
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} histogram".format(name))
+            for key in sorted(histograms):
+                hist = histograms[key]
+                for bound, count in zip(buckets, hist["buckets"]):
+                    lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}'.format(name, label, key, bound, count))
+                lines.append('{0}_bucket{{{1}="{2}",le="+Inf"}} {3}'.format(name, label, key, hist["count"]))
+                lines.append('{0}_sum{{{1}="{2}"}} {3:.4f}'.format(name, label, key, hist["sum"]))
+                lines.append('{0}_count{{{1}="{2}"}} {3}'.format(name, label, key, hist["count"]))
+
+        counters = self.counters.sample()
+        metric("protonvpn_up", "gauge", "Whether the VPN interface exists.", [((), 1 if counters else 0)])
+
+        config = self.config.get()
+        if counters and config is not None and config.has_option("metadata", "connected_server"):
+            server = config["metadata"]["connected_server"]
+            metric(
+                "protonvpn_connection_info", "gauge", "Currently connected server.",
+                [((("server", server), ("protocol", config["metadata"].get("connected_proto", ""))), 1)]
+            )
+            metric(
+                "protonvpn_connected_since_seconds", "gauge", "Unix time the connection was established.",
+                [((), config["metadata"].get("connected_time", 0))]
+            )
+            loads = self.loads.get() or {}
+            if server in loads:
+                metric(
+                    "protonvpn_server_load_percent", "gauge", "Load of the connected server.",
+                    [((("server", server),), loads[server])]
+                )
+
+        if counters:
+            rx_bytes, tx_bytes = counters
+            metric("protonvpn_receive_bytes_total", "counter", "Bytes received through the tunnel.",
+                   [((), rx_bytes)])
+            metric("protonvpn_transmit_bytes_total", "counter", "Bytes sent through the tunnel.",
+                   [((), tx_bytes)])
+            metric("protonvpn_receive_bytes_per_second", "gauge", "Receive rate since the previous scrape.",
+                   [((), "{0:.1f}".format(self.counters.rx_rate))])
+            metric("protonvpn_transmit_bytes_per_second", "gauge", "Transmit rate since the previous scrape.",
+                   [((), "{0:.1f}".format(self.counters.tx_rate))])
+
+        history = self.metrics.get()
+        if history:
+            metric(
+                "protonvpn_connects_total", "counter", "Connection attempts by result.",
+                [((("result", result),), count) for result, count in sorted(history["connects"].items())]
+            )
+            metric("protonvpn_reconnects_total", "counter", "Connection attempts via reconnect.",
+                   [((), history["reconnects"])])
+            metric(
+                "protonvpn_revalidations_total", "counter",
+                "Revalidations of servers chosen from cached data by result.",
+                [((("result", result),), count) for result, count in sorted(history["revalidations"].items())]
+            )
+            histogram(
+                "protonvpn_connect_phase_duration_seconds", "Duration of connection phases.",
+                "phase", CONNECT_BUCKETS, history["phases"]
+            )
+            histogram(
+                "protonvpn_api_call_duration_seconds", "Duration of ProtonVPN API calls.",
+                "endpoint", API_BUCKETS, history["api_calls"]
+            )
+            histogram(
+                "protonvpn_lock_wait_seconds", "Time spent waiting for locks held by other invocations.",
+                "lock", LOCK_BUCKETS, history["lock_waits"]
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(host, port):
+    """Serve the metrics on http://host:port/metrics until interrupted"""
+
+    collector = MetricsCollector()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            body = collector.collect().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("Exporter: " + format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    logger.debug("Exporter listening on {0}:{1}".format(host, port))
+    print("Serving metrics on http://{0}:{1}/metrics".format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,244 @@
+# Standard Libraries
+import os
+import json
+import time
+import zlib
+import signal
+import subprocess
+import threading
+# ProtonVPN-CLI functions
+from .logger import logger
+from . import metrics
+# Constants
+from .constants import JOURNAL_FILE
+
+# JOURNAL_FILE is a write-ahead log of the changes made to the network
+# state. Before a change is applied, a line with the step that undoes it
+# is appended and synced, so a crash at any point leaves a journal that
+# can be rolled back. Undo steps are idempotent and describe the state
+# to go back to (a file's content, a ruleset), so replaying them again
+# after an interrupted rollback is safe.
+#
+# Lines are JSON objects:
+#   {"seq": 1, "begin": "connect", "pid": 123}  a connect started
+#   {"seq": 2, "kind": "dns", "undo": {...}}    a change is about to be made
+#   {"seq": 3, "commit": 1}                     the connect completed
+#   {"seq": 4, "undone": [2]}                   changes were rolled back
+
+# Kinds of changes
+DNS = "dns"
+IPV6 = "ipv6"
+KILLSWITCH = "killswitch"
+
+# Changes are applied by concurrent threads of a connect
+_lock = threading.RLock()
+
+
+def _read():
+    """Return the entries of the journal"""
+    entries = []
+    try:
+        with open(JOURNAL_FILE, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A line torn by a crash was never followed by its change
+                    continue
+    except OSError:
+        pass
+    return entries
+
+
+def _append(entry):
+    """Durably append an entry, return its sequence number"""
+    with _lock:
+        entries = _read()
+        entry = dict(entry, seq=entries[-1]["seq"] + 1 if entries else 1)
+        line = json.dumps(entry, separators=(",", ":")).encode() + b"\n"
+        with open(JOURNAL_FILE, "a+b") as f:
+            # Start a new line after a line torn by a crash
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        return entry["seq"]
+
+
+def _pending(entries):
+    """Return the change entries that weren't undone, oldest first"""
+    undone = set()
+    for entry in entries:
+        undone.update(entry.get("undone", []))
+    return [entry for entry in entries if "kind" in entry and entry["seq"] not in undone]
+
+
+def _in_progress(entries):
+    """Return True if a connect that didn't commit yet still runs"""
+    committed = {entry["commit"] for entry in entries if "commit" in entry}
+    for entry in entries:
+        if "begin" in entry and entry["seq"] not in committed:
+            try:
+                os.kill(entry["pid"], 0)
+            except ProcessLookupError:
+                continue
+            except PermissionError:
+                pass
+            return True
+    return False
+
+
+def record(kind, undo):
+    """Log a change of kind about to be applied together with its undo step"""
+    _append({"kind": kind, "undo": undo})
+    logger.debug("Journaled {0} change ({1})".format(kind, undo["action"]))
+
+
+def begin():
+    """Mark the start of a connect, its changes are rolled back if it never commits"""
+    return _append({"begin": "connect", "pid": os.getpid()})
+
+
+def commit(transaction):
+    """Mark the connect started by begin() as completed"""
+    _append({"commit": transaction})
+
+
+def is_active(kind):
+    """Return True if a change of kind is applied"""
+    return any(entry["kind"] == kind for entry in _pending(_read()))
+
+
+def needs_recovery():
+    """Return True if a connect of a process that no longer runs never committed"""
+    entries = _read()
+    committed = {entry["commit"] for entry in entries if "commit" in entry}
+    for entry in entries:
+        if "begin" in entry and entry["seq"] not in committed:
+            try:
+                os.kill(entry["pid"], 0)
+            except ProcessLookupError:
+                return bool(_pending(entries))
+            except PermissionError:
+                continue
+    return False
+
+
+def rollback(kinds=None):
+    """
+    Undo the applied changes of kinds (all by default) in one batch.
+
+    Only the oldest undo step per target is replayed, as it restores the
+    state from before all later changes. The journal is removed once
+    nothing is left to undo, unless a connect that didn't commit still
+    runs, as its begin entry has to stay. Returns the number of steps
+    replayed.
+    """
+    with _lock:
+        return _rollback(kinds)
+
+
+def _rollback(kinds):
+    start = time.monotonic()
+    entries = _read()
+    pending = [entry for entry in _pending(entries) if kinds is None or entry["kind"] in kinds]
+    if not pending:
+        if kinds is None and os.path.isfile(JOURNAL_FILE) and not _in_progress(entries):
+            os.remove(JOURNAL_FILE)
+        return 0
+
+    steps = {}
+    for entry in pending:
+        undo = entry["undo"]
+        target = undo.get("path") or undo.get("tool") or undo.get("pidfile")
+        steps.setdefault((undo["action"], target), undo)
+
+    # Newest first, in reverse of how the changes were applied
+    for undo in reversed(list(steps.values())):
+        UNDO_ACTIONS[undo["action"]](undo)
+
+    _append({"undone": [entry["seq"] for entry in pending]})
+    entries = _read()
+    if not _pending(entries) and not _in_progress(entries):
+        os.remove(JOURNAL_FILE)
+
+    duration = time.monotonic() - start
+    metrics.record_span("rollback", duration, steps=len(steps))
+    logger.debug("Rolled back {0} changes in {1} steps ({2:.3f}s)".format(len(pending), len(steps), duration))
+    return len(steps)
+
+
+def restore_file_step(path, original, changed):
+    """Return an undo step that restores path to original if it still is changed"""
+    return {
+        "action": "restore_file", "path": path, "content": original,
+        "crc": zlib.crc32(changed.encode()),
+    }
+
+
+def restore_rules_step(tool, rules):
+    """Return an undo step that loads rules (iptables-save output) with tool"""
+    return {"action": "restore_rules", "tool": tool, "rules": rules}
+
+
+def stop_process_step(pidfile, command):
+    """Return an undo step that stops the process in pidfile if it still runs command"""
+    return {"action": "stop_process", "pidfile": pidfile, "command": command}
+
+
+def _restore_file(undo):
+    try:
+        with open(undo["path"], "r") as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+
+    if current == undo["content"]:
+        return
+    # Don't restore an old configuration if it changed since, e.g. by switching networks
+    if current is not None and zlib.crc32(current.encode()) != undo["crc"]:
+        logger.debug("{0} changed. Not restoring.".format(undo["path"]))
+        return
+    with open(undo["path"], "w") as f:
+        f.write(undo["content"])
+    logger.debug("{0} restored".format(undo["path"]))
+
+
+def _restore_rules(undo):
+    restore = subprocess.run(
+        [undo["tool"]], input=undo["rules"].encode(),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if restore.returncode != 0:
+        logger.debug("{0} failed: {1}".format(undo["tool"], restore.stderr))
+    else:
+        logger.debug("Rules restored with {0}".format(undo["tool"]))
+
+
+def _stop_process(undo):
+    try:
+        with open(undo["pidfile"], "r") as f:
+            pid = int(f.read())
+    except (OSError, ValueError):
+        return
+
+    # The pid may have been reused after a reboot
+    try:
+        with open("/proc/{0}/cmdline".format(pid), "rb") as f:
+            running = undo["command"].encode() in f.read()
+    except OSError:
+        running = False
+    if running:
+        os.kill(pid, signal.SIGTERM)
+        logger.debug("Stopped {0} ({1})".format(undo["command"], pid))
+    os.remove(undo["pidfile"])
+
+
+UNDO_ACTIONS = {
+    "restore_file": _restore_file,
+    "restore_rules": _restore_rules,
+    "stop_process": _stop_process,
+}
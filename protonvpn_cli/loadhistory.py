@@ -0,0 +1,196 @@
+# Standard Libraries
+import os
+import json
+import time
+# ProtonVPN-CLI functions
+from .logger import logger
+# Constants
+from .constants import LOAD_HISTORY_FILE, LOAD_HISTORY_INDEX, LOAD_HISTORY_WEEKS
+
+# LOAD_HISTORY_FILE holds one row per hour for the last LOAD_HISTORY_WEEKS
+# weeks, rows are `width` bytes with the peak load of every server in that
+# hour. The index maps servers to columns and stores the last written hour.
+HOURS_PER_WEEK = 168
+SLOTS = LOAD_HISTORY_WEEKS * HOURS_PER_WEEK
+MIN_WIDTH = 1024
+EMPTY = 255
+
+
+def _read_index():
+    """Return the index or None if there is no valid store"""
+    try:
+        with open(LOAD_HISTORY_INDEX, "r") as f:
+            index = json.load(f)
+        # A resize may have been interrupted
+        if os.path.getsize(LOAD_HISTORY_FILE) != SLOTS * index["width"]:
+            logger.debug("Load history size mismatch, resetting")
+            return None
+        return index
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_index(index):
+    tmp_path = LOAD_HISTORY_INDEX + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(tmp_path, LOAD_HISTORY_INDEX)
+
+
+def _create(servers):
+    """Create an empty store for servers and return its index"""
+    width = MIN_WIDTH
+    while width < len(servers):
+        width *= 2
+    tmp_path = LOAD_HISTORY_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        row = bytes([EMPTY]) * width
+        for _ in range(SLOTS):
+            f.write(row)
+    os.replace(tmp_path, LOAD_HISTORY_FILE)
+    index = {"width": width, "last_hour": None, "servers": list(servers)}
+    _write_index(index)
+    return index
+
+
+def _resize(index, servers):
+    """
+    Rewrite the store with room for all servers.
+
+    Columns of other servers without any recorded load are dropped.
+    """
+    old_width = index["width"]
+    with open(LOAD_HISTORY_FILE, "rb") as f:
+        rows = [f.read(old_width) for _ in range(SLOTS)]
+
+    # OR together the rows mapped to 1 for recorded and 0 for empty columns
+    recorded = bytes([0 if value == EMPTY else 1 for value in range(256)])
+    mask = 0
+    for row in rows:
+        mask |= int.from_bytes(row.translate(recorded), "big")
+    mask = mask.to_bytes(old_width, "big")
+    used = [column for column in range(len(index["servers"])) if mask[column]]
+    names = [index["servers"][column] for column in used]
+    known = set(names)
+    names.extend(name for name in servers if name not in known)
+
+    width = MIN_WIDTH
+    while width < len(names):
+        width *= 2
+    logger.debug("Resizing load history from {0} to {1} columns".format(old_width, width))
+
+    tmp_path = LOAD_HISTORY_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for row in rows:
+            new_row = bytearray([EMPTY]) * width
+            for new_column, column in enumerate(used):
+                new_row[new_column] = row[column]
+            f.write(new_row)
+    os.replace(tmp_path, LOAD_HISTORY_FILE)
+
+    index["width"] = width
+    index["servers"] = names
+    _write_index(index)
+    return index
+
+
+def record(loads, now=None):
+    """
+    Record the current loads ({servername: load}) in the history.
+
+    Loads within the same hour are merged to their peak. Costs
+    O(servers), the first record after a pause additionally clears
+    the skipped hours.
+    """
+    hour = int((now if now is not None else time.time()) // 3600)
+
+    index = _read_index() or _create(loads)
+    last_hour = index["last_hour"]
+    if last_hour is not None and hour < last_hour:
+        logger.debug("Clock is behind the load history, not recording")
+        return
+
+    columns = {name: column for column, name in enumerate(index["servers"])}
+    new_servers = [name for name in loads if name not in columns]
+    if new_servers:
+        if len(columns) + len(new_servers) > index["width"]:
+            index = _resize(index, loads)
+        else:
+            index["servers"].extend(new_servers)
+        columns = {name: column for column, name in enumerate(index["servers"])}
+
+    width = index["width"]
+    with open(LOAD_HISTORY_FILE, "r+b") as f:
+        if hour == last_hour:
+            f.seek((hour % SLOTS) * width)
+            row = bytearray(f.read(width))
+        else:
+            # Rows of hours without a record would otherwise keep old data
+            if last_hour is not None:
+                empty = bytes([EMPTY]) * width
+                for skipped in range(max(last_hour + 1, hour - SLOTS + 1), hour):
+                    f.seek((skipped % SLOTS) * width)
+                    f.write(empty)
+            row = bytearray([EMPTY]) * width
+
+        for name, load in loads.items():
+            column = columns[name]
+            load = min(max(int(load), 0), 100)
+            if row[column] == EMPTY or load > row[column]:
+                row[column] = load
+
+        f.seek((hour % SLOTS) * width)
+        f.write(row)
+
+    index["last_hour"] = hour
+    _write_index(index)
+
+
+def forecast(loads, now=None):
+    """
+    Return {servername: predicted peak load in the next hour}.
+
+    The prediction is the current load plus the average change from
+    this hour to the next one on the same weekday in past weeks.
+    Servers without history for that are left out.
+    """
+    index = _read_index()
+    if index is None or index["last_hour"] is None:
+        return {}
+
+    hour = int((now if now is not None else time.time()) // 3600)
+    last_hour = index["last_hour"]
+    width = index["width"]
+    columns = {name: column for column, name in enumerate(index["servers"])}
+
+    def is_recorded(h):
+        return h <= last_hour and last_hour - h < SLOTS
+
+    week_rows = []
+    with open(LOAD_HISTORY_FILE, "rb") as f:
+        for weeks in range(1, LOAD_HISTORY_WEEKS + 1):
+            base = hour - weeks * HOURS_PER_WEEK
+            if not (is_recorded(base) and is_recorded(base + 1)):
+                continue
+            f.seek((base % SLOTS) * width)
+            base_row = f.read(width)
+            f.seek(((base + 1) % SLOTS) * width)
+            week_rows.append((base_row, f.read(width)))
+
+    if not week_rows:
+        return {}
+
+    predictions = {}
+    for name, load in loads.items():
+        column = columns.get(name)
+        if column is None:
+            continue
+        deltas = [
+            next_row[column] - base_row[column] for base_row, next_row in week_rows
+            if base_row[column] != EMPTY and next_row[column] != EMPTY
+        ]
+        if deltas:
+            predictions[name] = min(max(load + sum(deltas) / len(deltas), 0), 100)
+
+    logger.debug("Forecasted load of {0} servers from {1} weeks".format(len(predictions), len(week_rows)))
+    return predictions
@@ -0,0 +1,144 @@
+# Standard Libraries
+import os
+import time
+import fcntl
+import threading
+import contextlib
+# ProtonVPN-CLI functions
+from .logger import logger
+from . import metrics
+# Constants
+from .constants import CONFIG_LOCK_FILE, STATE_LOCK_FILE, LOCK_TIMEOUT
+
+
+class LockTimeout(Exception):
+    """Raised when a lock couldn't be taken within its timeout"""
+
+    def __init__(self, name):
+        super().__init__("Timed out waiting for the {0} lock".format(name))
+        self.name = name
+
+
+class FileLock():
+    """
+    Shared/exclusive flock on a lock file between processes.
+
+    Readers take the lock shared and don't block each other, state
+    changes take it exclusive. The lock is reentrant within a process:
+    flocks belong to the open file and not to a thread, so the threads
+    of a process take turns on an RLock and share one file. A shared
+    hold can't be upgraded by a nested exclusive one: flock converts a
+    lock by releasing it first, so another process could change the
+    state in between. Take the lock exclusive from the start instead.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._file = None
+        self._depth = 0
+        self._exclusive = False
+
+    @contextlib.contextmanager
+    def hold(self, exclusive=False, timeout=LOCK_TIMEOUT):
+        """
+        Hold the lock for the with block, yields whether it had to wait.
+
+        Raises LockTimeout after timeout seconds and RuntimeError for an
+        exclusive hold nested in a shared one. Waits are recorded as
+        "lock:<name>" spans.
+        """
+        start = time.monotonic()
+        if not self._thread_lock.acquire(timeout=timeout):
+            self._record_wait(start, exclusive, ok=False)
+            raise LockTimeout(self.name)
+        try:
+            if exclusive and self._depth and not self._exclusive:
+                raise RuntimeError("The {0} lock is held shared and can't be upgraded".format(self.name))
+            waited = False
+            if self._depth == 0:
+                try:
+                    waited = self._acquire(exclusive, start + timeout)
+                except LockTimeout:
+                    self._record_wait(start, exclusive, ok=False)
+                    raise
+            if waited or time.monotonic() - start > 0.01:
+                self._record_wait(start, exclusive, ok=True)
+            self._depth += 1
+            try:
+                yield waited
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._release()
+        finally:
+            self._thread_lock.release()
+
+    def _acquire(self, exclusive, deadline):
+        """Take the flock, return True if another process held it"""
+        self._exclusive = exclusive
+        if self._file is None:
+            try:
+                created = not os.path.exists(self.path)
+                # flock doesn't need write access, so users can share root's lock files
+                self._file = open(self.path, "a" if created else "r")
+                if created and os.geteuid() == 0:
+                    stat = os.stat(os.path.dirname(self.path))
+                    os.chown(self.path, stat.st_uid, stat.st_gid)
+            except OSError as e:
+                # Nothing to protect before the configuration is initialized
+                logger.debug("Couldn't open lock {0}: {1}".format(self.path, e))
+                return False
+
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self._file, operation | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            logger.debug("Waiting for the {0} lock".format(self.name))
+
+        delay = 0.005
+        while time.monotonic() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.1)
+            try:
+                fcntl.flock(self._file, operation | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                continue
+
+        self._release()
+        raise LockTimeout(self.name)
+
+    def _release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._exclusive = False
+
+    def _record_wait(self, start, exclusive, ok):
+        metrics.record_span(
+            "lock:{0}".format(self.name), time.monotonic() - start,
+            mode="exclusive" if exclusive else "shared", ok=ok
+        )
+
+
+def server_data_lock(path):
+    """Return the lock of the server cache at path, one per path and process"""
+    with _server_data_locks_lock:
+        if path not in _server_data_locks:
+            _server_data_locks[path] = FileLock("server data", path + ".lock")
+        return _server_data_locks[path]
+
+
+# Server caches, held exclusive while downloading so concurrent
+# refreshes of a shared cache wait for and reuse the first one
+_server_data_locks = {}
+_server_data_locks_lock = threading.Lock()
+# pvpn-cli.cfg, held briefly around every read and write
+config_lock = FileLock("config", CONFIG_LOCK_FILE)
+# Network state (OpenVPN, DNS, IPv6, Kill Switch and their backups),
+# held exclusive while connecting or disconnecting
+state_lock = FileLock("state", STATE_LOCK_FILE)
@@ -0,0 +1,144 @@
+# Standard Libraries
+import os
+import json
+import math
+import contextlib
+import time
+import threading
+# ProtonVPN-CLI functions
+from .logger import logger
+# Constants
+from .constants import CONFIG_DIR, METRICS_FILE, METRICS_MAX_RECORDS
+
+# Spans recorded by this process, written to METRICS_FILE by flush()
+_spans = []
+_tags = {}
+_lock = threading.Lock()
+_enabled = True
+
+
+def disable():
+    """Stop recording spans in this process"""
+    global _enabled
+    _enabled = False
+
+
+def set_tags(**tags):
+    """Set tags that are added to every following span, e.g. the command"""
+    with _lock:
+        _tags.update(tags)
+
+
+def record_span(name, duration, **tags):
+    """Record a timing span of duration seconds"""
+    if not _enabled:
+        return
+    record = {"t": int(time.time()), "span": name, "dur": round(duration, 4)}
+    with _lock:
+        record.update(_tags)
+        record.update(tags)
+        _spans.append(record)
+
+
+@contextlib.contextmanager
+def span(name, **tags):
+    """Record the duration of the with block as a span"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_span(name, time.monotonic() - start, **tags)
+
+
+def flush():
+    """
+    Append the recorded spans to METRICS_FILE.
+
+    The file is a bounded ring: once it grows beyond roughly twice
+    METRICS_MAX_RECORDS spans, only the newest METRICS_MAX_RECORDS are kept.
+    """
+    with _lock:
+        spans = list(_spans)
+        del _spans[:]
+
+    # The configuration may have been purged
+    if not spans or not os.path.isdir(CONFIG_DIR):
+        return
+
+    try:
+        with open(METRICS_FILE, "a") as f:
+            for s in spans:
+                f.write(json.dumps(s, separators=(",", ":")) + "\n")
+
+        # Spans are around 100 bytes each
+        if os.path.getsize(METRICS_FILE) > METRICS_MAX_RECORDS * 200:
+            records = read_records()
+            if len(records) > METRICS_MAX_RECORDS:
+                with open(METRICS_FILE + ".tmp", "w") as f:
+                    for s in records[-METRICS_MAX_RECORDS:]:
+                        f.write(json.dumps(s, separators=(",", ":")) + "\n")
+                os.replace(METRICS_FILE + ".tmp", METRICS_FILE)
+    except OSError as e:
+        logger.debug("Couldn't write metrics: {0}".format(e))
+
+
+def read_records():
+    """Return all spans stored in METRICS_FILE"""
+    records = []
+    try:
+        with open(METRICS_FILE, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Skip lines of an interrupted write
+                    continue
+    except OSError:
+        pass
+    return records
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of values"""
+    values = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100 * len(values))))
+    return values[rank - 1]
+
+
+def summarize(records):
+    """
+    Return count, p50 and p95 per span and of connects per server.
+
+    Also counts how often revalidating cached server data changed the server.
+    """
+
+    def summary(durations):
+        return {
+            "count": len(durations),
+            "p50": percentile(durations, 50),
+            "p95": percentile(durations, 95),
+        }
+
+    phases = {}
+    servers = {}
+    revalidations = {"count": 0, "changed": 0}
+    for record in records:
+        phases.setdefault(record["span"], []).append(record["dur"])
+        if record["span"] == "connect" and record.get("server"):
+            servers.setdefault(record["server"], []).append(record)
+        elif record["span"] == "revalidate":
+            revalidations["count"] += 1
+            revalidations["changed"] += 1 if record.get("changed") else 0
+
+    server_summary = {}
+    for server, connects in servers.items():
+        server_summary[server] = summary([c["dur"] for c in connects])
+        server_summary[server]["success_rate"] = round(
+            sum(1 for c in connects if c.get("ok")) / len(connects), 3
+        )
+
+    return {
+        "phases": {name: summary(durations) for name, durations in phases.items()},
+        "servers": server_summary,
+        "revalidations": revalidations,
+    }
@@ -0,0 +1,86 @@
+# Standard Libraries
+import os
+import re
+import json
+import time
+# ProtonVPN-CLI functions
+from .logger import logger
+# Constants
+from .constants import QUARANTINE_FILE, QUARANTINE_TTL
+
+# Remotes OpenVPN tried, e.g. "UDP link remote: [AF_INET]185.159.157.1:1194"
+# or "Attempting to establish TCP connection with [AF_INET]185.159.157.1:443"
+REMOTE_RE = re.compile(r"(?:link remote|connection with):? \[AF_INET\](\d{1,3}(?:\.\d{1,3}){3}):\d+")
+# Remote the tunnel was established with
+PEER_RE = re.compile(r"Peer Connection Initiated with \[AF_INET\](\d{1,3}(?:\.\d{1,3}){3}):\d+")
+
+
+def _load():
+    """Return the unexpired entries of QUARANTINE_FILE"""
+    try:
+        with open(QUARANTINE_FILE, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+
+    now = time.time()
+    return {
+        kind: {key: until for key, until in data.get(kind, {}).items() if until > now}
+        for kind in ["servers", "entry_ips"]
+    }
+
+
+def add(servers=(), entry_ips=(), ttl=QUARANTINE_TTL):
+    """Quarantine logical servers (by name) and entry IPs for ttl seconds"""
+    data = _load()
+    until = int(time.time() + ttl)
+    for kind, keys in [("servers", servers), ("entry_ips", entry_ips)]:
+        for key in keys:
+            data[kind][key] = max(data[kind].get(key, 0), until)
+            logger.debug("Quarantined {0} until {1}".format(key, until))
+
+    tmp_path = "{0}.{1}.tmp".format(QUARANTINE_FILE, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, QUARANTINE_FILE)
+
+
+def filter_servers(servers):
+    """
+    Return the servers that aren't quarantined.
+
+    Servers whose entry IPs are all quarantined count as quarantined.
+    If every server is quarantined, all of them are returned.
+    """
+    data = _load()
+    if not data["servers"] and not data["entry_ips"]:
+        return servers
+
+    available = [
+        server for server in servers
+        if server.name not in data["servers"]
+        and not (server.servers and all(s.entry_ip in data["entry_ips"] for s in server.servers))
+    ]
+    if not available:
+        logger.debug("All servers are quarantined, ignoring quarantine")
+        return servers
+    logger.debug("Excluded {0} quarantined servers".format(len(servers) - len(available)))
+    return available
+
+
+def filter_entry_ips(entry_ips):
+    """Return the entry IPs that aren't quarantined, all if every one is"""
+    quarantined = _load()["entry_ips"]
+    available = [ip for ip in entry_ips if ip not in quarantined]
+    return available or entry_ips
+
+
+def get_failed_remotes(log):
+    """Return the remote IPs OpenVPN tried to connect to in an OpenVPN log"""
+    return sorted(set(REMOTE_RE.findall(log)))
+
+
+def get_peer(log):
+    """Return the remote IP the tunnel was established with or None"""
+    match = PEER_RE.search(log)
+    return match.group(1) if match else None
@@ -0,0 +1,340 @@
+# Standard Libraries
+import math
+import heapq
+import random
+from array import array
+# ProtonVPN-CLI functions
+from .logger import logger
+from . import metrics
+
+# NumPy is optional, columns fall back to array.array and plain loops
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Ranking criteria, for all of them lower values are better
+CRITERIA = ("load", "score", "rtt", "distance", "success")
+DEFAULT_WEIGHTS = "score:1,load:0.25,rtt:1,distance:0,success:0.5"
+EARTH_RADIUS_KM = 6371.0
+# Size of the GeoGrid cells in degrees
+GRID_CELL_DEGREES = 5
+NAN = float("nan")
+
+
+def parse_weights(value):
+    """Parse 'criterion:weight,...' into a dict, raise ValueError if invalid"""
+    weights = dict.fromkeys(CRITERIA, 0.0)
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        criterion, weight = item.split(":")
+        criterion = criterion.strip().lower()
+        if criterion not in CRITERIA:
+            raise ValueError("Unknown ranking criterion {0}".format(criterion))
+        weights[criterion] = float(weight)
+        if weights[criterion] < 0 or math.isnan(weights[criterion]):
+            raise ValueError("Invalid weight for {0}".format(criterion))
+    return weights
+
+
+def format_weights(weights):
+    """Inverse of parse_weights()"""
+    return ",".join("{0}:{1:g}".format(c, weights[c]) for c in CRITERIA)
+
+
+def get_success_rates():
+    """Return {servername: connect success rate} of the recorded connects"""
+    attempts = {}
+    for record in metrics.read_records():
+        if record["span"] == "connect" and record.get("server"):
+            total, ok = attempts.get(record["server"], (0, 0))
+            attempts[record["server"]] = (total + 1, ok + (1 if record.get("ok") else 0))
+    return {server: ok / total for server, (total, ok) in attempts.items()}
+
+
+def _column(values, count):
+    """Return a float column of an iterable, None becomes NaN"""
+    values = (NAN if v is None else v for v in values)
+    if np is not None:
+        return np.fromiter(values, dtype=np.float64, count=count)
+    return array("d", values)
+
+
+def _normalized(column):
+    """
+    Scale a column to 0..1, missing values (NaN) become 0.5.
+
+    Returns None if no value is known. A column of equal values, e.g. a
+    single known one, says nothing about which server is better and is
+    all 0.5, so servers with data don't rank ahead of those without.
+    """
+    if np is not None:
+        missing = np.isnan(column)
+        if missing.all():
+            return None
+        low = column[~missing].min()
+        spread = column[~missing].max() - low
+        if not spread:
+            return np.full(len(column), 0.5)
+        scaled = (column - low) / spread
+        scaled[missing] = 0.5
+        return scaled
+
+    known = [v for v in column if not math.isnan(v)]
+    if not known:
+        return None
+    low = min(known)
+    spread = max(known) - low
+    if not spread:
+        return array("d", [0.5]) * len(column)
+    return array("d", (0.5 if math.isnan(v) else (v - low) / spread for v in column))
+
+
+class ServerTable():
+    """
+    Columnar view of a list of LogicalServer for ranking.
+
+    Columns are NumPy arrays if NumPy is installed and array.array
+    otherwise, with NaN for unknown values.
+    """
+
+    def __init__(self, servers):
+        self.servers = servers
+        count = len(servers)
+        self.load = _column((s.load for s in servers), count)
+        self.score = _column((s.score for s in servers), count)
+        self.lat = _column((s.lat for s in servers), count)
+        self.long = _column((s.long for s in servers), count)
+        # Built on the first nearest() query
+        self.grid = None
+
+    def __len__(self):
+        return len(self.servers)
+
+    def lookup(self, values):
+        """Return a column of values[servername], NaN for missing servers"""
+        return _column((values.get(s.name) for s in self.servers), len(self))
+
+    def merged_load(self, loads):
+        """Return the load column with the values of loads where known"""
+        known = self.lookup(loads)
+        if np is not None:
+            return np.where(np.isnan(known), self.load, known)
+        return array("d", (c if math.isnan(k) else k for k, c in zip(known, self.load)))
+
+    def distances(self, lat, long, indices=None):
+        """
+        Return a column of great-circle distances in km to lat, long.
+
+        With indices, only the distances of these rows are computed.
+        """
+        lats, longs = self.lat, self.long
+        if indices is not None:
+            if np is not None:
+                indices = np.asarray(indices, dtype=np.intp)
+                lats, longs = lats[indices], longs[indices]
+            else:
+                lats = array("d", (lats[idx] for idx in indices))
+                longs = array("d", (longs[idx] for idx in indices))
+
+        lat1 = math.radians(lat)
+        if np is not None:
+            lat2 = np.radians(lats)
+            dlat = lat2 - lat1
+            dlong = np.radians(longs) - math.radians(long)
+            a = np.sin(dlat / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlong / 2) ** 2
+            return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+        def haversine(lat2, long2):
+            lat2 = math.radians(lat2)
+            dlong = math.radians(long2 - long)
+            a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlong / 2) ** 2
+            return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+        return array("d", (haversine(lt, lg) for lt, lg in zip(lats, longs)))
+
+    def nearest(self, lat, long, count):
+        """Return the indices of the count servers nearest to lat, long"""
+        if self.grid is None:
+            self.grid = GeoGrid(self.lat, self.long)
+        return self.grid.nearest(lat, long, count, self.distances)
+
+    def costs(self, weights, rtts=None, success_rates=None, origin=None, loads=None):
+        """
+        Return the weighted cost of every server, lower is better.
+
+        Every criterion is scaled to 0..1 over the table first, so the
+        costs are in 0..1 as well. Criteria without any data (no rtts,
+        no origin, ...) are left out and their weight is ignored.
+        loads, e.g. forecasts, replace the current load of servers.
+        """
+        columns = {
+            "load": lambda: self.merged_load(loads) if loads else self.load,
+            "score": lambda: self.score,
+            "rtt": lambda: self.lookup(rtts) if rtts else None,
+            "distance": lambda: self.distances(*origin) if origin else None,
+            # Higher success rates are better
+            "success": lambda: self.lookup(
+                {name: 1 - rate for name, rate in success_rates.items()}
+            ) if success_rates else None,
+        }
+
+        total_weight = 0.0
+        costs = np.zeros(len(self)) if np is not None else array("d", bytes(8 * len(self)))
+        for criterion in CRITERIA:
+            weight = weights.get(criterion, 0)
+            if not weight:
+                continue
+            column = columns[criterion]()
+            scaled = _normalized(column) if column is not None else None
+            if scaled is None:
+                logger.debug("No data to rank by {0}".format(criterion))
+                continue
+            total_weight += weight
+            if np is not None:
+                costs += weight * scaled
+            else:
+                for idx, value in enumerate(scaled):
+                    costs[idx] += weight * value
+
+        if not total_weight:
+            return costs
+        if np is not None:
+            return costs / total_weight
+        return array("d", (c / total_weight for c in costs))
+
+
+class GeoGrid():
+    """
+    Spatial index of coordinates in cells of GRID_CELL_DEGREES.
+
+    Nearest neighbour queries search the cells in rings around the
+    origin and stop once no unsearched cell can hold a closer point.
+    Rows without coordinates aren't indexed.
+    """
+
+    def __init__(self, lats, longs, cell=GRID_CELL_DEGREES):
+        self.cell = cell
+        self.rows = int(180 // cell) + 1
+        self.columns = int(math.ceil(360 / cell))
+        self.cells = {}
+        self.size = 0
+
+        if np is None:
+            for idx, (lat, long) in enumerate(zip(lats, longs)):
+                if math.isnan(lat) or math.isnan(long):
+                    continue
+                self.cells.setdefault(self._cell(lat, long), []).append(idx)
+                self.size += 1
+            return
+
+        # Sort the rows by cell and split them into runs of the same cell
+        indices = np.flatnonzero(~(np.isnan(lats) | np.isnan(longs)))
+        keys = (
+            ((lats[indices] + 90) // cell).astype(np.intp) * self.columns
+            + (((longs[indices] + 180) % 360) // cell).astype(np.intp)
+        )
+        order = np.argsort(keys, kind="stable")
+        keys, indices = keys[order], indices[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]).tolist()
+        for start, end in zip(starts, starts[1:] + [len(keys)]):
+            self.cells[divmod(int(keys[start]), self.columns)] = indices[start:end].tolist()
+        self.size = len(indices)
+
+    def _cell(self, lat, long):
+        return int((lat + 90) // self.cell), int(((long + 180) % 360) // self.cell)
+
+    def _ring(self, row, column, radius):
+        """Yield the cells radius cells away from row, column"""
+        for r in range(max(0, row - radius), min(self.rows, row + radius + 1)):
+            if abs(r - row) == radius:
+                columns = range(column - radius, column + radius + 1)
+            else:
+                columns = (column - radius, column + radius)
+            for c in columns:
+                # Columns wrap around at the antimeridian
+                yield r, c % self.columns
+
+    def _lower_bound(self, lat, radius):
+        """Return a lower bound in km of points more than radius cells away"""
+        degrees = radius * self.cell
+        # Points in other rows are at least this far north or south
+        by_lat = math.radians(degrees) * EARTH_RADIUS_KM
+        if degrees >= 180:
+            return by_lat
+        # Points in the same rows but other columns, at most this far from the equator
+        max_lat = min(90.0, abs(lat) + (radius + 1) * self.cell)
+        factor = math.cos(math.radians(lat)) * math.cos(math.radians(max_lat))
+        by_long = 2 * EARTH_RADIUS_KM * math.asin(
+            min(1.0, math.sqrt(max(0.0, factor)) * math.sin(math.radians(degrees) / 2))
+        )
+        return min(by_lat, by_long)
+
+    def nearest(self, lat, long, count, distances):
+        """
+        Return the indices of the count nearest points, nearest first.
+
+        distances(lat, long, indices) returns the distance column of indices.
+        """
+        count = min(count, self.size)
+        if count <= 0:
+            return []
+        row, column = self._cell(lat, long)
+        found = []
+        found_dist = []
+        visited = set()
+        for radius in range(max(self.rows, self.columns) + 1):
+            new = []
+            for cell in self._ring(row, column, radius):
+                if cell not in visited:
+                    visited.add(cell)
+                    new.extend(self.cells.get(cell, []))
+            if new:
+                found.extend(new)
+                found_dist.extend(distances(lat, long, new).tolist())
+            if len(found) < count:
+                continue
+            kth = heapq.nsmallest(count, found_dist)[-1]
+            if kth <= self._lower_bound(lat, radius):
+                break
+        order = sorted(range(len(found)), key=found_dist.__getitem__)
+        return [found[idx] for idx in order[:count]]
+
+
+def rank_servers(servers, weights, tolerance, nearest=None, **kwargs):
+    """
+    Return the servers whose cost is within tolerance of the best one.
+
+    With nearest, only that many servers nearest to the origin are
+    ranked. kwargs are passed on to ServerTable.costs().
+    """
+    table = ServerTable(servers)
+    if nearest:
+        lat, long = kwargs["origin"]
+        servers = [servers[idx] for idx in table.nearest(lat, long, nearest)]
+        table = ServerTable(servers)
+    if not servers:
+        return []
+
+    costs = table.costs(weights, **kwargs)
+    if np is not None:
+        best = costs.min()
+        candidates = np.flatnonzero(costs <= best + tolerance).tolist()
+    else:
+        best = min(costs)
+        candidates = [idx for idx, cost in enumerate(costs) if cost <= best + tolerance]
+    return [servers[idx] for idx in candidates]
+
+
+def select_server(servers, weights, tolerance, **kwargs):
+    """Return a random server among the best ranked ones, None if there is none"""
+    candidates = rank_servers(servers, weights, tolerance, **kwargs)
+    logger.debug(
+        "Selecting from {0} of {1} servers ({2})".format(
+            len(candidates), len(servers), "numpy" if np is not None else "array"
+        )
+    )
+    if not candidates:
+        return None
+    return random.choice(candidates)
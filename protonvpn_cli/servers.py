@@ -0,0 +1,206 @@
+# Standard Libraries
+import sys
+import re
+import json
+import codecs
+
+# ProtonVPN Features (bitmask)
+FEATURE_NORMAL = 0
+FEATURE_SECURE_CORE = 1
+FEATURE_TOR = 2
+FEATURE_P2P = 4
+
+# ProtonVPN Tiers
+TIER_FREE = 0
+TIER_BASIC = 1
+TIER_PLUS = 2
+
+# Server Status
+STATUS_OFFLINE = 0
+STATUS_ONLINE = 1
+
+
+class PhysicalServer():
+    """A physical server (entry node) of a logical server"""
+
+    __slots__ = ("entry_ip", "exit_ip", "status")
+
+    def __init__(self, entry_ip, exit_ip, status):
+        self.entry_ip = entry_ip
+        self.exit_ip = exit_ip
+        self.status = status
+
+
+class LogicalServer():
+    """A logical ProtonVPN server as listed by /vpn/logicals"""
+
+    __slots__ = (
+        "id", "name", "entry_country", "exit_country", "city", "tier",
+        "features", "status", "load", "score", "lat", "long", "servers",
+    )
+
+    def __init__(self, data):
+        location = data.get("Location") or {}
+        # Countries and cities repeat across thousands of servers
+        self.id = data.get("ID")
+        self.name = data["Name"]
+        self.entry_country = sys.intern(data["EntryCountry"]) if data.get("EntryCountry") else None
+        self.exit_country = sys.intern(data["ExitCountry"])
+        self.city = sys.intern(data["City"]) if data.get("City") else None
+        self.tier = int(data["Tier"])
+        self.features = int(data["Features"])
+        self.status = int(data["Status"])
+        self.load = int(data["Load"])
+        self.score = float(data["Score"])
+        self.lat = location.get("Lat")
+        self.long = location.get("Long")
+        self.servers = tuple(
+            PhysicalServer(s["EntryIP"], s.get("ExitIP"), int(s.get("Status", STATUS_ONLINE)))
+            for s in data.get("Servers", [])
+        )
+
+    def __repr__(self):
+        return "<LogicalServer {0}>".format(self.name)
+
+
+class ServerIndex():
+    """
+    Bitsets of the servers per exit country and per feature.
+
+    Bit i of a bitset is set if servers[i] is part of it, so filters
+    combine with integer AND/OR instead of scanning all servers.
+    """
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.all = (1 << len(servers)) - 1
+        self.by_country = {}
+        self.by_feature = {
+            feature: 0 for feature in [FEATURE_SECURE_CORE, FEATURE_TOR, FEATURE_P2P]
+        }
+
+        by_country = {}
+        by_feature = {feature: [] for feature in self.by_feature}
+        for idx, server in enumerate(servers):
+            by_country.setdefault(server.exit_country, []).append(idx)
+            for feature in by_feature:
+                if server.features & feature:
+                    by_feature[feature].append(idx)
+        for country, indices in by_country.items():
+            self.by_country[country] = _to_bitset(indices)
+        for feature, indices in by_feature.items():
+            self.by_feature[feature] = _to_bitset(indices)
+
+    def select(self, countries=None, features=FEATURE_NORMAL, excluded_features=FEATURE_NORMAL):
+        """
+        Return the servers in any of countries with all of the features.
+
+        Servers with any of excluded_features that weren't asked for are
+        left out. countries=None matches every country.
+        """
+        if countries is None:
+            bitset = self.all
+        else:
+            bitset = 0
+            for country in countries:
+                bitset |= self.by_country.get(country, 0)
+
+        for feature, feature_bitset in self.by_feature.items():
+            if features & feature:
+                bitset &= feature_bitset
+            elif excluded_features & feature:
+                bitset &= ~feature_bitset
+
+        return [self.servers[idx] for idx in _from_bitset(bitset)]
+
+
+def _to_bitset(indices):
+    """Return an int with the bits of indices set"""
+    bits = bytearray(b"0") * (max(indices) + 1 if indices else 1)
+    for idx in indices:
+        bits[idx] = ord("1")
+    return int(bits[::-1], 2)
+
+
+def _from_bitset(bitset):
+    """Return the indices of the set bits of bitset, ascending"""
+    # Scanning the binary string is much faster than shifting big ints
+    bits = bin(bitset)[:1:-1]
+    indices = []
+    idx = bits.find("1")
+    while idx != -1:
+        indices.append(idx)
+        idx = bits.find("1", idx + 1)
+    return indices
+
+
+def iter_json_array(chunks, key):
+    """
+    Yield the items of the array stored under key in a JSON document.
+
+    chunks is an iterable of bytes. Items are decoded one at a time as
+    soon as they are complete, so only the current chunk and item are
+    held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = None
+    key_pattern = re.compile(r'"{0}"\s*:\s*\['.format(re.escape(key)))
+
+    def read_more():
+        """Append the next chunk to buffer, return False at the end"""
+        nonlocal buffer
+        for chunk in chunks:
+            if chunk:
+                buffer += text_decoder.decode(chunk)
+                return True
+        buffer += text_decoder.decode(b"", final=True)
+        return False
+
+    # Find the start of the array
+    while pos is None:
+        match = key_pattern.search(buffer)
+        if match:
+            pos = match.end()
+            break
+        # Keep enough of the tail for a key split across chunks
+        buffer = buffer[-(len(key) + 64):]
+        if not read_more():
+            raise ValueError("{0} not found".format(key))
+
+    while True:
+        # Skip whitespace and separators between items
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                break
+            buffer, pos = "", 0
+            if not read_more():
+                raise ValueError("Unterminated array {0}".format(key))
+
+        if buffer[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # Incomplete item, drop what's been consumed and read on
+            buffer, pos = buffer[pos:], 0
+            if not read_more():
+                raise
+            continue
+
+        yield item
+        pos = end
+
+
+def load_servers(path):
+    """Return a list of LogicalServer from the server cache at path"""
+    with open(path, "rb") as f:
+        return [
+            LogicalServer(data)
+            for data in iter_json_array(iter(lambda: f.read(65536), b""), "LogicalServers")
+        ]
@@ -0,0 +1,86 @@
+# Standard Libraries
+import os
+import time
+# ProtonVPN-CLI functions
+from .logger import logger
+
+SYSFS_NET = "/sys/class/net"
+
+
+def get_vpn_interface():
+    """Return the name of the VPN interface or None if it doesn't exist"""
+    for interface in ["proton0", "tun0"]:
+        if os.path.isfile(os.path.join(SYSFS_NET, interface, "statistics", "rx_bytes")):
+            return interface
+    return None
+
+
+class InterfaceCounters():
+    """
+    Transfer counters of the VPN interface.
+
+    The sysfs statistics files are kept open and read with os.pread, so
+    sampling costs two syscalls. They're reopened once the interface is
+    removed and created again.
+    """
+
+    def __init__(self):
+        self.interface = None
+        self.fds = None
+        self.last_sample = None
+        self.rx_rate = 0.0
+        self.tx_rate = 0.0
+
+    def _open(self, interface):
+        self.close()
+        path = os.path.join(SYSFS_NET, interface, "statistics")
+        self.fds = (
+            os.open(os.path.join(path, "rx_bytes"), os.O_RDONLY),
+            os.open(os.path.join(path, "tx_bytes"), os.O_RDONLY),
+        )
+        self.interface = interface
+        logger.debug("Opened counters of {0}".format(interface))
+
+    def close(self):
+        """Close the statistics files"""
+        if self.fds:
+            for fd in self.fds:
+                os.close(fd)
+        self.interface = None
+        self.fds = None
+        self.last_sample = None
+        self.rx_rate = 0.0
+        self.tx_rate = 0.0
+
+    def sample(self):
+        """
+        Return (rx_bytes, tx_bytes) or None if there is no VPN interface.
+
+        Updates rx_rate and tx_rate in bytes per second since the
+        previous sample.
+        """
+        if self.fds is None:
+            interface = get_vpn_interface()
+            if interface is None:
+                self.close()
+                return None
+            self._open(interface)
+
+        try:
+            rx_bytes = int(os.pread(self.fds[0], 32, 0))
+            tx_bytes = int(os.pread(self.fds[1], 32, 0))
+        except (OSError, ValueError):
+            # Reads fail once the interface has been removed
+            self.close()
+            return None
+
+        now = time.monotonic()
+        if self.last_sample:
+            last_time, last_rx, last_tx = self.last_sample
+            elapsed = now - last_time
+            if elapsed > 0 and rx_bytes >= last_rx and tx_bytes >= last_tx:
+                self.rx_rate = (rx_bytes - last_rx) / elapsed
+                self.tx_rate = (tx_bytes - last_tx) / elapsed
+        self.last_sample = (now, rx_bytes, tx_bytes)
+
+        return rx_bytes, tx_bytes
@@ -0,0 +1,87 @@
+# Standard Libraries
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+# External Libraries
+import requests
+# ProtonVPN-CLI functions
+from .logger import logger
+# Constants
+from .constants import VERSION, UPDATE_CHECK_FILE, UPDATE_CHECK_TIMEOUT
+
+# Update checks run in a detached process that stores the latest version
+# in UPDATE_CHECK_FILE, the next command reads it from there. So a slow
+# or unreachable PyPI never delays a command.
+
+PYPI_URL = "https://pypi.org/pypi/protonvpn-cli/json"
+
+
+def read_cache():
+    """Return the stored result of the last update check"""
+    try:
+        with open(UPDATE_CHECK_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache):
+    tmp_path = "{0}.{1}.tmp".format(UPDATE_CHECK_FILE, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    # Written by root on behalf of the user that owns the config
+    if os.geteuid() == 0:
+        stat = os.stat(os.path.dirname(UPDATE_CHECK_FILE))
+        os.chown(tmp_path, stat.st_uid, stat.st_gid)
+    os.replace(tmp_path, UPDATE_CHECK_FILE)
+
+
+def is_newer(version, current=VERSION):
+    """Return True if version is newer than current"""
+    try:
+        return [int(i) for i in version.split(".")] > [int(i) for i in current.split(".")]
+    except ValueError:
+        return False
+
+
+def fetch_latest_version(timeout=UPDATE_CHECK_TIMEOUT):
+    """Return the latest version from pypi, None on errors"""
+    logger.debug("Calling pypi API")
+    try:
+        r = requests.get(PYPI_URL, timeout=timeout)
+        r.raise_for_status()
+        return r.json()["info"]["version"]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.debug("Couldn't get the latest version from pypi: {0}".format(e))
+        return None
+
+
+def start_check():
+    """Run an update check in a detached process"""
+    subprocess.Popen(
+        [sys.executable, "-m", "protonvpn_cli.updates"], start_new_session=True,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    logger.debug("Update check started in the background")
+
+
+def main():
+    # Make sure the process ends even if DNS resolution hangs
+    signal.alarm(2 * UPDATE_CHECK_TIMEOUT)
+
+    latest = fetch_latest_version()
+    if latest is None:
+        return
+    logger.debug("Latest version: {0}".format(latest))
+
+    cache = read_cache()
+    # Every new result is shown once
+    cache.update(latest=latest, checked=int(time.time()), notified=False)
+    write_cache(cache)
+
+
+if __name__ == "__main__":
+    main()
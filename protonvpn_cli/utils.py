@@ -6,23 +6,49 @@ import time
 import json
 import subprocess
 import re
-import random
 import ipaddress
 import math
+import hashlib
+import shutil
+import stat
+import multiprocessing
+import socket
+import selectors
+import select
+import errno
+import concurrent.futures
 # External Libraries
 import requests
 from jinja2 import Environment, FileSystemLoader
 # ProtonVPN-CLI functions
 from .logger import logger
+from . import metrics
+from . import ranking
+from . import loadhistory
+from . import quarantine
+from . import locks
+from . import updates
+from .servers import iter_json_array, load_servers, STATUS_ONLINE
 # Constants
 from .constants import (
     USER, CONFIG_FILE, SERVER_INFO_FILE, SPLIT_TUNNEL_FILE,
-    VERSION, OVPN_FILE
+    OVPN_FILE, PERFORMANCE_PROFILES, PMTU_CACHE_FILE,
+    PMTU_CACHE_TTL, OVPN_CACHE_DIR, OVPN_CACHE_SIZE, TEMPLATE_DIR,
+    OPENVPN_PORTS, OPENVPN_PID_FILE, RANKING_TOLERANCE, PROXIMITY_POOL_SIZE, VERSION,
+    LOCATION_TTL, LOAD_HISTORY_FILE, LOAD_HISTORY_INDEX, RTT_CACHE_FILE,
+    RTT_CACHE_TTL, RTT_PROBE_PORT, RTT_PROBE_TIMEOUT, SERVER_POLL_TIMEOUT,
+    SERVER_CACHE_LOCK_TIMEOUT, SERVER_REFRESH_TIMEOUT, NETWORK_PROBE_BACKOFF_START,
+    NETWORK_PROBE_BACKOFF_MAX, EXPORT_OPENVPN_CAPABILITIES
 )
 
 
-def call_api(endpoint, json_format=True, handle_errors=True):
-    """Call to the ProtonVPN API."""
+def call_api(endpoint, json_format=True, handle_errors=True, stream=False, timeout=None):
+    """
+    Call to the ProtonVPN API.
+
+    With stream=True the body isn't downloaded before returning,
+    use it together with json_format=False.
+    """
 
     api_domain = get_config_value("USER", "api_domain").rstrip("/")
     url = api_domain + endpoint
@@ -37,11 +63,13 @@ def call_api(endpoint, json_format=True, handle_errors=True):
 
     # For manual error handling, such as in wait_for_network()
     if not handle_errors:
-        response = requests.get(url, headers=headers)
+        with metrics.span("api:{0}".format(endpoint)):
+            response = requests.get(url, headers=headers, stream=stream, timeout=timeout)
         return response
 
     try:
-        response = requests.get(url, headers=headers)
+        with metrics.span("api:{0}".format(endpoint)):
+            response = requests.get(url, headers=headers, stream=stream, timeout=timeout)
     except (requests.exceptions.ConnectionError,
             requests.exceptions.ConnectTimeout):
         print(
@@ -69,73 +97,295 @@ def call_api(endpoint, json_format=True, handle_errors=True):
         return response
 
 
-def pull_server_data(force=False):
-    """Pull current server data from the ProtonVPN API."""
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+def get_server_info_file():
+    """Return the path of the server cache, shared if server_cache_dir is set"""
+    try:
+        cache_dir = get_config_value("USER", "server_cache_dir")
+    except KeyError:
+        cache_dir = "None"
+    if cache_dir == "None":
+        return SERVER_INFO_FILE
+    return os.path.join(cache_dir, os.path.basename(SERVER_INFO_FILE))
+
+
+def is_server_data_fresh(path, max_age):
+    """Return True if the server cache at path is younger than max_age seconds"""
+    try:
+        return time.time() - os.path.getmtime(path) <= max_age
+    except OSError:
+        return False
+
+
+def pull_server_data(force=False, quiet=False):
+    """
+    Pull current server data from the ProtonVPN API.
+
+    Refreshes are single-flight: concurrent invocations wait for the
+    lock of the one that is downloading and use its result, which is
+    published by an atomic rename. Returns True if the data was
+    refreshed. With quiet, errors are only logged, e.g. for a refresh
+    in the background. Raises LockTimeout if another refresh holds the
+    lock for longer than SERVER_CACHE_LOCK_TIMEOUT.
+    """
+    server_info_file = get_server_info_file()
+    shared = server_info_file != SERVER_INFO_FILE
 
     if not force:
         # Check if last server pull happened within the last 15 min (900 sec)
-        if int(time.time()) - int(config["metadata"]["last_api_pull"]) <= 900:
+        if is_server_data_fresh(server_info_file, 900):
             logger.debug("Last server pull within 15mins")
-            return
+            return False
 
-    data = call_api("/vpn/logicals")
+    cache_dir = os.path.dirname(server_info_file)
+    if shared and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, mode=0o755)
+    if shared and not (
+        os.access(cache_dir, os.W_OK)
+        and (not os.path.exists(server_info_file) or os.access(server_info_file, os.W_OK))
+    ):
+        # E.g. 'status' without root, the next connect refreshes it
+        logger.debug("Shared server cache isn't writable, not refreshing")
+        return False
 
-    with open(SERVER_INFO_FILE, "w") as f:
-        json.dump(data, f)
-        logger.debug("SERVER_INFO_FILE written")
+    requested = time.time()
+    lock = locks.server_data_lock(server_info_file)
+    with lock.hold(exclusive=True, timeout=SERVER_CACHE_LOCK_TIMEOUT) as waited:
+        # Another invocation refreshed the cache while we were waiting
+        if waited and is_server_data_fresh(server_info_file, time.time() - requested):
+            logger.debug("Using server data refreshed by another invocation")
+            return True
+        result = download_server_data(server_info_file, quiet)
+    if result is None:
+        return False
+    server_count, loads = result
 
-    change_file_owner(SERVER_INFO_FILE)
-    config["metadata"]["last_api_pull"] = str(int(time.time()))
+    logger.debug("{0} written with {1} servers".format(server_info_file, server_count))
 
-    with open(CONFIG_FILE, "w+") as f:
-        config.write(f)
-        logger.debug("last_api_call updated")
+    # A shared cache belongs to whoever runs the CLI as root
+    if not shared:
+        change_file_owner(server_info_file)
+
+    try:
+        loadhistory.record(loads)
+        change_file_owner(LOAD_HISTORY_FILE)
+        change_file_owner(LOAD_HISTORY_INDEX)
+    except (OSError, ValueError) as e:
+        logger.debug("Couldn't record server loads: {0}".format(e))
+
+    set_config_value("metadata", "last_api_pull", int(time.time()))
+    logger.debug("last_api_call updated")
+    return True
+
+
+def refresh_server_data_async():
+    """
+    Start a quiet pull_server_data(force=True) in a background thread.
+
+    Returns a Future of its result.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    refresh = executor.submit(pull_server_data, force=True, quiet=True)
+    # Don't wait for it here, the thread finishes on its own
+    executor.shutdown(wait=False)
+    return refresh
+
+
+def download_server_data(path, quiet=False):
+    """
+    Download /vpn/logicals to path, return (server count, {servername: load}).
+
+    On errors, quiet returns None instead of exiting.
+    """
+    if quiet:
+        try:
+            response = call_api(
+                "/vpn/logicals", json_format=False, handle_errors=False,
+                stream=True, timeout=SERVER_REFRESH_TIMEOUT
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.debug("Error refreshing server data: {0}".format(e))
+            return None
+    else:
+        response = call_api("/vpn/logicals", json_format=False, stream=True)
+
+    loads = {}
+    try:
+        server_count = write_server_data(response.iter_content(chunk_size=65536), path, loads)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.debug("Error reading server data: {0}".format(e))
+        if quiet:
+            return None
+        print(
+            "[!] There was an error with accessing the ProtonVPN API.\n"
+            "[!] Please make sure your connection is working properly!"
+        )
+        sys.exit(1)
+    finally:
+        response.close()
 
+    return server_count, loads
 
-def get_servers():
-    """Return a list of all servers for the users Tier."""
 
-    with open(SERVER_INFO_FILE, "r") as f:
-        logger.debug("Reading servers from file")
-        server_data = json.load(f)
+def write_server_data(chunks, path, loads=None):
+    """
+    Write the compact server cache from a streamed /vpn/logicals body.
 
-    servers = server_data["LogicalServers"]
+    Only the fields used by the CLI are kept. The file is written to a
+    temporary file and renamed, returns the number of servers written.
+    If loads is a dict, the load of every server is stored in it.
+    """
+    server_keys = [
+        "ID", "Name", "EntryCountry", "ExitCountry", "City", "Tier",
+        "Features", "Status", "Load", "Score", "Location",
+    ]
+    subserver_keys = ["EntryIP", "ExitIP", "Status"]
+
+    server_count = 0
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "w") as f:
+            f.write('{"LogicalServers": [')
+            for server in iter_json_array(chunks, "LogicalServers"):
+                compact = {key: server[key] for key in server_keys if key in server}
+                compact["Servers"] = [
+                    {key: subserver[key] for key in subserver_keys if key in subserver}
+                    for subserver in server.get("Servers", [])
+                ]
+                if server_count:
+                    f.write(",")
+                f.write("\n")
+                json.dump(compact, f, separators=(",", ":"))
+                server_count += 1
+                if loads is not None and "Load" in server:
+                    loads[server["Name"]] = server["Load"]
+            f.write("\n]}\n")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return server_count
+
+
+def get_servers(online_only=True):
+    """Return a list of all servers (LogicalServer) for the users Tier."""
+
+    logger.debug("Reading servers from file")
+    server_info_file = get_server_info_file()
+    try:
+        servers = load_servers(server_info_file)
+    except FileNotFoundError:
+        # A shared cache that wasn't downloaded yet can't be without root
+        print(
+            "[!] No server data found in {0}.\n".format(server_info_file)
+            + "[!] Please run the command as root to download it."
+        )
+        logger.debug("{0} not found".format(server_info_file))
+        sys.exit(1)
 
     user_tier = int(get_config_value("USER", "tier"))
 
     # Sort server IDs by Tier
-    return [server for server in servers if server["Tier"] <= user_tier and server["Status"] == 1] # noqa
+    return [
+        server for server in servers
+        if server.tier <= user_tier and (server.status == STATUS_ONLINE or not online_only)
+    ]
+
+
+def update_server_loads(servers):
+    """
+    Update load, score and status of servers from the small /vpn/loads.
+
+    Returns False if the loads couldn't be fetched.
+    """
+    try:
+        response = call_api("/vpn/loads", json_format=False, handle_errors=False)
+        response.raise_for_status()
+        loads = {item["ID"]: item for item in iter_json_array(response.iter_content(65536), "LogicalServers")}
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.debug("Couldn't fetch server loads: {0}".format(e))
+        return False
+
+    for server in servers:
+        item = loads.get(server.id)
+        if item is None:
+            continue
+        server.load = int(item.get("Load", server.load))
+        server.score = float(item.get("Score", server.score))
+        server.status = int(item.get("Status", server.status))
+    logger.debug("Updated loads of {0} servers".format(len(loads)))
+    return True
 
 
-def get_server_value(servername, key, servers):
-    """Return the value of a key for a given server."""
-    value = [server[key] for server in servers if server['Name'] == servername]
-    return value[0]
+def get_server(servername, servers):
+    """Return the server with the given name, raise KeyError if not found."""
+    for server in servers:
+        if server.name == servername:
+            return server
+    raise KeyError(servername)
 
 
 def get_config_value(group, key):
     """Return specific value from CONFIG_FILE as string"""
     config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    with locks.config_lock.hold():
+        config.read(CONFIG_FILE)
 
     return config[group][key]
 
 
 def set_config_value(group, key, value):
     """Write a specific value to CONFIG_FILE"""
+    set_config_values(group, {key: value})
 
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
-    config[group][key] = str(value)
 
-    logger.debug(
-        "Writing {0} to [{1}] in config file".format(key, group)
-    )
+def set_config_values(group, values):
+    """Write several values of a group to CONFIG_FILE at once"""
+
+    with locks.config_lock.hold(exclusive=True):
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        for key, value in values.items():
+            config[group][key] = str(value)
+
+        logger.debug(
+            "Writing {0} to [{1}] in config file".format(", ".join(values), group)
+        )
+
+        write_config_file(config)
 
-    with open(CONFIG_FILE, "w+") as f:
+
+def write_config_file(config):
+    """
+    Replace CONFIG_FILE with config.
+
+    The file is renamed into place, so readers without the config lock
+    (e.g. the exporter) never see a partial file.
+    """
+    tmp_path = "{0}.{1}.tmp".format(CONFIG_FILE, os.getpid())
+    with open(tmp_path, "w") as f:
         config.write(f)
+    if os.path.exists(CONFIG_FILE):
+        shutil.copymode(CONFIG_FILE, tmp_path)
+        stat = os.stat(CONFIG_FILE)
+        if os.geteuid() == 0:
+            os.chown(tmp_path, stat.st_uid, stat.st_gid)
+    os.replace(tmp_path, CONFIG_FILE)
+
+
+def timed_call(timings, phase, func, *args, **kwargs):
+    """
+    Call func and store its duration in seconds in timings[phase].
+
+    The duration is also recorded as a metrics span.
+    """
+    start = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[phase] = time.monotonic() - start
+        metrics.record_span(phase, timings[phase])
 
 
 def get_ip_info():
@@ -156,22 +406,99 @@ def get_country_name(code):
     return country_codes.get(code, code)
 
 
-def get_fastest_server(server_pool):
-    """Return the fastest server from a list of servers"""
+def get_ranking_weights():
+    """Return the configured server ranking weights"""
+    try:
+        return ranking.parse_weights(get_config_value("USER", "ranking_weights"))
+    except (KeyError, ValueError) as e:
+        logger.debug("Invalid ranking weights ({0}), using defaults".format(e))
+        return ranking.parse_weights(ranking.DEFAULT_WEIGHTS)
 
-    # Sort servers by "speed" and select top n according to pool_size
-    fastest_pool = sorted(
-        server_pool, key=lambda server: server["Score"]
-    )
-    if len(fastest_pool) >= 50:
-        pool_size = 4
-    else:
-        pool_size = 1
-    logger.debug(
-        "Returning fastest server with pool size {0}".format(pool_size)
+
+def get_location():
+    """
+    Return the (latitude, longitude) of the user or None if unknown.
+
+    Uses the location configured in 'protonvpn configure' and otherwise
+    the location of the public IP, which is cached for LOCATION_TTL.
+    """
+    location = get_config_value("USER", "location")
+    if location == "None":
+        try:
+            location_time = int(get_config_value("metadata", "location_time"))
+            if time.time() - location_time < LOCATION_TTL:
+                location = get_config_value("metadata", "location")
+        except KeyError:
+            pass
+
+    if location == "None":
+        # The API would return the location of the VPN server
+        if is_connected():
+            return None
+        logger.debug("Looking up location")
+        ip_info = call_api("/vpn/location")
+        if ip_info.get("Lat") is None or ip_info.get("Long") is None:
+            return None
+        location = "{0},{1}".format(ip_info["Lat"], ip_info["Long"])
+        set_config_value("metadata", "location", location)
+        set_config_value("metadata", "location_time", int(time.time()))
+
+    try:
+        return parse_location(location)
+    except ValueError:
+        logger.debug("Invalid location {0}".format(location))
+        return None
+
+
+def parse_location(value):
+    """Parse 'latitude,longitude', raise ValueError if invalid"""
+    lat, long = (float(v) for v in value.split(","))
+    if not -90 <= lat <= 90 or not -180 <= long <= 180:
+        raise ValueError("Coordinates out of range")
+    return lat, long
+
+
+def get_fastest_server(server_pool, near=False):
+    """
+    Return the name of the best ranked server from a list of servers.
+
+    With near=True only the servers nearest to the user are ranked,
+    by distance as well even if its weight is set to 0.
+    """
+
+    server_pool = quarantine.filter_servers(server_pool)
+
+    weights = get_ranking_weights()
+    success_rates = ranking.get_success_rates() if weights["success"] else None
+
+    origin = None
+    if near or weights["distance"]:
+        origin = get_location()
+        if origin is None and near:
+            print(
+                "[!] Your location couldn't be determined.\n"
+                "[!] Please set it with 'protonvpn configure'."
+            )
+            logger.debug("No location for proximity connect")
+            sys.exit(1)
+    if near and not weights["distance"]:
+        weights["distance"] = 1.0
+
+    rtts = get_server_rtts(server_pool) if weights["rtt"] else None
+
+    loads = None
+    if weights["load"] and int(get_config_value("USER", "load_forecast")):
+        loads = loadhistory.forecast({server.name: server.load for server in server_pool})
+
+    fastest_server = ranking.select_server(
+        server_pool, weights, RANKING_TOLERANCE, nearest=PROXIMITY_POOL_SIZE if near else None,
+        rtts=rtts, success_rates=success_rates, origin=origin, loads=loads
     )
-    fastest_server = random.choice(fastest_pool[:pool_size])["Name"]
-    return fastest_server
+    if fastest_server is None:
+        print("[!] No servers found with your selection.")
+        logger.debug("No server left after ranking")
+        sys.exit(1)
+    return fastest_server.name
 
 
 def get_default_nic():
@@ -199,8 +526,28 @@ def is_connected():
     return True if ovpn_processes != [] else False
 
 
+def get_openvpn_pid():
+    """Return the PID of the running OpenVPN process started by the CLI or None"""
+    try:
+        with open(OPENVPN_PID_FILE, "r") as f:
+            pid = int(f.read().strip())
+        with open("/proc/{0}/comm".format(pid), "r") as f:
+            if f.read().strip() == "openvpn":
+                return pid
+    except (OSError, ValueError):
+        pass
+    return None
+
+
 def is_ipv6_disabled():
     """Returns True if IPv6 is disabled and False if it's enabled"""
+    try:
+        # Read procfs directly to avoid forking sysctl
+        with open("/proc/sys/net/ipv6/conf/all/disable_ipv6", "r") as f:
+            return bool(int(f.read()))
+    except (OSError, ValueError):
+        pass
+
     ipv6_state = subprocess.run(['sysctl', '-n', 'net.ipv6.conf.all.disable_ipv6'],
                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
 
@@ -210,27 +557,378 @@ def is_ipv6_disabled():
         return False
 
 
+def has_default_route():
+    """Return True if there is an IPv4 or IPv6 default route"""
+    try:
+        with open("/proc/net/route", "r") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                # Destination and mask 0.0.0.0 with the RTF_UP flag
+                if fields[1] == "00000000" and fields[7] == "00000000" and int(fields[3], 16) & 1:
+                    return True
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        with open("/proc/net/ipv6_route", "r") as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == "0" * 32 and fields[1] == "00" and fields[9] != "lo":
+                    return True
+    except (OSError, IndexError):
+        pass
+    return False
+
+
+def open_route_events():
+    """
+    Return a netlink socket receiving link, address and route changes.
+
+    Returns None if netlink isn't available.
+    """
+    # RTMGRP_LINK, RTMGRP_IPV4_IFADDR, RTMGRP_IPV4_ROUTE, RTMGRP_IPV6_IFADDR, RTMGRP_IPV6_ROUTE
+    groups = 0x1 | 0x10 | 0x40 | 0x100 | 0x400
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, groups))
+    except (OSError, AttributeError) as e:
+        logger.debug("Netlink unavailable, polling routes: {0}".format(e))
+        return None
+    sock.setblocking(False)
+    return sock
+
+
+def wait_for_default_route(deadline):
+    """
+    Block until there is a default route or the deadline passes.
+
+    Wakes up on netlink route and address events, or every half second
+    without netlink. Returns True if a default route exists.
+    """
+    events = open_route_events()
+    try:
+        # Subscribed before checking, so no change is missed in between
+        while not has_default_route():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if events is None:
+                time.sleep(min(remaining, 0.5))
+                continue
+            readable, _, _ = select.select([events], [], [], remaining)
+            if readable:
+                # Only the fact that something changed matters
+                try:
+                    while events.recv(65536):
+                        pass
+                except BlockingIOError:
+                    pass
+                except OSError as e:
+                    # E.g. ENOBUFS after a burst of events
+                    logger.debug("Netlink: {0}".format(e))
+        return True
+    finally:
+        if events is not None:
+            events.close()
+
+
 def wait_for_network(wait_time):
-    """Check if internet access is working"""
+    """
+    Wait up to wait_time seconds until the ProtonVPN API is reachable.
+
+    Waits for a default route first, then probes the API with
+    exponential backoff. Returns the seconds waited.
+    """
 
     print("Waiting for connection...")
-    start = time.time()
+    logger.debug("Waiting for {0}s for connection...".format(wait_time))
+    start = time.monotonic()
+    deadline = start + wait_time
+
+    def give_up():
+        logger.debug("Max waiting time reached.")
+        print("Max waiting time reached.")
+        sys.exit(1)
 
+    if not wait_for_default_route(deadline):
+        give_up()
+    logger.debug("Default route after {0:.3f}s".format(time.monotonic() - start))
+
+    delay = NETWORK_PROBE_BACKOFF_START
     while True:
-        if time.time() - start > wait_time:
-            logger.debug("Max waiting time reached.")
-            print("Max waiting time reached.")
-            sys.exit(1)
-        logger.debug("Waiting for {0}s for connection...".format(wait_time))
         try:
-            call_api("/test/ping", handle_errors=False)
-            time.sleep(2)
-            print("Connection working!")
-            logger.debug("Connection working!")
+            remaining = deadline - time.monotonic()
+            call_api("/test/ping", handle_errors=False, timeout=max(min(remaining, 5), 0.1))
             break
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.ConnectTimeout):
-            time.sleep(2)
+        except requests.exceptions.RequestException as e:
+            logger.debug("API not reachable yet: {0}".format(e))
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            give_up()
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, NETWORK_PROBE_BACKOFF_MAX)
+
+    waited = time.monotonic() - start
+    metrics.record_span("wait_for_network", waited)
+    print("Connection working after {0:.2f}s!".format(waited))
+    logger.debug("Connection working after {0:.3f}s".format(waited))
+    return waited
+
+
+# Cached result of get_openvpn_capabilities()
+_openvpn_capabilities = None
+
+
+def get_openvpn_capabilities():
+    """Return version and cipher support of the installed OpenVPN binary"""
+
+    global _openvpn_capabilities
+    if _openvpn_capabilities is not None:
+        return _openvpn_capabilities
+
+    try:
+        version_output = subprocess.run(
+            ["openvpn", "--version"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        ).stdout.decode()
+    except FileNotFoundError:
+        version_output = ""
+
+    version = re.search(r"OpenVPN (\d+)\.(\d+)", version_output)
+    version = (int(version.group(1)), int(version.group(2))) if version else (2, 4)
+
+    # CHACHA20-POLY1305 needs OpenSSL 1.1.0 or newer
+    openssl = re.search(r"OpenSSL (\d+)\.(\d+)", version_output)
+    chacha20 = bool(openssl) and (int(openssl.group(1)), int(openssl.group(2))) >= (1, 1)
+
+    logger.debug("OpenVPN version: {0}, CHACHA20: {1}".format(version, chacha20))
+    _openvpn_capabilities = {"version": version, "chacha20": chacha20}
+    return _openvpn_capabilities
+
+
+def get_profile_directives(protocol, capabilities=None, profile_name=None):
+    """
+    Return the template values of a performance profile
+
+    capabilities = OpenVPN support to render for, the installed OpenVPN by default
+    profile_name = profile to render, the configured one by default
+    """
+
+    if profile_name is None:
+        try:
+            profile_name = get_config_value("USER", "performance_profile")
+        except KeyError:
+            profile_name = "default"
+    profile = PERFORMANCE_PROFILES.get(profile_name, PERFORMANCE_PROFILES["default"])
+    logger.debug("Using performance profile {0}".format(profile_name))
+
+    if capabilities is None:
+        capabilities = get_openvpn_capabilities()
+
+    ciphers = [
+        cipher for cipher in profile.get("data_ciphers", [])
+        if cipher != "CHACHA20-POLY1305" or capabilities["chacha20"]
+    ]
+
+    directives = {
+        "data_ciphers": None,
+        "ncp_ciphers": None,
+        "sndbuf": profile.get("sndbuf"),
+        "rcvbuf": profile.get("rcvbuf"),
+        "txqueuelen": profile.get("txqueuelen"),
+        # fast-io is only valid for UDP connections
+        "fast_io": protocol.lower() == "udp" and profile.get("fast_io", True),
+    }
+
+    if ciphers:
+        # Keep the static cipher last, so servers without NCP still work
+        ciphers.append("AES-256-CBC")
+        if capabilities["version"] >= (2, 5):
+            directives["data_ciphers"] = ":".join(ciphers)
+        else:
+            # OpenVPN 2.4 only negotiates AES-GCM ciphers via ncp-ciphers
+            directives["ncp_ciphers"] = ":".join(
+                cipher for cipher in ciphers if cipher.startswith("AES-")
+            )
+
+    return directives
+
+
+def get_path_mtu(ip):
+    """
+    Return the path MTU to ip or None if it can't be determined.
+
+    Pings with the DF bit set and binary searches between the IPv4 minimum
+    and the Ethernet MTU. Discovered MTUs are cached per (default NIC,
+    server IP) for PMTU_CACHE_TTL seconds, failed probes aren't cached.
+    """
+
+    def probe(mtu):
+        """Return True if a packet of size mtu passes unfragmented"""
+        # Subtract IPv4 (20) and ICMP (8) header sizes
+        ping = subprocess.run(
+            ["ping", "-c", "1", "-W", "1", "-M", "do", "-s", str(mtu - 28), ip],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        return ping.returncode == 0
+
+    try:
+        cache_key = "{0}|{1}".format(get_default_nic(), ip)
+    except IndexError:
+        logger.debug("No default route, skipping path MTU discovery")
+        return None
+
+    try:
+        with open(PMTU_CACHE_FILE, "r") as f:
+            pmtu_cache = json.load(f)
+    except (OSError, ValueError):
+        pmtu_cache = {}
+
+    cached = pmtu_cache.get(cache_key)
+    if cached and cached["mtu"] and time.time() - cached["time"] <= PMTU_CACHE_TTL:
+        logger.debug("Using cached path MTU {0} for {1}".format(cached["mtu"], cache_key))
+        return cached["mtu"]
+
+    low, high = 576, 1500
+    if probe(high):
+        path_mtu = high
+    elif not probe(low):
+        # ICMP is blocked or the server is unreachable, probe again next time
+        logger.debug("Path MTU discovery failed for {0}".format(cache_key))
+        return None
+    else:
+        while high - low > 1:
+            middle = (low + high) // 2
+            if probe(middle):
+                low = middle
+            else:
+                high = middle
+        path_mtu = low
+    logger.debug("Discovered path MTU {0} for {1}".format(path_mtu, cache_key))
+
+    pmtu_cache[cache_key] = {"mtu": path_mtu, "time": int(time.time())}
+    tmp_path = "{0}.{1}.tmp".format(PMTU_CACHE_FILE, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(pmtu_cache, f)
+    os.replace(tmp_path, PMTU_CACHE_FILE)
+    change_file_owner(PMTU_CACHE_FILE)
+
+    return path_mtu
+
+
+def probe_rtts(ips, port=RTT_PROBE_PORT, timeout=RTT_PROBE_TIMEOUT):
+    """
+    Return {ip: seconds to open a TCP connection to ip:port}.
+
+    All IPs are probed concurrently with non-blocking sockets, IPs that
+    don't answer within timeout are None.
+    """
+
+    results = dict.fromkeys(ips)
+    selector = selectors.DefaultSelector()
+    for ip in results:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        error = sock.connect_ex((ip, port))
+        if error not in [0, errno.EINPROGRESS]:
+            sock.close()
+            continue
+        selector.register(sock, selectors.EVENT_WRITE, (ip, time.monotonic()))
+
+    deadline = time.monotonic() + timeout
+    while selector.get_map():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        for key, _ in selector.select(remaining):
+            ip, start = key.data
+            if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                results[ip] = time.monotonic() - start
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+
+    for key in list(selector.get_map().values()):
+        selector.unregister(key.fileobj)
+        key.fileobj.close()
+    selector.close()
+
+    return results
+
+
+def get_rtts(ips, probe=True):
+    """
+    Return {ip: rtt in seconds or None if unreachable} of the entry IPs.
+
+    Results are cached per default NIC for RTT_CACHE_TTL seconds. With
+    probe=False only cached IPs are returned, otherwise the others are
+    probed.
+    """
+
+    try:
+        nic = get_default_nic()
+    except IndexError:
+        logger.debug("No default route, skipping RTT probes")
+        return {}
+
+    try:
+        with open(RTT_CACHE_FILE, "r") as f:
+            rtt_cache = json.load(f)
+    except (OSError, ValueError):
+        rtt_cache = {}
+
+    now = time.time()
+    rtts = {}
+    for ip in ips:
+        cached = rtt_cache.get("{0}|{1}".format(nic, ip))
+        if cached and now - cached["time"] <= RTT_CACHE_TTL:
+            rtts[ip] = cached["rtt"]
+
+    missing = [ip for ip in ips if ip not in rtts]
+    if not probe or not missing:
+        return rtts
+
+    probed = probe_rtts(missing)
+    logger.debug("Probed RTTs: {0}".format(probed))
+    rtts.update(probed)
+
+    # Drop expired entries while updating the cache
+    rtt_cache = {key: value for key, value in rtt_cache.items() if now - value["time"] <= RTT_CACHE_TTL}
+    for ip, rtt in probed.items():
+        rtt_cache["{0}|{1}".format(nic, ip)] = {"rtt": rtt, "time": int(now)}
+    tmp_path = "{0}.{1}.tmp".format(RTT_CACHE_FILE, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(rtt_cache, f)
+    os.replace(tmp_path, RTT_CACHE_FILE)
+    change_file_owner(RTT_CACHE_FILE)
+
+    return rtts
+
+
+def order_by_rtt(ips):
+    """
+    Return (ips, ordered) with reachable IPs sorted by RTT first.
+
+    ordered is False if no IP answered, the order is unchanged then.
+    """
+    if len(ips) < 2:
+        return ips, False
+
+    rtts = get_rtts(ips)
+    reachable = sorted((ip for ip in ips if rtts.get(ip) is not None), key=rtts.get)
+    if not reachable:
+        return ips, False
+    # Unreachable IPs are kept as a last resort, the probe may be filtered
+    return reachable + [ip for ip in ips if ip not in reachable], True
+
+
+def get_server_rtts(servers):
+    """Return {servername: lowest cached RTT of its entry IPs}"""
+    rtts = get_rtts([s.entry_ip for server in servers for s in server.servers], probe=False)
+    server_rtts = {}
+    for server in servers:
+        known = [rtts[s.entry_ip] for s in server.servers if rtts.get(s.entry_ip) is not None]
+        if known:
+            server_rtts[server.name] = min(known)
+    return server_rtts
 
 
 def cidr_to_netmask(cidr):
@@ -238,40 +936,139 @@ def cidr_to_netmask(cidr):
     return str(subnet.netmask)
 
 
-def render_j2_template(template_file, destination_file, values):
+def get_j2_environment():
+    """Return the shared Jinja2 environment, creating it on first use"""
+
+    global _j2_environment
+    if _j2_environment is None:
+        _j2_environment = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return _j2_environment
+
+
+# Shared Jinja2 environment of get_j2_environment()
+_j2_environment = None
+
+# First line of a cached OpenVPN config, OpenVPN skips it as a comment
+OVPN_DIGEST_HEADER = "# sha256 {0}\n"
+
+
+def render_openvpn_config(destination_file, values):
     """
-    Render a Jinja2 template from a file and save it to a specified location
-    template_file = name of jinja2 template
+    Render the OpenVPN template to a file only the current user can access
     destination_file = path where rendered file will be saved to
     values = dictionary with values for jinja2 templates
+
+    The first line holds the digest of the content for open_openvpn_config().
     """
 
-    j2 = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")))
-    template = j2.get_template(template_file)
+    content = get_j2_environment().get_template("openvpn_template.j2").render(values).encode()
+    header = OVPN_DIGEST_HEADER.format(hashlib.sha256(content).hexdigest()).encode()
 
-    # Render Template and write to file
-    with open(destination_file, "w") as f:
-        f.write(template.render(values))
-    logger.debug("Rendered {0} from {1}".format(destination_file, template_file))
-    change_file_owner(destination_file)
+    if os.path.lexists(destination_file):
+        os.remove(destination_file)
+    fd = os.open(destination_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(header + content)
+    logger.debug("Rendered {0}".format(destination_file))
 
 
-def create_openvpn_config(serverlist, protocol, ports):
+def open_openvpn_config(path):
     """
-    Create the OpenVPN Config file
-    serverlist = list with IPs or hostnames
-    protocol = "udp" or "tcp"
-    ports = list with possible ports
+    Open a cached OpenVPN config if it can be trusted, else return None
+
+    The config has to be a regular file of the current user that nobody
+    else can write and has to match the digest in its first line. The
+    returned binary file keeps the verified file open at its start, pass
+    it to OpenVPN as /dev/fd/<fileno> so it can't be swapped afterwards.
+    """
+
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+
+    f = os.fdopen(fd, "rb")
+    file_stat = os.fstat(fd)
+    header = f.readline()
+    digest = hashlib.sha256(f.read()).hexdigest()
+
+    if (
+        stat.S_ISREG(file_stat.st_mode) and file_stat.st_uid == os.geteuid()
+        and not file_stat.st_mode & 0o022 and header == OVPN_DIGEST_HEADER.format(digest).encode()
+    ):
+        f.seek(0)
+        return f
+
+    f.close()
+    logger.debug("Untrusted OpenVPN config {0}".format(path))
+    return None
+
+
+def make_private_dir(path):
+    """
+    Make sure path is a directory of the current user with mode 0700
+
+    Anything else at path, like a directory an unprivileged user could
+    write to, is removed first.
     """
 
-    # Split Tunneling
     try:
-        if get_config_value("USER", "split_tunnel") == "1":
-            split = True
+        dir_stat = os.lstat(path)
+    except FileNotFoundError:
+        dir_stat = None
+
+    if dir_stat is not None and not (
+        stat.S_ISDIR(dir_stat.st_mode) and dir_stat.st_uid == os.geteuid() and not dir_stat.st_mode & 0o077
+    ):
+        logger.debug("Replacing {0}, it isn't private".format(path))
+        if stat.S_ISDIR(dir_stat.st_mode):
+            shutil.rmtree(path)
         else:
-            split = False
+            os.remove(path)
+        dir_stat = None
+
+    if dir_stat is None:
+        os.mkdir(path, 0o700)
+
+
+def get_openvpn_config_key(serverlist, protocol, ports, path_mtu, split, ordered=False):
+    """Return a hash over every input that changes the rendered config"""
+
+    config_hash = hashlib.sha256()
+
+    with open(os.path.join(TEMPLATE_DIR, "openvpn_template.j2"), "rb") as f:
+        config_hash.update(f.read())
+
+    if split:
+        with open(SPLIT_TUNNEL_FILE, "rb") as f:
+            config_hash.update(f.read())
+
+    try:
+        profile_name = get_config_value("USER", "performance_profile")
     except KeyError:
-        split = False
+        profile_name = "default"
+
+    # Identify the OpenVPN binary instead of probing its version
+    openvpn_binary = shutil.which("openvpn")
+    openvpn_stat = os.stat(openvpn_binary) if openvpn_binary else None
+
+    inputs = [
+        VERSION, serverlist, ordered, protocol.lower(), ports, path_mtu, split, is_ipv6_disabled(),
+        profile_name, PERFORMANCE_PROFILES.get(profile_name), SERVER_POLL_TIMEOUT,
+        [openvpn_binary, openvpn_stat.st_size, openvpn_stat.st_mtime] if openvpn_stat else None,
+    ]
+    config_hash.update(json.dumps(inputs).encode())
+
+    return config_hash.hexdigest()
+
+
+def get_openvpn_config_values(serverlist, protocol, ports, split, path_mtu=None, ordered=False, portable=False):
+    """
+    Return the Jinja2 values for the OpenVPN template
+
+    ordered = serverlist is sorted by preference, OpenVPN tries it in order
+    portable = leave out what depends on this machine (IPv6 state, OpenVPN version)
+    """
 
     ip_nm_pairs = []
 
@@ -293,8 +1090,9 @@ def create_openvpn_config(serverlist, protocol, ports):
 
             ip_nm_pairs.append({"ip": ip, "nm": netmask})
 
-    # IPv6
-    ipv6_disabled = is_ipv6_disabled()
+    # Lower mssfix by the amount the path MTU is below 1500. tun-mtu stays,
+    # it doesn't include the encapsulation overhead mssfix accounts for.
+    mtu_reduction = 1500 - path_mtu if path_mtu and path_mtu < 1500 else 0
 
     j2_values = {
         "openvpn_protocol": protocol,
@@ -302,10 +1100,167 @@ def create_openvpn_config(serverlist, protocol, ports):
         "openvpn_ports": ports,
         "split": split,
         "ip_nm_pairs": ip_nm_pairs,
-        "ipv6_disabled": ipv6_disabled
+        "ipv6_disabled": not portable and is_ipv6_disabled(),
+        "tun_mtu": 1500,
+        "mssfix": 1450 - mtu_reduction,
+        "remote_random": not ordered,
+        "server_poll_timeout": SERVER_POLL_TIMEOUT,
     }
+    j2_values.update(get_profile_directives(protocol, EXPORT_OPENVPN_CAPABILITIES if portable else None))
+
+    return j2_values
+
+
+def is_split_tunnel_enabled():
+    """Return True if split tunneling is enabled"""
+    try:
+        return get_config_value("USER", "split_tunnel") == "1"
+    except KeyError:
+        return False
+
+
+def create_openvpn_config(serverlist, protocol, ports, path_mtu=None, ordered=False):
+    """
+    Create the OpenVPN Config file
+    serverlist = list with IPs or hostnames
+    protocol = "udp" or "tcp"
+    ports = list with possible ports
+    path_mtu = discovered path MTU to the server or None
+    ordered = serverlist is sorted by preference instead of tried randomly
+
+    Rendered configs are cached in OVPN_CACHE_DIR by the hash of their
+    inputs, OVPN_FILE is a symlink to the config of the current connection.
+    OpenVPN runs as root with these configs, so the cache directory and its
+    files belong to root and every hit is verified with open_openvpn_config().
+    Returns the path of the cached config.
+    """
 
-    render_j2_template(template_file="openvpn_template.j2", destination_file=OVPN_FILE, values=j2_values)
+    split = is_split_tunnel_enabled()
+
+    make_private_dir(OVPN_CACHE_DIR)
+
+    config_key = get_openvpn_config_key(serverlist, protocol, ports, path_mtu, split, ordered)
+    cached_config = os.path.join(OVPN_CACHE_DIR, "{0}.ovpn".format(config_key))
+
+    config_file = open_openvpn_config(cached_config)
+    if config_file is not None:
+        config_file.close()
+        logger.debug("Using cached OpenVPN config {0}".format(config_key))
+        # Mark as recently used for eviction
+        os.utime(cached_config)
+    else:
+        j2_values = get_openvpn_config_values(serverlist, protocol, ports, split, path_mtu, ordered)
+
+        # Render to a temporary file first, so a cache entry is never partial
+        render_openvpn_config(cached_config + ".tmp", j2_values)
+        os.replace(cached_config + ".tmp", cached_config)
+
+        # Evict the least recently used configs
+        cached_configs = sorted(
+            (os.path.join(OVPN_CACHE_DIR, name) for name in os.listdir(OVPN_CACHE_DIR) if name.endswith(".ovpn")),
+            key=os.path.getmtime
+        )
+        for old_config in cached_configs[:-OVPN_CACHE_SIZE]:
+            os.remove(old_config)
+            logger.debug("Evicted cached OpenVPN config {0}".format(old_config))
+
+    # Atomically point OVPN_FILE to the cached config
+    if os.path.realpath(OVPN_FILE) != os.path.realpath(cached_config):
+        if os.path.lexists(OVPN_FILE + ".tmp"):
+            os.remove(OVPN_FILE + ".tmp")
+        os.symlink(cached_config, OVPN_FILE + ".tmp")
+        os.replace(OVPN_FILE + ".tmp", OVPN_FILE)
+
+    return cached_config
+
+
+def _init_export_worker(base_values):
+    """Prepare a worker process for rendering exported configs"""
+    global _export_template, _export_base_values
+    _export_template = get_j2_environment().get_template("openvpn_template.j2")
+    _export_base_values = base_values
+
+
+def _export_config(job):
+    """
+    Render a single exported config and write it atomically.
+
+    Returns True if the file was written, False if it was unchanged.
+    """
+    path, protocol, serverlist = job
+
+    values = dict(_export_base_values[protocol])
+    values["serverlist"] = serverlist
+    content = _export_template.render(values).encode()
+
+    # Skip files whose content didn't change
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).digest() == hashlib.sha256(content).digest():
+                    return False
+    except OSError:
+        pass
+
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return True
+
+
+# Per process state of _init_export_worker()
+_export_template = None
+_export_base_values = None
+
+
+def export_openvpn_configs(servers, out_dir, protocols, prune=False):
+    """
+    Write an OpenVPN config for every server and protocol to out_dir.
+
+    The configs are meant for other machines, so they are rendered
+    without the split tunneling, IPv6 and OpenVPN version of this one.
+    Rendering is spread across a process pool for large server lists.
+    With prune, exported configs of other servers, e.g. ones that were
+    removed, are deleted from out_dir.
+    Returns a tuple of (written, unchanged, removed) file counts.
+    """
+
+    base_values = {
+        protocol: get_openvpn_config_values([], protocol, [OPENVPN_PORTS[protocol]], split=False, portable=True)
+        for protocol in protocols
+    }
+
+    jobs = []
+    for server in servers:
+        filename = server.name.lower().replace("#", "-")
+        serverlist = [subserver.entry_ip for subserver in server.servers]
+        for protocol in protocols:
+            path = os.path.join(out_dir, "{0}.{1}.ovpn".format(filename, protocol))
+            jobs.append((path, protocol, serverlist))
+
+    # Forking a pool only pays off for larger exports
+    if len(jobs) < 500:
+        _init_export_worker(base_values)
+        results = [_export_config(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(initializer=_init_export_worker, initargs=(base_values,)) as pool:
+            results = list(pool.imap_unordered(_export_config, jobs, chunksize=128))
+
+    written = sum(results)
+    logger.debug("Exported {0} configs to {1}, {2} written".format(len(jobs), out_dir, written))
+
+    removed = 0
+    if prune:
+        exported = {os.path.basename(job[0]) for job in jobs}
+        suffixes = tuple(".{0}.ovpn".format(protocol) for protocol in OPENVPN_PORTS)
+        for filename in os.listdir(out_dir):
+            if filename.endswith(suffixes) and filename not in exported:
+                os.remove(os.path.join(out_dir, filename))
+                removed += 1
+        logger.debug("Removed {0} configs from {1}".format(removed, out_dir))
+
+    return written, len(jobs) - written, removed
 
 
 def change_file_owner(path):
@@ -349,72 +1304,21 @@ def check_root():
 
 
 def check_update():
-    """Return the download URL if an Update is available, False if otherwise"""
-
-    def get_latest_version():
-        """Return the latest version from pypi"""
-        logger.debug("Calling pypi API")
-        try:
-            r = requests.get("https://pypi.org/pypi/protonvpn-cli/json")
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.ConnectTimeout):
-            logger.debug("Couldn't connect to pypi API")
-            return False
-        try:
-            r.raise_for_status()
-        except requests.exceptions.HTTPError:
-            logger.debug(
-                "HTTP Error with pypi API: {0}".format(r.status_code)
-            )
-            return False
-
-        release = r.json()["info"]["version"]
-
-        return release
-
-    # Determine if an update check should be run
-    check_interval = int(get_config_value("USER", "check_update_interval"))
-    check_interval = check_interval * 24 * 3600
-    last_check = int(get_config_value("metadata", "last_update_check"))
-
-    if (last_check + check_interval) >= time.time():
-        # Don't check for update
-        return
-
-    logger.debug("Checking for new update")
-    current_version = list(VERSION.split("."))
-    current_version = [int(i) for i in current_version]
-    logger.debug("Current: {0}".format(current_version))
-
-    latest_version = get_latest_version()
-    if not latest_version:
-        # Skip if get_latest_version() ran into errors
-        return
-    latest_version = latest_version.split(".")
-    latest_version = [int(i) for i in latest_version]
-    logger.debug("Latest: {0}".format(latest_version))
-
-    for idx, i in enumerate(latest_version):
-        if i > current_version[idx]:
-            logger.debug("Update found")
-            update_available = True
-            break
-        elif i < current_version[idx]:
-            logger.debug("No update")
-            update_available = False
-            break
-    else:
-        logger.debug("No update")
-        update_available = False
+    """
+    Print a notice if the last update check found an update.
 
-    set_config_value("metadata", "last_update_check", int(time.time()))
+    Starts a new check in the background if one is due, its result is
+    shown by a later command. Never waits for the network.
+    """
+    cache = updates.read_cache()
+    changed = False
 
-    if update_available:
+    latest_version = cache.get("latest")
+    if latest_version and not cache.get("notified") and updates.is_newer(latest_version):
+        logger.debug("Update found")
         print()
         print(
-            "A new Update for ProtonVPN-CLI (v{0}) ".format('.'.join(
-                [str(x) for x in latest_version])
-            )
+            "A new Update for ProtonVPN-CLI (v{0}) ".format(latest_version)
             + "is available.\n"
             + "Follow the Update instructions on\n"
             + "https://github.com/ProtonVPN/linux-cli/blob/master/USAGE.md#updating-protonvpn-cli\n"
@@ -422,6 +1326,23 @@ def check_update():
             + "To see what's new, check out the changelog:\n"
             + "https://github.com/ProtonVPN/linux-cli/blob/master/CHANGELOG.md"
         )
+        cache["notified"] = True
+        changed = True
+
+    # Determine if an update check should be run
+    check_interval = int(get_config_value("USER", "check_update_interval"))
+    check_interval = check_interval * 24 * 3600
+    if cache.get("checked", 0) + check_interval < time.time():
+        # Also marks the check as running, so the next commands don't start another one
+        cache["checked"] = int(time.time())
+        changed = True
+        updates.start_check()
+
+    if changed:
+        try:
+            updates.write_cache(cache)
+        except OSError as e:
+            logger.debug("Couldn't store the update check: {0}".format(e))
 
 
 def check_init():
@@ -449,6 +1370,14 @@ def check_init():
                     "check_update_interval": "3",
                     "killswitch": "0",
                     "split_tunnel": "0",
+                    "performance_profile": "default",
+                    "mtu_discovery": "0",
+                    "ranking_weights": ranking.DEFAULT_WEIGHTS,
+                    "location": "None",
+                    "load_forecast": "0",
+                    "server_cache_dir": "None",
+                    "server_data_max_age": "900",
+                    "dns_cache": "0",
                     "api_domain": "https://api.protonvpn.ch",
                 },
             }
@@ -488,21 +1417,22 @@ def is_valid_ip(ipaddr):
         return False
 
 
+def convert_size(size_bytes):
+    """Converts byte amounts into human readable formats"""
+    if size_bytes < 1:
+        return "0B"
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+
+    i = int(math.floor(math.log(size_bytes, 1000)))
+    p = math.pow(1000, i)
+    s = round(size_bytes / p, 2)
+    return "{0} {1}".format(s, size_name[i])
+
+
 def get_transferred_data():
     """Reads and returns the amount of data transferred during a session
     from the /sys/ directory"""
 
-    def convert_size(size_bytes):
-        """Converts byte amounts into human readable formats"""
-        if size_bytes == 0:
-            return "0B"
-        size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-
-        i = int(math.floor(math.log(size_bytes, 1000)))
-        p = math.pow(1000, i)
-        s = round(size_bytes / p, 2)
-        return "{0} {1}".format(s, size_name[i])
-
     base_path = "/sys/class/net/{0}/statistics/{1}"
 
     if os.path.isfile(base_path.format('proton0', 'rx_bytes')):
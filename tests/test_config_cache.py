@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from protonvpn_cli import utils
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "OVPN_CACHE_DIR", str(tmp_path / "ovpn_cache"))
+    monkeypatch.setattr(utils, "OVPN_FILE", str(tmp_path / "connect.ovpn"))
+
+    def get_config_value(group, key):
+        raise KeyError(key)
+
+    monkeypatch.setattr(utils, "get_config_value", get_config_value)
+    monkeypatch.setattr(utils, "is_ipv6_disabled", lambda: False)
+    monkeypatch.setattr(utils, "get_openvpn_capabilities", lambda: {"version": (2, 5), "chacha20": True})
+
+    renders = []
+    render = utils.render_openvpn_config
+
+    def counting_render(destination_file, values):
+        renders.append(values)
+        render(destination_file, values)
+
+    monkeypatch.setattr(utils, "render_openvpn_config", counting_render)
+    return renders
+
+
+def create(serverlist=("10.0.0.1", "10.0.0.2"), protocol="udp"):
+    return utils.create_openvpn_config(serverlist=list(serverlist), protocol=protocol, ports=[1194])
+
+
+def test_miss_renders_and_links(cache):
+    path = create()
+
+    assert len(cache) == 1
+    assert os.path.dirname(path) == utils.OVPN_CACHE_DIR
+    assert os.readlink(utils.OVPN_FILE) == path
+    assert os.stat(utils.OVPN_CACHE_DIR).st_mode & 0o777 == 0o700
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    with open(path, "r") as f:
+        assert "remote 10.0.0.1 1194" in f.read()
+
+
+def test_hit_reuses_config(cache):
+    path = create()
+    assert create() == path
+    assert len(cache) == 1
+
+    other = create(protocol="tcp")
+    assert other != path
+    assert len(cache) == 2
+    assert os.readlink(utils.OVPN_FILE) == other
+
+
+def test_modified_config_is_rendered_again(cache):
+    path = create()
+    with open(path, "a") as f:
+        f.write("up /tmp/script\n")
+    assert utils.open_openvpn_config(path) is None
+
+    assert create() == path
+    assert len(cache) == 2
+    config_file = utils.open_openvpn_config(path)
+    assert config_file is not None
+    with config_file:
+        assert b"up /tmp/script" not in config_file.read()
+
+
+def test_writable_cache_dir_is_replaced(cache):
+    os.mkdir(utils.OVPN_CACHE_DIR)
+    os.chmod(utils.OVPN_CACHE_DIR, 0o777)
+    planted = os.path.join(utils.OVPN_CACHE_DIR, "planted.ovpn")
+    with open(planted, "w") as f:
+        f.write("script-security 2\n")
+
+    create()
+    assert os.stat(utils.OVPN_CACHE_DIR).st_mode & 0o777 == 0o700
+    assert not os.path.exists(planted)
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from protonvpn_cli import journal
+
+
+@pytest.fixture
+def resolv(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "JOURNAL_FILE", str(tmp_path / "netstate.journal"))
+    path = tmp_path / "resolv.conf"
+    path.write_text("nameserver 10.8.8.1\n")
+    return path
+
+
+def record_dns(path, original, changed):
+    journal.record(journal.DNS, journal.restore_file_step(str(path), original, changed))
+
+
+def test_rollback_replays_one_step_per_target(resolv):
+    record_dns(resolv, "nameserver 192.168.1.1\n", "nameserver 10.8.8.1\n")
+    # A second leak protection of the same connect
+    record_dns(resolv, "nameserver 10.8.8.1\n", "nameserver 10.8.8.1\n")
+
+    assert journal.rollback() == 1
+    assert resolv.read_text() == "nameserver 192.168.1.1\n"
+    assert not os.path.exists(journal.JOURNAL_FILE)
+
+
+def test_rollback_keeps_changed_file(resolv):
+    record_dns(resolv, "nameserver 192.168.1.1\n", "nameserver 10.8.8.1\n")
+    # Changed since, e.g. by switching networks
+    resolv.write_text("nameserver 172.16.0.1\n")
+
+    journal.rollback()
+    assert resolv.read_text() == "nameserver 172.16.0.1\n"
+
+
+def test_rollback_of_kinds_keeps_connect_in_progress(resolv):
+    transaction = journal.begin()
+    record_dns(resolv, "nameserver 192.168.1.1\n", "nameserver 10.8.8.1\n")
+
+    assert journal.rollback([journal.IPV6]) == 0
+    assert journal.is_active(journal.DNS)
+
+    journal.rollback([journal.DNS])
+    assert resolv.read_text() == "nameserver 192.168.1.1\n"
+    assert not journal.is_active(journal.DNS)
+    # The begin of the running connect has to survive for crash recovery
+    assert os.path.exists(journal.JOURNAL_FILE)
+
+    journal.commit(transaction)
+    journal.rollback()
+    assert not os.path.exists(journal.JOURNAL_FILE)
+
+
+def test_needs_recovery_after_crash(resolv):
+    journal.begin()
+    record_dns(resolv, "nameserver 192.168.1.1\n", "nameserver 10.8.8.1\n")
+    assert not journal.needs_recovery()
+
+    # A pid that can't exist, as if the connecting process crashed
+    with open(journal.JOURNAL_FILE, "r") as f:
+        content = f.read().replace('"pid":{0}'.format(os.getpid()), '"pid":{0}'.format(2 ** 22 + 1))
+    with open(journal.JOURNAL_FILE, "w") as f:
+        f.write(content)
+    assert journal.needs_recovery()
+
+    journal.rollback()
+    assert not journal.needs_recovery()
+    assert resolv.read_text() == "nameserver 192.168.1.1\n"
+    assert not os.path.exists(journal.JOURNAL_FILE)
@@ -0,0 +1,41 @@
+import pytest
+
+from protonvpn_cli import ranking
+from protonvpn_cli.servers import LogicalServer
+
+
+def make_servers(count):
+    return [
+        LogicalServer({
+            "Name": "CH#{0}".format(idx), "ExitCountry": "CH", "Tier": 2,
+            "Features": 0, "Status": 1, "Load": 50, "Score": 1.0,
+        })
+        for idx in range(count)
+    ]
+
+
+@pytest.fixture(params=["numpy", "array"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ranking, "np", None)
+    return request.param
+
+
+def test_single_bad_value_does_not_outrank_unknown(backend):
+    servers = make_servers(5)
+    weights = ranking.parse_weights(ranking.DEFAULT_WEIGHTS)
+    # The only server with history failed every connect and is slow
+    costs = list(ranking.ServerTable(servers).costs(
+        weights, rtts={"CH#0": 1.4}, success_rates={"CH#0": 0.0}
+    ))
+    assert costs == pytest.approx([costs[1]] * len(servers))
+
+
+def test_known_values_are_scaled_around_unknown(backend):
+    servers = make_servers(3)
+    costs = list(ranking.ServerTable(servers).costs(
+        {"rtt": 1}, rtts={"CH#0": 0.01, "CH#1": 1.4}
+    ))
+    assert costs == pytest.approx([0.0, 1.0, 0.5])
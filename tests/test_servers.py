@@ -0,0 +1,70 @@
+import json
+import random
+
+import pytest
+
+from protonvpn_cli.servers import (
+    LogicalServer, ServerIndex, iter_json_array, FEATURE_NORMAL, FEATURE_SECURE_CORE, FEATURE_TOR, FEATURE_P2P
+)
+
+DOCUMENT = json.dumps({
+    "Code": 1000,
+    "LogicalServers": [
+        {"Name": "CH#1", "City": "Zürich", "Servers": [{"EntryIP": "10.0.0.1"}]},
+        {"Name": "JP#1", "City": "東京", "Tags": [], "Note": "]\"[,{"},
+        {"Name": "US#1", "Score": 1.5e-3},
+    ],
+}, ensure_ascii=False, indent=1).encode()
+
+
+def split(data, size):
+    return [data[idx:idx + size] for idx in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(DOCUMENT)])
+def test_iter_json_array_chunk_boundaries(size):
+    # Chunks split keys, items and multibyte UTF-8 characters at every offset
+    items = list(iter_json_array(split(DOCUMENT, size), "LogicalServers"))
+    assert items == json.loads(DOCUMENT.decode())["LogicalServers"]
+
+
+def test_iter_json_array_skips_empty_chunks():
+    chunks = [b""] + [chunk for part in split(DOCUMENT, 5) for chunk in (part, b"")]
+    assert len(list(iter_json_array(chunks, "LogicalServers"))) == 3
+
+
+def test_iter_json_array_errors():
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'{"Code": 1000}'], "LogicalServers"))
+    with pytest.raises(ValueError):
+        list(iter_json_array(split(DOCUMENT[:-20], 4), "LogicalServers"))
+
+
+def make_servers(count):
+    random.seed(1)
+    return [
+        LogicalServer({
+            "Name": "S{0}".format(idx), "ExitCountry": random.choice(["CH", "SE", "US"]), "Tier": 2,
+            "Features": random.choice([0, 1, 2, 4, 5, 6]), "Status": 1, "Load": 50, "Score": 1.0,
+        })
+        for idx in range(count)
+    ]
+
+
+@pytest.mark.parametrize("countries", [None, ["CH"], ["SE", "US"], ["XX"]])
+@pytest.mark.parametrize("features", [FEATURE_NORMAL, FEATURE_SECURE_CORE, FEATURE_P2P, FEATURE_TOR | FEATURE_P2P])
+def test_server_index_select_matches_scan(countries, features):
+    servers = make_servers(300)
+    excluded = FEATURE_SECURE_CORE | FEATURE_TOR
+    expected = [
+        server for server in servers
+        if (countries is None or server.exit_country in countries)
+        and server.features & features == features
+        and not server.features & excluded & ~features
+    ]
+    assert ServerIndex(servers).select(countries, features, excluded) == expected
+
+
+def test_server_index_select_empty():
+    assert ServerIndex([]).select() == []
+    assert ServerIndex(make_servers(3)).select(["XX"]) == []